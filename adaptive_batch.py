@@ -0,0 +1,94 @@
+import time
+from typing import Any, Dict, Optional
+
+
+def _clamp(value: float, lowest: float, highest: float) -> float:
+    return max(lowest, min(highest, value))
+
+
+class AdaptiveBatchController:
+    """
+    按观测到的到达速率、队列深度和写库耗时调整批大小和刷新期限，使数据从入队到写库完成的延迟接近目标
+    - 刷新期限：目标延迟减去最近一次刷新的耗时（数据等到期限后还要写库），限制在[min_interval, max_interval]
+    - 批大小：期限内预计到达的数据量，并按每条的写库成本封顶，使一次刷新不超过目标延迟的一半；
+      积压超过两个批次时不再封顶，按积压量增大批次，摊薄每次写库的固定开销尽快追上
+    - 批大小限制在[min_size, max_size]
+    观测值使用指数移动平均，只在每次刷新后更新
+    """
+
+    def __init__(self, latency_target: float, min_size: int, max_size: int, min_interval: float,
+                 max_interval: float, initial_size: int, initial_interval: float, alpha: float = 0.3):
+        """
+        Args:
+            latency_target: 目标延迟（秒），自入队到写库完成
+            min_size, max_size: 批大小的范围（条）
+            min_interval, max_interval: 刷新期限的范围（秒）
+            initial_size, initial_interval: 还没有观测值时使用的批大小和刷新期限
+            alpha: 指数移动平均中新观测值的权重
+        """
+        self.latency_target = latency_target
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.alpha = alpha
+
+        self.batch_size = int(_clamp(initial_size, self.min_size, self.max_size))
+        self.flush_interval = _clamp(initial_interval, self.min_interval, self.max_interval)
+
+        self._arrivals = 0
+        self._last_update = time.monotonic()
+        self.arrival_rate = 0.0  # 每秒到达的条数
+        self.flush_seconds: Optional[float] = None  # 每次刷新的耗时
+        self.seconds_per_item: Optional[float] = None  # 每条的写库耗时
+        self.adjustments = 0
+
+    def _average(self, current: Optional[float], value: float) -> float:
+        return value if current is None else current + self.alpha * (value - current)
+
+    def record_arrivals(self, count: int = 1) -> None:
+        self._arrivals += count
+
+    def observe_flush(self, items: int, seconds: float, queue_depth: int) -> None:
+        """
+        每次刷新后调用
+        :param items: 本次刷新写入的条数
+        :param seconds: 本次刷新的耗时（秒）
+        :param queue_depth: 刷新后仍在等待的条数
+        """
+        now = time.monotonic()
+        elapsed = now - self._last_update
+        if elapsed > 0:
+            self.arrival_rate = self._average(self.arrival_rate, self._arrivals / elapsed)
+        self._arrivals = 0
+        self._last_update = now
+        self.flush_seconds = self._average(self.flush_seconds, seconds)
+        if items > 0:
+            self.seconds_per_item = self._average(self.seconds_per_item, seconds / items)
+        self._adjust(queue_depth)
+
+    def _adjust(self, queue_depth: int) -> None:
+        interval = _clamp(self.latency_target - (self.flush_seconds or 0.0), self.min_interval, self.max_interval)
+
+        size = self.arrival_rate * interval
+        if self.seconds_per_item:
+            size = min(size, self.latency_target / 2 / self.seconds_per_item)
+        if queue_depth > 2 * self.batch_size:
+            # 每次刷新最多取两个批次，按积压量增大批次
+            size = max(size, queue_depth / 2)
+        size = int(_clamp(size, self.min_size, self.max_size))
+
+        if size != self.batch_size or abs(interval - self.flush_interval) > 1e-3:
+            self.adjustments += 1
+        self.batch_size, self.flush_interval = size, interval
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            'batch_size': self.batch_size,
+            'flush_interval': round(self.flush_interval, 4),
+            'latency_target': self.latency_target,
+            'arrival_rate': round(self.arrival_rate, 2),
+            'flush_seconds': round(self.flush_seconds, 6) if self.flush_seconds is not None else None,
+            'seconds_per_item': round(self.seconds_per_item, 9) if self.seconds_per_item is not None else None,
+            'adjustments': self.adjustments,
+        }
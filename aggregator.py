@@ -0,0 +1,190 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import struct
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 消息格式：4字节大端长度 + JSON负载；应答为1字节
+_HEADER = struct.Struct(">I")
+_ACK = b"\x01"
+AGGREGATOR_SEND_TIMEOUT = float(os.getenv("BATCH_AGGREGATOR_SEND_TIMEOUT", "2.0"))  # 发送/等待应答超时（秒）
+
+
+def _encode_entries(entries: List[Tuple[Tuple[str, str, str], Dict[str, Any]]]) -> bytes:
+    """序列化合并后的更新，datetime转为字符串（由聚合器重新设置lastUpdated）"""
+    payload = json.dumps(
+        [[list(key), update_fields] for key, update_fields in entries],
+        default=lambda value: value.isoformat() if isinstance(value, datetime) else str(value)
+    ).encode()
+    return _HEADER.pack(len(payload)) + payload
+
+
+def _decode_entries(payload: bytes) -> List[Tuple[Tuple[str, str, str], Dict[str, Any]]]:
+    entries = []
+    for key, update_fields in json.loads(payload):
+        if '$set' in update_fields and 'lastUpdated' in update_fields['$set']:
+            update_fields['$set']['lastUpdated'] = datetime.utcnow()
+        entries.append((tuple(key), update_fields))
+    return entries
+
+
+class WorkerAggregator:
+    """
+    多worker进程间的预聚合器
+    同一台机器上的worker通过文件锁选出一个leader，leader监听Unix socket接收其他worker合并后的增量，
+    并放入自己的批处理队列统一写库；其他worker（follower）刷新时把增量发给leader而不是直接写库。
+    leader退出后文件锁自动释放，follower在下次发送时重新竞选。
+    stop()之后不再竞选也不再发送，停止前剩余的数据由本进程直接写库。
+    """
+
+    def __init__(self, socket_path: str, on_entries: Callable[[List[tuple]], Awaitable[List[tuple]]]):
+        """
+        Args:
+            socket_path: Unix socket路径，同目录下的 <socket_path>.lock 用于选主
+            on_entries: leader收到增量后的回调，返回未能接收的条目；回调返回后才应答，
+                        不能等待入队或写库（超过发送超时follower会自行写库）
+        """
+        self.socket_path = socket_path
+        self.lock_path = f"{socket_path}.lock"
+        self._on_entries = on_entries
+        self._lock_fd: Optional[int] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._send_lock = asyncio.Lock()
+        self._connections = set()  # leader端已建立的连接
+        self._stopping = False
+        self.metrics = {
+            'sent_batches': 0,
+            'received_batches': 0,
+            'received_entries': 0,
+            'send_failures': 0,
+        }
+
+    @property
+    def is_leader(self) -> bool:
+        return self._server is not None
+
+    async def start(self):
+        self._stopping = False
+        await self._try_become_leader()
+
+    async def stop(self):
+        # 先关闭选主和发送：停止过程中刷新剩余数据时不能重新成为leader（否则接收的增量不会再被写库）
+        self._stopping = True
+        async with self._send_lock:
+            await self._close_client()
+        if self._server:
+            self._server.close()
+            for writer in list(self._connections):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+        if self._lock_fd is not None:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    async def _try_become_leader(self) -> bool:
+        """非阻塞地尝试获取文件锁，成功则成为leader并启动socket服务"""
+        if self.is_leader:
+            return True
+        if self._stopping:
+            return False
+        fd = os.open(self.lock_path, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+
+        self._lock_fd = fd
+        # 持有锁说明之前的leader已退出，清理残留的socket文件
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+        self._server = await asyncio.start_unix_server(self._handle_connection, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        await self._close_client()
+        logger.info(f"Worker {os.getpid()} became batch aggregator leader on {self.socket_path}")
+        return True
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(_HEADER.size)
+                (length,) = _HEADER.unpack(header)
+                entries = _decode_entries(await reader.readexactly(length))
+                rejected = await self._on_entries(entries)
+                if rejected:
+                    # 未被接收的条目不应答，让follower自行降级写库
+                    logger.warning(f"Aggregator leader rejected {len(rejected)} entries")
+                    break
+                self.metrics['received_batches'] += 1
+                self.metrics['received_entries'] += len(entries)
+                writer.write(_ACK)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            logger.error(f"Aggregator connection error: {e}", exc_info=True)
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _close_client(self):
+        if self._writer:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+
+    async def send(self, entries: List[Tuple[Tuple[str, str, str], Dict[str, Any]]]) -> bool:
+        """
+        follower将合并后的增量发送给leader
+
+        Returns:
+            bool: leader是否已确认接收；返回False时调用方应直接写库（包括已停止时）
+        """
+        if not entries:
+            return True
+        if self._stopping:
+            return False
+        async with self._send_lock:
+            if self._stopping:
+                return False
+            # leader可能已经退出，先尝试接替
+            if await self._try_become_leader():
+                return False
+            try:
+                if self._writer is None or self._writer.is_closing():
+                    self._reader, self._writer = await asyncio.wait_for(
+                        asyncio.open_unix_connection(self.socket_path), timeout=AGGREGATOR_SEND_TIMEOUT
+                    )
+                self._writer.write(_encode_entries(entries))
+                await asyncio.wait_for(self._writer.drain(), timeout=AGGREGATOR_SEND_TIMEOUT)
+                ack = await asyncio.wait_for(self._reader.readexactly(1), timeout=AGGREGATOR_SEND_TIMEOUT)
+                if ack != _ACK:
+                    raise ConnectionError(f"Unexpected aggregator ack: {ack!r}")
+                self.metrics['sent_batches'] += 1
+                return True
+            except Exception as e:
+                logger.warning(f"Send to aggregator failed, falling back to direct write: {e}")
+                self.metrics['send_failures'] += 1
+                await self._close_client()
+                return False
+
+    def get_metrics(self) -> Dict[str, Any]:
+        metrics = self.metrics.copy()
+        metrics['role'] = 'leader' if self.is_leader else 'follower'
+        return metrics
@@ -13,6 +13,8 @@ from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import RedirectResponse
 from starlette.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+from typing import Optional
+
 from pydantic import BaseModel
 
 from starlette.staticfiles import StaticFiles
@@ -20,7 +22,14 @@ from starlette.staticfiles import StaticFiles
 from security import require_login, logout_user, login_user, get_current_user, JWT_EXPIRE_PERIOD, cleanup_expired_cache, \
     get_password_hash, get_user_cache, NoUserCache
 import mongodb
-from track import api_router, get_batch_processor
+from batch import topk_limiter
+from dimension_dict import dimension_dictionary
+from track import api_router, get_batch_processor, invalidate_site_cache, period_compactor, stats_retention
+from export import export_router
+from profiler import STATS_PROFILE_ENABLED, StatsProfilerMiddleware, profiler_router
+from rollup import STATS_HOURLY_BUCKETS, STATS_PERIOD_ROLLUPS, stats_rollup
+from retention import STATS_RETENTION
+from storage import STATS_STORAGE, stats_storage
 from util import access_system
 
 SESSION_CLEANUP_PERIOD = os.environ["SESSION_CLEANUP_PERIOD"] if "SESSION_CLEANUP_PERIOD" in os.environ else 3600
@@ -39,6 +48,16 @@ class RegisterRequest(BaseModel):
 class CreateSiteRequest(BaseModel):
     site_name: str
     site_url: str
+    top_k: Optional[int] = None  # 开启top-K模式时每个自由输入维度保留的键数
+    retention_days: Optional[int] = None  # 每日统计的保留天数，更早的按月归档
+
+
+class SiteTopKRequest(BaseModel):
+    top_k: Optional[int] = None  # 为空或0时关闭top-K模式
+
+
+class SiteRetentionRequest(BaseModel):
+    retention_days: Optional[int] = None  # 为空或0时永久保留每日统计
 
 
 class ChangePasswordRequest(BaseModel):
@@ -101,6 +120,15 @@ async def lifespan(app: FastAPI):
     from security import set_user_service
     set_user_service(mongodb.MongoDBUserService())
     await start_batch_processor()
+    # 按小时分桶时启动小时文档汇总任务
+    if STATS_HOURLY_BUCKETS:
+        await stats_rollup.start()
+    # 启用周/月汇总时启动汇总任务
+    if STATS_PERIOD_ROLLUPS:
+        await period_compactor.start()
+    # 启用保留策略时启动归档任务（只处理设置了retention_days的网站）
+    if STATS_RETENTION:
+        await stats_retention.start()
     # 添加停止标志
     stop_flag = threading.Event()
     def periodic_cleanup():
@@ -115,7 +143,13 @@ async def lifespan(app: FastAPI):
         cleanup_thread.start()
     yield
     stop_flag.set()
+    await stats_retention.stop()
+    await period_compactor.stop()
+    await stats_rollup.stop()
+    await dimension_dictionary.stop()
     await stop_batch_processor()
+    # 批处理器写完剩余数据后再关闭存储
+    stats_storage.close()
 
 app = FastAPI(title="页面访问监控API", lifespan=lifespan)
 
@@ -141,6 +175,9 @@ app.add_middleware(
 )
 
 app.add_middleware(TokenRefreshMiddleware)
+# 慢查询性能分析（可选）
+if STATS_PROFILE_ENABLED:
+    app.add_middleware(StatsProfilerMiddleware)
 
 
 @app.post("/login")
@@ -225,7 +262,7 @@ async def get_sites(request: Request):
                 {"creator": current_user.username},
                 {"site_name": {"$in": current_user.permissions}}
             ]},
-            {"_id": 0, "site_name": 1, "site_url": 1, "api_key": 1, "creator": 1}
+            {"_id": 0, "site_name": 1, "site_url": 1, "api_key": 1, "creator": 1, "top_k": 1, "retention_days": 1}
         )
         return await sites_cursor.to_list(length=None)
     except Exception as e:
@@ -274,9 +311,21 @@ async def create_site(request: Request, site_data: CreateSiteRequest):
         "api_key": api_key,
         "created_at": datetime.now()
     }
+    if site_data.top_k:
+        if site_data.top_k < 0:
+            raise HTTPException(status_code=400, detail="top_k不能为负数")
+        _require_mongodb_storage("top_k")
+        save_data["top_k"] = site_data.top_k
+    if site_data.retention_days:
+        if site_data.retention_days < 0:
+            raise HTTPException(status_code=400, detail="retention_days不能为负数")
+        _require_mongodb_storage("retention_days")
+        save_data["retention_days"] = site_data.retention_days
 
     # 插入网站数据到数据库
     await mongodb.sites_collection.insert_one(save_data)
+    # 清除该网站名称可能存在的负缓存
+    invalidate_site_cache(site_data.site_name)
     
 
     # 获取当前用户的权限列表
@@ -303,6 +352,85 @@ async def create_site(request: Request, site_data: CreateSiteRequest):
     }
 
 
+def _require_mongodb_storage(setting: str):
+    """top-K和保留策略依赖MongoDB统计集合，其他存储后端拒绝设置（否则会被静默忽略）"""
+    if STATS_STORAGE != 'mongodb':
+        raise HTTPException(status_code=400, detail=f"STATS_STORAGE={STATS_STORAGE}不支持{setting}")
+
+
+@app.put("/sites/{site_name}/top-k")
+@access_system("${site_name}")
+async def set_site_top_k(request: Request, site_name: str, top_k_request: SiteTopKRequest):
+    """
+    设置网站的top-K模式：url、referrer、selector、eventLabel、fileName等自由输入维度
+    每天只保留计数最大的K个键，其余计入(other)，统计结果附带误差上界
+    
+    Args:
+        request: 请求对象，用于获取当前用户信息
+        site_name: 网站名称
+        top_k_request: K值，为空或0时关闭
+    """
+    current_user = await get_current_user(request)
+    if not current_user:
+        raise HTTPException(status_code=401, detail="请先登录")
+    top_k = top_k_request.top_k or 0
+    if top_k < 0:
+        raise HTTPException(status_code=400, detail="top_k不能为负数")
+    if top_k:
+        _require_mongodb_storage("top_k")
+
+    site = await mongodb.sites_collection.find_one({"site_name": site_name})
+    if not site:
+        raise HTTPException(status_code=404, detail="网站不存在")
+    # 只有创建者可以修改
+    if site.get("creator") != current_user.username:
+        raise HTTPException(status_code=403, detail="没有权限修改此网站")
+
+    if top_k:
+        await mongodb.sites_collection.update_one({"site_name": site_name}, {"$set": {"top_k": top_k}})
+    else:
+        await mongodb.sites_collection.update_one({"site_name": site_name}, {"$unset": {"top_k": ""}})
+    # 只作用于当前worker进程，其他进程在TOPK_CONFIG_TTL后生效
+    topk_limiter.invalidate_site(site_name)
+    return {"success": True, "site_name": site_name, "top_k": top_k}
+
+
+@app.put("/sites/{site_name}/retention")
+@access_system("${site_name}")
+async def set_site_retention(request: Request, site_name: str, retention_request: SiteRetentionRequest):
+    """
+    设置网站的保留策略：早于retention_days天的每日统计按自然月合并为月汇总，
+    删除按用户指纹的维度和原每日文档（需要启用STATS_RETENTION）
+    
+    Args:
+        request: 请求对象，用于获取当前用户信息
+        site_name: 网站名称
+        retention_request: 保留天数，为空或0时永久保留
+    """
+    current_user = await get_current_user(request)
+    if not current_user:
+        raise HTTPException(status_code=401, detail="请先登录")
+    retention_days = retention_request.retention_days or 0
+    if retention_days < 0:
+        raise HTTPException(status_code=400, detail="retention_days不能为负数")
+    if retention_days:
+        _require_mongodb_storage("retention_days")
+
+    site = await mongodb.sites_collection.find_one({"site_name": site_name})
+    if not site:
+        raise HTTPException(status_code=404, detail="网站不存在")
+    # 只有创建者可以修改
+    if site.get("creator") != current_user.username:
+        raise HTTPException(status_code=403, detail="没有权限修改此网站")
+
+    if retention_days:
+        await mongodb.sites_collection.update_one({"site_name": site_name},
+                                                  {"$set": {"retention_days": retention_days}})
+    else:
+        await mongodb.sites_collection.update_one({"site_name": site_name}, {"$unset": {"retention_days": ""}})
+    return {"success": True, "site_name": site_name, "retention_days": retention_days}
+
+
 @app.delete("/sites/{site_name}")
 @access_system("${site_name}")
 async def delete_site(request: Request, site_name: str):
@@ -333,6 +461,8 @@ async def delete_site(request: Request, site_name: str):
         
         # 删除网站记录
         await mongodb.sites_collection.delete_one({"site_name": site_name})
+        invalidate_site_cache(site_name)
+        topk_limiter.invalidate_site(site_name)
         
         # 从所有用户的permissions中移除该网站名称
         result = await mongodb.users_collection.update_many(
@@ -352,7 +482,7 @@ async def delete_site(request: Request, site_name: str):
             "message": f"成功删除网站 '{site_name}' 及其相关数据",
             "site_deleted": True,
             "users_updated": result.modified_count,
-            "stats_deleted": stats_result.get("deleted_count", 0)
+            "stats_delete_job": stats_result.get("job_id")
         }
     except HTTPException:
         raise
@@ -622,6 +752,8 @@ class ProtectedStaticFiles(StaticFiles):
 
 # 注册API路由
 app.include_router(api_router)
+app.include_router(export_router)
+app.include_router(profiler_router)
 
 # 配置静态文件服务（放在API路由定义之后）
 app.mount("/public", StaticFiles(directory="public"), name="public")
@@ -5,19 +5,256 @@ import os
 from typing import Dict, Any, Tuple, List, Optional
 from datetime import datetime
 import threading
+import zlib
+from bson import Binary
 from pymongo import UpdateOne
 
-from mongodb import stats_collection
+import hll
+from adaptive_batch import AdaptiveBatchController
+from aggregator import WorkerAggregator
+from mongodb import stats_collection, user_stats_collection, hourly_stats_collection
+from storage import STATS_STORAGE, stats_storage
+from topk import TopKLimiter
+from util import LogHistogram
+from wal import WriteAheadLog
 
 # 配置 - 从环境变量获取，没有则使用默认值
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", "50"))  # 达到50条记录时触发批量更新
-BATCH_INTERVAL = int(os.getenv("BATCH_INTERVAL", "5"))  # 每5秒触发一次批量更新
+BATCH_INTERVAL = float(os.getenv("BATCH_INTERVAL", "5"))  # 最早一条数据等待5秒后触发批量更新
 BATCH_MAX_QUEUE_SIZE = int(os.getenv("BATCH_MAX_QUEUE_SIZE", "10000"))  # 最大队列长度
 BATCH_RETRY_MAX_ATTEMPTS = int(os.getenv("BATCH_RETRY_MAX_ATTEMPTS", "3"))  # 最大重试次数
 BATCH_RETRY_BASE_DELAY = float(os.getenv("BATCH_RETRY_BASE_DELAY", "1.0"))  # 重试基础延迟（秒）
+BATCH_STOP_TIMEOUT = float(os.getenv("BATCH_STOP_TIMEOUT", "30"))  # 停止时写完剩余数据的最长时间（秒）
+# 自适应批大小：按到达速率、队列深度和写库耗时在以下范围内调整批大小和刷新期限，BATCH_INTERVAL为期限上限
+BATCH_ADAPTIVE = os.getenv("BATCH_ADAPTIVE", "False").lower() == "true"
+BATCH_LATENCY_TARGET = float(os.getenv("BATCH_LATENCY_TARGET", "1.0"))  # 自入队到写库完成的目标延迟（秒）
+BATCH_SIZE_MIN = int(os.getenv("BATCH_SIZE_MIN", "10"))
+BATCH_SIZE_MAX = int(os.getenv("BATCH_SIZE_MAX", "1000"))
+BATCH_INTERVAL_MIN = float(os.getenv("BATCH_INTERVAL_MIN", "0.05"))
+# 多worker预聚合的Unix socket路径，为空则不启用（每个worker各自写库）
+BATCH_AGGREGATOR_SOCKET = os.getenv("BATCH_AGGREGATOR_SOCKET", "")
+# 预写日志目录，为空则不启用（队列中的数据在进程崩溃时会丢失）
+BATCH_WAL_DIR = os.getenv("BATCH_WAL_DIR", "")
+BATCH_WAL_SEGMENT_BYTES = int(os.getenv("BATCH_WAL_SEGMENT_BYTES", str(16 * 1024 * 1024)))  # 单个段文件大小
+BATCH_WAL_FSYNC_INTERVAL = float(os.getenv("BATCH_WAL_FSYNC_INTERVAL", "0.05"))  # 分组提交fsync的间隔（秒）
+# 累加器模式：add()时直接合并到按key的计数表，内存随不同key数增长而不是随事件数增长
+BATCH_ACCUMULATOR_MODE = os.getenv("BATCH_ACCUMULATOR_MODE", "False").lower() == "true"
+HLL_CAS_MAX_ATTEMPTS = int(os.getenv("HLL_CAS_MAX_ATTEMPTS", "5"))  # HLL草图乐观并发写入的最大尝试次数
+# 按用户指纹的维度拆分到独立的分桶文档（按指纹哈希分桶，建议16），默认0仍写入每日统计文档
+# 非MongoDB存储没有分桶集合，用户维度总是写入每日统计文档
+USER_DIMENSION_BUCKETS = int(os.getenv("USER_DIMENSION_BUCKETS", "0")) if STATS_STORAGE == 'mongodb' else 0
+
+# 以用户指纹为最后一级键的高基数维度，摘要查询不读取
+USER_DIMENSIONS = ('byUser', 'byUrlAndUser', 'byFileAndUser', 'byCategoryAndUser', 'byCategoryAndActionAndUser')
 
 logger = logging.getLogger(__name__)
 
+# 按站点开启的top-K模式（分桶存储的用户维度不在每日文档内，只改写不折叠）
+topk_limiter = TopKLimiter(USER_DIMENSIONS if USER_DIMENSION_BUCKETS > 0 else ())
+
+
+def get_stats_target(key: Tuple[str, str, str]) -> Tuple[Any, Dict[str, Any]]:
+    """
+    获取批处理键对应的集合和查询条件
+    按小时分桶的键（日期为 YYYY-MM-DDTHH）写入小时集合中仍在接收写入（active）的文档
+    """
+    system, date, track_type = key
+    filter_criteria = {'system': system, 'date': date, 'type': track_type}
+    if len(date) > len('YYYY-MM-DD'):
+        # 已被汇总任务冻结的小时文档不再写入，迟到的数据会写入新的小时文档
+        filter_criteria['active'] = True
+        return hourly_stats_collection, filter_criteria
+    return stats_collection, filter_criteria
+
+
+def split_unique_updates(update_fields: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, set]]:
+    """
+    HLL模式下把$addToSet的唯一用户字段拆出来，改为写入 data.hll.* 草图
+
+    Returns:
+        tuple: (不含$addToSet的更新操作, {草图字段路径: 指纹集合})
+    """
+    if not hll.HLL_ENABLED or '$addToSet' not in update_fields:
+        return update_fields, {}
+    sketch_values = {}
+    for field, value in update_fields['$addToSet'].items():
+        path = 'data.hll.' + field[len('data.'):] if field.startswith('data.') else f'hll.{field}'
+        if isinstance(value, dict) and '$each' in value:
+            sketch_values[path] = set(value['$each'])
+        else:
+            sketch_values[path] = {value}
+    remaining = {op: value for op, value in update_fields.items() if op != '$addToSet'}
+    return remaining, sketch_values
+
+
+def split_user_dimension_updates(update_fields: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[Tuple[str, int], Dict[str, int]]]:
+    """
+    把按用户指纹的$inc字段从每日统计更新中拆出来，按(维度, 桶)分组
+    例如 data.byUrlAndUser.<url>.<指纹> 拆为 (byUrlAndUser, 桶) 文档中的 data.<url>.<指纹>
+
+    Returns:
+        tuple: (剩余的更新操作, {(维度, 桶): {字段路径: 增量}})
+    """
+    if USER_DIMENSION_BUCKETS <= 0 or '$inc' not in update_fields:
+        return update_fields, {}
+    counters = {}
+    user_updates = {}
+    for field, value in update_fields['$inc'].items():
+        parts = field.split('.')
+        if len(parts) > 2 and parts[0] == 'data' and parts[1] in USER_DIMENSIONS:
+            # 指纹总是最后一级键，同一用户的所有维度落在同一个桶
+            bucket = zlib.crc32(parts[-1].encode()) % USER_DIMENSION_BUCKETS
+            user_updates.setdefault((parts[1], bucket), {})['data.' + '.'.join(parts[2:])] = value
+        else:
+            counters[field] = value
+    if not user_updates:
+        return update_fields, {}
+    remaining = {op: value for op, value in update_fields.items() if op != '$inc'}
+    if counters:
+        remaining['$inc'] = counters
+    return remaining, user_updates
+
+
+def build_user_dimension_operations(key: Tuple[str, str, str],
+                                    user_updates: Dict[Tuple[str, int], Dict[str, int]]) -> List[UpdateOne]:
+    """构建分桶用户维度文档的upsert操作"""
+    system, date, track_type = key
+    # 用户维度只按天存储（按小时分桶时也写入当天）
+    date = date[:len('YYYY-MM-DD')]
+    return [
+        UpdateOne(
+            {'system': system, 'date': date, 'type': track_type, 'dimension': dimension, 'bucket': bucket},
+            {'$inc': fields},
+            upsert=True
+        )
+        for (dimension, bucket), fields in user_updates.items()
+    ]
+
+
+def _get_path(document: Optional[Dict[str, Any]], path: str):
+    for part in path.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(part)
+    return document
+
+
+async def apply_hll_updates(key: Tuple[str, str, str], sketch_values: Dict[str, set]) -> bool:
+    """
+    将指纹合并进文档中的HLL草图（BSON二进制，寄存器取最大值）
+    草图无法用MongoDB更新操作符合并，采用读-合并-写，并以hllVersion做乐观并发控制
+
+    Returns:
+        bool: 是否写入成功
+    """
+    collection, filter_criteria = get_stats_target(key)
+    projection = {'_id': 0, 'hllVersion': 1}
+    projection.update({path: 1 for path in sketch_values})
+
+    for _ in range(HLL_CAS_MAX_ATTEMPTS):
+        document = await collection.find_one(filter_criteria, projection)
+        version = document.get('hllVersion') if document else None
+
+        sketches = {}
+        for path, values in sketch_values.items():
+            existing = _get_path(document, path)
+            registers = hll.decode(existing) if existing else hll.new_registers()
+            for value in values:
+                hll.add(registers, value)
+            sketches[path] = Binary(hll.encode(registers))
+
+        # 只有在草图未被其他进程修改时才写入
+        cas_filter = dict(filter_criteria)
+        cas_filter['hllVersion'] = version if version is not None else {'$exists': False}
+        try:
+            result = await collection.update_one(
+                cas_filter,
+                {'$set': sketches, '$inc': {'hllVersion': 1}},
+                upsert=document is None
+            )
+        except Exception as e:
+            logger.warning(f"HLL sketch write conflict for {key}: {e}")
+            continue
+        if result.matched_count or result.upserted_id is not None:
+            return True
+
+    logger.error(f"HLL sketch update gave up after {HLL_CAS_MAX_ATTEMPTS} attempts: {key}")
+    return False
+
+
+class UpdateAccumulator:
+    """
+    按(system, date, type)累加的更新缓冲区
+    $inc直接累加到计数表，$addToSet的值放入集合去重，$set保留最新值；
+    刷新时整体交换出去，交换为O(1)
+    """
+
+    def __init__(self):
+        self._entries: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        self._wal_records = []  # 预写日志中的记录位置
+        self.pending_events = 0
+        self.oldest_added_at: Optional[float] = None  # 当前缓冲区中最早一条的加入时间（monotonic）
+
+    def add(self, key: Tuple[str, str, str], update_fields: Dict[str, Any], wal_record: Optional[tuple] = None):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {'$inc': {}, '$set': {}, '$addToSet': {}, 'others': None}
+
+        counters = entry['$inc']
+        for field, value in update_fields.get('$inc', {}).items():
+            counters[field] = counters.get(field, 0) + value
+
+        entry['$set'].update(update_fields.get('$set', {}))
+
+        sets = entry['$addToSet']
+        for field, value in update_fields.get('$addToSet', {}).items():
+            values = sets.get(field)
+            if values is None:
+                values = sets[field] = set()
+            if isinstance(value, dict) and '$each' in value:
+                values.update(value['$each'])
+            else:
+                values.add(value)
+
+        # 其他操作符（如$push）较少使用，沿用通用合并逻辑
+        others = {op: value for op, value in update_fields.items() if op not in ('$inc', '$set', '$addToSet')}
+        if others:
+            entry['others'] = BatchProcessor._merge_update_fields(entry['others'], others) if entry['others'] else others
+
+        if wal_record is not None:
+            self._wal_records.append(wal_record)
+        if not self.pending_events:
+            self.oldest_added_at = time.monotonic()
+        self.pending_events += 1
+
+    @property
+    def key_count(self) -> int:
+        return len(self._entries)
+
+    def swap(self) -> Tuple[Dict[Tuple[str, str, str], Dict[str, Any]], list, int]:
+        """
+        交换出当前缓冲区
+
+        Returns:
+            tuple: (batch_cache, 预写日志记录位置, 事件数)，batch_cache为可直接写库的MongoDB更新操作
+        """
+        entries, wal_records, events = self._entries, self._wal_records, self.pending_events
+        self._entries, self._wal_records, self.pending_events = {}, [], 0
+        self.oldest_added_at = None
+
+        batch_cache = {}
+        for key, entry in entries.items():
+            update_fields = entry['others'] or {}
+            for op in ('$inc', '$set'):
+                if entry[op]:
+                    update_fields[op] = entry[op]
+            if entry['$addToSet']:
+                update_fields['$addToSet'] = {
+                    field: {'$each': list(values)} for field, values in entry['$addToSet'].items()
+                }
+            batch_cache[key] = update_fields
+        return batch_cache, wal_records, events
+
 
 class BatchProcessor:
     """高性能异步批处理器"""
@@ -29,10 +266,33 @@ class BatchProcessor:
         # 工作状态
         self.running = False
         self.worker_task: Optional[asyncio.Task] = None
-        self.flush_event = asyncio.Event()  # 用于触发刷新
+        self.flush_event = asyncio.Event()  # 唤醒工作器：空闲时有新数据、达到批大小或停止
+        self._worker_idle = False  # 工作器是否在等待新数据
+        self._queue_oldest_at: Optional[float] = None  # 队列中最早一条的入队时间（monotonic）
+        self._stop_deadline: Optional[float] = None  # 停止时写完剩余数据的期限（monotonic），重试退避不超过该期限
+        self._stop_requested = asyncio.Event()  # 唤醒正在退避等待的重试
         
         # 批量缓存
         self._batch_lock = asyncio.Lock()  # 用于保护批量缓存
+
+        # 多worker预聚合（可选）：follower把合并后的增量交给leader统一写库
+        self.aggregator: Optional[WorkerAggregator] = (
+            WorkerAggregator(BATCH_AGGREGATOR_SOCKET, self._accept_aggregated) if BATCH_AGGREGATOR_SOCKET else None
+        )
+
+        # 累加器模式（可选）：不使用队列，add()时直接合并
+        self.accumulator: Optional[UpdateAccumulator] = UpdateAccumulator() if BATCH_ACCUMULATOR_MODE else None
+
+        # 预写日志（可选）：队列元素为(key, update_fields, 日志记录位置, 入队时间)，写库成功后确认记录
+        self.wal: Optional[WriteAheadLog] = (
+            WriteAheadLog(BATCH_WAL_DIR, BATCH_WAL_SEGMENT_BYTES, BATCH_WAL_FSYNC_INTERVAL) if BATCH_WAL_DIR else None
+        )
+
+        # 自适应批大小（可选），未启用时固定为BATCH_SIZE和BATCH_INTERVAL
+        self.controller: Optional[AdaptiveBatchController] = AdaptiveBatchController(
+            BATCH_LATENCY_TARGET, BATCH_SIZE_MIN, BATCH_SIZE_MAX, BATCH_INTERVAL_MIN, BATCH_INTERVAL,
+            initial_size=BATCH_SIZE, initial_interval=BATCH_INTERVAL
+        ) if BATCH_ADAPTIVE else None
         
         # 指标
         self._metrics_lock = threading.Lock()  # 使用线程锁保护指标
@@ -46,6 +306,18 @@ class BatchProcessor:
             'avg_process_time': 0.0,
             'rejects_due_to_full_queue': 0,  # 新增：因队列满拒绝的数量
             'dropped_after_max_retries': 0,  # 新增：重试后丢弃的数量
+            'hll_sketch_errors': 0,  # HLL草图写入失败的次数（失败的草图更新会重新入队重试）
+            'user_dimension_errors': 0,  # 分桶用户维度写入失败的次数（失败的分桶会重新入队重试）
+        }
+
+        # 延迟和批量大小的分布（累计，不随上面的计数指标重置），用于按尾延迟告警
+        self.histograms = {
+            'enqueue_wait_seconds': LogHistogram(1e-6, 10),  # 放入队列的等待时间（队列满时阻塞）
+            'queue_time_seconds': LogHistogram(1e-4, 3600),  # 自入队到被刷新取出的时间
+            'merge_seconds': LogHistogram(1e-6, 60),  # 每次刷新合并更新操作的时间
+            'flush_seconds': LogHistogram(1e-4, 3600),  # 每次刷新的总时间
+            'bulk_write_seconds': LogHistogram(1e-4, 3600),  # 每次bulk_write的时间
+            'bulk_write_ops': LogHistogram(1, 1 << 20),  # 每次bulk_write的操作数
         }
         
     async def start(self):
@@ -54,6 +326,13 @@ class BatchProcessor:
             return
             
         self.running = True
+        self._stop_deadline = None
+        self._stop_requested.clear()
+        if self.wal:
+            self.wal.open()
+            await self._replay_wal()
+        if self.aggregator:
+            await self.aggregator.start()
         self.worker_task = asyncio.create_task(self._batch_worker())
         logger.info("Batch processor started")
         
@@ -64,6 +343,13 @@ class BatchProcessor:
             
         logger.info("Stopping batch processor...")
         self.running = False
+        # 期限从开始停止时计算，同时限制重试的退避等待（超过期限后失败的数据直接重新入队，保留在预写日志中）
+        deadline = self._stop_deadline = time.monotonic() + BATCH_STOP_TIMEOUT
+        self._stop_requested.set()
+
+        # 先停止预聚合（leader不再接收新增量，停止后不再竞选leader，剩余数据都由本进程直接写库）
+        if self.aggregator:
+            await self.aggregator.stop()
         
         # 触发最后一次刷新
         self.flush_event.set()
@@ -75,146 +361,310 @@ class BatchProcessor:
             except asyncio.CancelledError:
                 pass
                 
-        # 处理队列中剩余的数据
-        if not self.queue.empty():
+        # 处理队列中剩余的数据（每次刷新最多处理两个批次，循环直到清空）
+        # 写库失败的数据会重新入队，数据库不可用时按时间限制放弃，避免关闭一直挂起
+        while self.pending_count() > 0:
+            if time.monotonic() >= deadline:
+                logger.error(
+                    f"Batch processor stop timed out after {BATCH_STOP_TIMEOUT}s with {self.pending_count()} records "
+                    + ("kept in the WAL for replay" if self.wal else "not written")
+                )
+                break
             await self._flush_batch(force=True)
+
+        if self.wal:
+            self.wal.close()
             
         logger.info("Batch processor stopped gracefully")
-        
-    async def add(self, key: Tuple[str, str, str], update_fields: Dict[str, Any]) -> bool:
-        """
-        添加数据到批处理队列
-        
-        Args:
-            key: (system, date, track_type) 三元组
-            update_fields: MongoDB更新操作
-            
-        Returns:
-            bool: 是否成功加入队列
-        """
+
+    async def _replay_wal(self):
+        """回放已退出进程遗留的预写日志，合并后直接写库"""
+        for directory, lock_fd in self.wal.claim_orphan_dirs():
+            batch_cache = {}
+            try:
+                for key, update_fields in self.wal.read_dir(directory):
+                    if key in batch_cache:
+                        batch_cache[key] = self._merge_update_fields(batch_cache[key], update_fields)
+                    else:
+                        batch_cache[key] = update_fields
+                if not batch_cache:
+                    self.wal.remove_orphan_dir(directory, lock_fd)
+                    continue
+
+                success, failed_operations = await self._execute_bulk_write(batch_cache)
+                if len(failed_operations) == len(batch_cache):
+                    # 整批写库失败，保留日志留待下次启动回放
+                    logger.error(f"WAL replay of {directory} failed, keeping it for next start")
+                    self.wal.remove_orphan_dir(directory, lock_fd, delete=False)
+                    continue
+
+                # 部分失败的重新入队（会写入本进程的日志），之后即可删除遗留目录
+                for key, update_fields, _ in failed_operations:
+                    await self.add(key, update_fields)
+                self.wal.remove_orphan_dir(directory, lock_fd)
+                logger.info(f"Replayed WAL {directory}: {len(batch_cache)} keys")
+            except Exception as e:
+                logger.error(f"WAL replay of {directory} failed: {e}", exc_info=True)
+                self.wal.remove_orphan_dir(directory, lock_fd, delete=False)
+
+    def pending_count(self) -> int:
+        """待写库的数据条数（队列长度或累加器中的事件数）"""
+        if self.accumulator:
+            return self.accumulator.pending_events
+        return self.queue.qsize()
+
+    def _oldest_pending_at(self) -> Optional[float]:
+        """待写库数据中最早一条的加入时间（monotonic）"""
+        if self.accumulator:
+            return self.accumulator.oldest_added_at
+        return self._queue_oldest_at
+
+    def _batch_limits(self) -> Tuple[int, float]:
+        """当前的批大小和刷新期限（秒）"""
+        if self.controller:
+            return self.controller.batch_size, self.controller.flush_interval
+        return BATCH_SIZE, BATCH_INTERVAL
+
+    async def _put(self, item: tuple) -> bool:
+        """放入队列（累加器模式下直接合并），队列满时最多等待1秒"""
+        enqueued_at = time.monotonic()
+        try:
+            accepted = await self._put_item(item, enqueued_at)
+        finally:
+            self.histograms['enqueue_wait_seconds'].record(time.monotonic() - enqueued_at)
+        if accepted:
+            self._on_accepted(enqueued_at)
+        return accepted
+
+    def _on_accepted(self, enqueued_at: float):
+        """一条数据已放入队列或累加器"""
+        if not self.accumulator and self._queue_oldest_at is None:
+            self._queue_oldest_at = enqueued_at
+        if self.controller:
+            self.controller.record_arrivals()
+        # 唤醒等待新数据的工作器，或达到批大小时立即刷新
+        if self._worker_idle or self.pending_count() >= self._batch_limits()[0]:
+            self.flush_event.set()
+
+    async def _put_item(self, item: tuple, enqueued_at: float) -> bool:
+        if self.accumulator:
+            self.accumulator.add(*item)
+            return True
+        item = item + (enqueued_at,)
         # 队列满时的处理策略：等待而不是丢弃
         try:
             # 尝试非阻塞放入队列
-            self.queue.put_nowait((key, update_fields))
-            success = True
+            self.queue.put_nowait(item)
+            return True
         except asyncio.QueueFull:
             # 队列满时，改为阻塞等待（有超时）
             try:
                 await asyncio.wait_for(
-                    self.queue.put((key, update_fields)),
+                    self.queue.put(item),
                     timeout=1.0  # 等待1秒
                 )
-                success = True
+                return True
             except asyncio.TimeoutError:
                 # 超时后拒绝新数据并记录指标
-                logger.warning(f"Queue full, rejecting data after timeout: {key}")
+                logger.warning(f"Queue full, rejecting data after timeout: {item[0]}")
                 with self._metrics_lock:
                     self.metrics['rejects_due_to_full_queue'] += 1
-                success = False
+                return False
+        
+    async def add(self, key: Tuple[str, str, str], update_fields: Dict[str, Any]) -> bool:
+        """
+        添加数据到批处理队列
+        
+        Args:
+            key: (system, date, track_type) 三元组
+            update_fields: MongoDB更新操作
+            
+        Returns:
+            bool: 是否成功加入队列
+        """
+        # 先写预写日志，再放入队列
+        wal_record = self.wal.append([(key, update_fields)])[0] if self.wal else None
+        success = await self._put((key, update_fields, wal_record))
+        if self.wal and not success:
+            self.wal.release([wal_record])
         
         # 更新指标（线程安全）
         with self._metrics_lock:
-            self.metrics['queue_size'] = self.queue.qsize()
-        
-        # 如果队列达到批处理大小，立即触发处理
-        if success and self.queue.qsize() >= BATCH_SIZE:
-            self.flush_event.set()
+            self.metrics['queue_size'] = self.pending_count()
+
+        # 等待日志落盘后再确认
+        if self.wal and success:
+            await self.wal.wait_durable()
             
         return success
         
+    async def add_many(self, entries: List[Tuple[Tuple[str, str, str], Dict[str, Any]]]) -> List[tuple]:
+        """
+        一次性将多条已合并的更新加入批处理队列（用于批量上报接口）
+
+        Args:
+            entries: [(key, update_fields), ...] 列表
+
+        Returns:
+            List[tuple]: 未能加入队列的条目，由调用方降级处理
+        """
+        wal_records = self.wal.append(entries) if self.wal else [None] * len(entries)
+        rejected, rejected_records = [], []
+        for (key, update_fields), wal_record in zip(entries, wal_records):
+            if not await self._put((key, update_fields, wal_record)):
+                rejected.append((key, update_fields))
+                rejected_records.append(wal_record)
+        if self.wal and rejected:
+            self.wal.release(rejected_records)
+
+        with self._metrics_lock:
+            self.metrics['queue_size'] = self.pending_count()
+
+        if self.wal and len(rejected) < len(entries):
+            await self.wal.wait_durable()
+
+        return rejected
+
+    async def _accept_aggregated(self, entries: List[tuple]) -> List[tuple]:
+        """
+        leader接收follower发来的增量
+        应答不能依赖入队或写库的耗时：follower等待应答超时后会自行写库，leader再写入就会重复计数。
+        因此只做不等待的整体入队，队列空间不足时整体拒绝（不应答），由follower降级写库；
+        也不等待预写日志落盘（记录已写入日志缓冲区，在下一次分组提交前leader崩溃时可能丢失）
+        """
+        if not self.accumulator and 0 < self.queue.maxsize < self.queue.qsize() + len(entries):
+            with self._metrics_lock:
+                self.metrics['rejects_due_to_full_queue'] += len(entries)
+            return entries
+        wal_records = self.wal.append(entries) if self.wal else [None] * len(entries)
+        enqueued_at = time.monotonic()
+        for (key, update_fields), wal_record in zip(entries, wal_records):
+            if self.accumulator:
+                self.accumulator.add(key, update_fields, wal_record)
+            else:
+                self.queue.put_nowait((key, update_fields, wal_record, enqueued_at))
+            self._on_accepted(enqueued_at)
+        with self._metrics_lock:
+            self.metrics['queue_size'] = self.pending_count()
+        return []
+
     async def _batch_worker(self):
-        """批处理工作器主循环 - 优化版"""
-        last_flush_time = time.time()
-        
+        """
+        批处理工作器主循环（事件驱动）
+        没有待写数据时等待新数据唤醒；有数据后从最早一条加入起最多等待刷新期限，期间达到批大小时立即刷新
+        """
         while self.running:
             try:
-                current_time = time.time()
-                time_since_last_flush = current_time - last_flush_time
-                
-                # 等待触发条件：事件或超时
-                try:
-                    # 等待刷新事件或超时
-                    await asyncio.wait_for(
-                        self.flush_event.wait(),
-                        timeout=max(0.1, BATCH_INTERVAL - time_since_last_flush)
+                if self.pending_count() == 0:
+                    self._worker_idle = True
+                    self.flush_event.clear()
+                    try:
+                        await self.flush_event.wait()
+                    finally:
+                        self._worker_idle = False
+                    continue
+
+                batch_size, flush_interval = self._batch_limits()
+                oldest_pending_at = self._oldest_pending_at()
+                remaining = flush_interval - (time.monotonic() - oldest_pending_at) if oldest_pending_at else 0
+                if remaining > 0 and self.pending_count() < batch_size:
+                    # 等到期限或被唤醒（达到批大小或停止）后重新检查
+                    self.flush_event.clear()
+                    try:
+                        await asyncio.wait_for(self.flush_event.wait(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                start_time = time.time()
+                await self._flush_batch()
+                process_time = time.time() - start_time
+
+                # 记录处理时间指标
+                with self._metrics_lock:
+                    self.metrics['last_flush_time'] = datetime.utcnow().isoformat()
+                    self.metrics['avg_process_time'] = (
+                        (self.metrics['avg_process_time'] * self.metrics['total_batches'] +
+                         process_time) / (self.metrics['total_batches'] + 1)
                     )
-                    self.flush_event.clear()  # 清除事件
-                except asyncio.TimeoutError:
-                    pass  # 正常超时，继续检查处理条件
-                
-                # 检查处理条件
-                current_queue_size = self.queue.qsize()
-                should_flush = (
-                    (current_queue_size >= BATCH_SIZE) or
-                    (time.time() - last_flush_time >= BATCH_INTERVAL and current_queue_size > 0)
-                )
-                
-                if should_flush:
-                    start_time = time.time()
-                    await self._flush_batch()
-                    process_time = time.time() - start_time
-                    
-                    last_flush_time = time.time()
-                    
-                    # 记录处理时间指标
-                    with self._metrics_lock:
-                        self.metrics['last_flush_time'] = datetime.utcnow().isoformat()
-                        self.metrics['avg_process_time'] = (
-                            (self.metrics['avg_process_time'] * self.metrics['total_batches'] + 
-                             process_time) / (self.metrics['total_batches'] + 1)
-                        )
-                
-                # 动态调整等待时间：队列越满，检查越频繁
-                if current_queue_size < BATCH_SIZE / 2:
-                    await asyncio.sleep(0.5)  # 队列不饱满，减少检查频率
-                    
+
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 logger.error(f"Batch worker error: {e}", exc_info=True)
                 await asyncio.sleep(1)  # 出错后休眠1秒
-                
+
     async def _flush_batch(self, force: bool = False):
         """刷新当前批次到数据库 - 优化版"""
         # 快速检查是否需要处理
-        if self.queue.empty() and not force:
+        if self.pending_count() == 0 and not force:
             return
 
         start_time = time.time()
-        items_to_process = []
+        processed_count = 0
         try:
-            # 1. 从队列中取出待处理项
-            max_items = BATCH_SIZE * 2  # 每次最多处理两倍的批处理大小
-            
-            while len(items_to_process) < max_items:
-                try:
-                    item = self.queue.get_nowait()
-                    items_to_process.append(item)
-                except asyncio.QueueEmpty:
-                    break
-            
-            if not items_to_process:
+            if self.accumulator:
+                # 1-2. 累加器模式：add()时已合并，直接整体交换出来（只能记录最早一条的等待时间）
+                oldest_added_at = self.accumulator.oldest_added_at
+                merge_started = time.monotonic()
+                batch_cache, wal_records, processed_count = self.accumulator.swap()
+                if oldest_added_at is not None:
+                    self.histograms['queue_time_seconds'].record(merge_started - oldest_added_at)
+                self.histograms['merge_seconds'].record(time.monotonic() - merge_started)
+            else:
+                # 1. 从队列中取出待处理项
+                items_to_process = []
+                max_items = self._batch_limits()[0] * 2  # 每次最多处理两倍的批处理大小
+
+                while len(items_to_process) < max_items:
+                    try:
+                        item = self.queue.get_nowait()
+                        items_to_process.append(item)
+                    except asyncio.QueueEmpty:
+                        break
+                # 剩余数据的入队时间未知，从取出时开始计算期限（只在积压时剩余，积压时不等待期限）
+                self._queue_oldest_at = time.monotonic() if not self.queue.empty() else None
+
+                merge_started = time.monotonic()
+                queue_time = self.histograms['queue_time_seconds']
+                for item in items_to_process:
+                    queue_time.record(merge_started - item[3])
+
+                # 2. 合并更新操作（使用锁保护）
+                batch_cache = {}
+                wal_records = []
+                async with self._batch_lock:
+                    # 先处理队列中的新数据
+                    for key, update_fields, wal_record, _ in items_to_process:
+                        if key in batch_cache:
+                            batch_cache[key] = self._merge_update_fields(
+                                batch_cache[key], update_fields
+                            )
+                        else:
+                            batch_cache[key] = update_fields
+                        wal_records.append(wal_record)
+                self.histograms['merge_seconds'].record(time.monotonic() - merge_started)
+                processed_count = len(items_to_process)
+
+            if not processed_count:
                 return
-                
-            # 2. 合并更新操作（使用锁保护）
-            batch_cache = {}
-            async with self._batch_lock:
-                # 先处理队列中的新数据
-                for key, update_fields in items_to_process:
-                    if key in batch_cache:
-                        batch_cache[key] = self._merge_update_fields(
-                            batch_cache[key], update_fields
-                        )
-                    else:
-                        batch_cache[key] = update_fields
             
             # 3. 执行批量写入（不使用锁，避免阻塞）
             if batch_cache:
-                success, failed_operations = await self._execute_bulk_write(batch_cache)
+                if self.aggregator and not self.aggregator.is_leader and \
+                        await self.aggregator.send(list(batch_cache.items())):
+                    # 已交给leader统一写库
+                    failed_operations = []
+                else:
+                    success, failed_operations = await self._execute_bulk_write(batch_cache)
                 
                 # 4. 处理失败的操作
                 if failed_operations:
                     await self._handle_failed_operations(failed_operations)
+
+                # 已写库或已重新入队（重新写入日志），归还预写日志中的记录
+                if self.wal:
+                    self.wal.release(wal_records)
                 
                 # 5. 更新指标并检查是否需要重置
                 with self._metrics_lock:                    
@@ -224,22 +674,24 @@ class BatchProcessor:
                         self.metrics = {
                             'total_processed': 0,
                             'total_errors': 0,
-                            'queue_size': self.queue.qsize(),  # 保留当前队列大小
+                            'queue_size': self.pending_count(),  # 保留当前队列大小
                             'last_flush_time': self.metrics['last_flush_time'],  # 保留最后刷新时间
                             'avg_batch_size': 0.0,
                             'total_batches': 0,
                             'avg_process_time': 0.0,
                             'rejects_due_to_full_queue': 0,
                             'dropped_after_max_retries': 0,
+                            'hll_sketch_errors': self.metrics['hll_sketch_errors'],
+                            'user_dimension_errors': self.metrics['user_dimension_errors'],
                         }
-                    self.metrics['total_processed'] += len(items_to_process)
+                    self.metrics['total_processed'] += processed_count
                     self.metrics['total_batches'] += 1
                     current_avg = self.metrics['avg_batch_size']
                     new_count = self.metrics['total_batches']
                     self.metrics['avg_batch_size'] = (
                         (current_avg * (new_count - 1) + len(batch_cache)) / new_count
                     )
-                    self.metrics['queue_size'] = self.queue.qsize()
+                    self.metrics['queue_size'] = self.pending_count()
 
         except Exception as e:
             logger.error(f"Batch flush error: {e}", exc_info=True)
@@ -249,8 +701,12 @@ class BatchProcessor:
         finally:
             # 处理时间过长时记录警告
             process_time = time.time() - start_time
+            if processed_count:
+                self.histograms['flush_seconds'].record(process_time)
+                if self.controller:
+                    self.controller.observe_flush(processed_count, process_time, self.pending_count())
             if process_time > 1.0:
-                logger.warning(f"Batch {len(items_to_process)} records and flush took {process_time:.3f}s")
+                logger.warning(f"Batch {processed_count} records and flush took {process_time:.3f}s")
 
     async def _execute_bulk_write(self, batch_cache: Dict) -> tuple:
         """
@@ -269,9 +725,13 @@ class BatchProcessor:
 
         # 将batch_cache转换为有序列表以跟踪索引
         items = list(batch_cache.items())  # [(key1, fields1), (key2, fields2), ...]
+        if STATS_STORAGE != 'mongodb':
+            return await self._write_to_storage(items)
 
-        bulk_operations = []
-        valid_items = []  # 跟踪有效项目
+        # 按目标集合分组（按小时分桶的键写入小时集合）：{集合名: (集合, [UpdateOne], [原始索引])}
+        groups: Dict[str, Tuple[Any, List[UpdateOne], List[int]]] = {}
+        sketch_updates = {}  # HLL模式下拆出的唯一用户草图更新 {原始索引: {路径: 指纹集合}}
+        user_dimension_updates = {}  # 拆出的分桶用户维度更新 {原始索引: {(维度, 桶): {字段路径: 增量}}}
 
         for i, ((system, date, track_type), update_fields) in enumerate(items):
             try:
@@ -285,25 +745,42 @@ class BatchProcessor:
                     logger.warning(f"Skipping invalid update_fields for {system}: not a dict")
                     continue
 
-                filter_criteria = {
-                    'system': system,
-                    'date': date,
-                    'type': track_type
-                }
+                collection, filter_criteria = get_stats_target((system, date, track_type))
+
+                # 开启top-K的站点把未进入摘要的键改写为(other)，失败重试时使用改写后的更新
+                try:
+                    update_fields = await topk_limiter.apply((system, date, track_type), update_fields,
+                                                             (collection, filter_criteria))
+                    items[i] = ((system, date, track_type), update_fields)
+                except Exception as e:
+                    logger.error(f"Top-K remap failed for {system}, writing unchanged: {e}", exc_info=True)
+
+                # HLL模式下$addToSet改为在计数写入成功后合并草图
+                write_fields, sketch_values = split_unique_updates(update_fields)
+                # 按用户指纹的维度写入独立的分桶文档
+                write_fields, user_updates = split_user_dimension_updates(write_fields)
 
                 # 验证更新操作字段
                 validated_update = {}
-                for op_key, op_value in update_fields.items():
+                for op_key, op_value in write_fields.items():
                     if op_key.startswith('$') and isinstance(op_value, dict):
                         validated_update[op_key] = op_value
                     else:
                         logger.warning(f"Invalid MongoDB operation {op_key} in update_fields for {system}")
 
+                if sketch_values:
+                    sketch_updates[i] = sketch_values
+                if user_updates:
+                    user_dimension_updates[i] = user_updates
+
                 if not validated_update:
-                    logger.warning(f"No valid MongoDB operations found for {system}")
+                    if not sketch_values and not user_updates:
+                        logger.warning(f"No valid MongoDB operations found for {system}")
+                    # 只有草图或用户维度的更新（计数已写入后重试的部分）不写每日文档
                     continue
 
                 # 使用正确的UpdateOne对象
+                _, bulk_operations, valid_items = groups.setdefault(collection.name, (collection, [], []))
                 bulk_operations.append(
                     UpdateOne(
                         filter=filter_criteria,
@@ -317,20 +794,45 @@ class BatchProcessor:
                 logger.warning(f"Error processing item {i} for {system}: {e}")
                 continue
 
-        if not bulk_operations:
+        if not groups and not sketch_updates and not user_dimension_updates:
             logger.warning("No valid operations to execute in bulk write")
             return True, []
 
-        try:
-            start_time = time.time()
+        failed_item_indices = set()
+        for collection, bulk_operations, valid_items in groups.values():
+            failed_item_indices |= await self._bulk_write_to(collection, bulk_operations, valid_items)
 
-            result = await stats_collection.bulk_write(
-                bulk_operations,
-                ordered=False,
-                bypass_document_validation=False
-            )
+        # 计数写入成功的项目再合并草图和用户维度（失败的操作会整体重试）；
+        # 草图或用户维度写入失败时只重试失败的部分（重新入队并写入预写日志），计数不会重复
+        partial_retries = await self._apply_sketch_updates(items, sketch_updates, failed_item_indices)
+        partial_retries += await self._apply_user_dimension_updates(items, user_dimension_updates, failed_item_indices)
+        await self._apply_topk_folds(items, failed_item_indices)
+        if partial_retries:
+            await self._handle_failed_operations(partial_retries)
+        if failed_item_indices:
+            failed_operations = [(items[i][0], items[i][1], 0) for i in sorted(failed_item_indices)]
+            return False, failed_operations
+        return True, []
+
+    async def _bulk_write_to(self, collection, bulk_operations: List[UpdateOne], valid_items: List[int]) -> set:
+        """
+        对一个集合执行批量写入
 
-            duration = time.time() - start_time
+        Returns:
+            set: 写入失败的项目在batch_cache中的原始索引
+        """
+        try:
+            start_time = time.time()
+            self.histograms['bulk_write_ops'].record(len(bulk_operations))
+            try:
+                result = await collection.bulk_write(
+                    bulk_operations,
+                    ordered=False,
+                    bypass_document_validation=False
+                )
+            finally:
+                duration = time.time() - start_time
+                self.histograms['bulk_write_seconds'].record(duration)
 
             # 检查是否有写错误
             write_errors = []
@@ -343,33 +845,26 @@ class BatchProcessor:
             if write_errors:
                 logger.warning(f"Bulk write had {len(write_errors)} write errors")
 
-                # 收集失败的操作（添加retry_count=0）
-                failed_operations = []
+                # 收集失败的操作（确保索引有效且对应于有效项目）
                 failed_indices = {error.get('index') for error in write_errors if
                                   isinstance(error, dict) and 'index' in error}
+                failed_item_indices = {valid_items[idx] for idx in failed_indices
+                                       if isinstance(idx, int) and idx < len(valid_items)}
 
-                for idx in failed_indices:
-                    # 确保索引有效且对应于有效项目
-                    if idx is not None and isinstance(idx, int) and idx < len(valid_items):
-                        original_idx = valid_items[idx]  # 获取原始索引
-                        if original_idx < len(items):
-                            key, update_fields = items[original_idx]
-                            failed_operations.append((key, update_fields, 0))
-
-                success_count = len(bulk_operations) - len(failed_operations)
+                success_count = len(bulk_operations) - len(failed_item_indices)
                 logger.warning(
                     f"Batch write partial failures: "
-                    f"success={success_count}, failed={len(failed_operations)}"
+                    f"success={success_count}, failed={len(failed_item_indices)}"
                 )
-                return False, failed_operations
+                return failed_item_indices
 
             # 全部成功
             logger.debug(
-                f"Batch write: ops={len(bulk_operations)}, "
+                f"Batch write: collection={collection.name}, ops={len(bulk_operations)}, "
                 f"matched={getattr(result, 'matched_count', 'N/A')}, modified={getattr(result, 'modified_count', 'N/A')}, "
                 f"duration={duration:.3f}s"
             )
-            return True, []
+            return set()
 
         except Exception as e:
             logger.error(f"Bulk write failed: {type(e).__name__}: {e}", exc_info=True)
@@ -381,13 +876,105 @@ class BatchProcessor:
             if len(bulk_operations) > 3:
                 logger.error(f"... and {len(bulk_operations) - 3} more operations")
 
-            # 整个批量失败，所有操作都失败（添加retry_count=0）
-            failed_operations = []
-            for idx in valid_items:
-                if idx < len(items):
-                    key, update_fields = items[idx]
-                    failed_operations.append((key, update_fields, 0))
-            return False, failed_operations
+            # 整个批量失败，所有操作都失败
+            return set(valid_items)
+
+    async def _write_to_storage(self, items: List[tuple]) -> tuple:
+        """非MongoDB存储：整批交给存储后端（不支持HLL、分桶用户维度、按小时分桶和top-K）"""
+        start_time = time.time()
+        self.histograms['bulk_write_ops'].record(len(items))
+        try:
+            failed_item_indices = await stats_storage.apply_updates(items)
+        except Exception as e:
+            logger.error(f"Storage write failed: {type(e).__name__}: {e}", exc_info=True)
+            failed_item_indices = set(range(len(items)))
+        finally:
+            self.histograms['bulk_write_seconds'].record(time.time() - start_time)
+        if failed_item_indices:
+            logger.warning(f"Storage write partial failures: success={len(items) - len(failed_item_indices)}, "
+                           f"failed={len(failed_item_indices)}")
+            return False, [(items[i][0], items[i][1], 0) for i in sorted(failed_item_indices)]
+        return True, []
+
+    async def _apply_sketch_updates(self, items: List[tuple], sketch_updates: Dict[int, Dict[str, set]],
+                                    failed_indices: set = frozenset()) -> List[tuple]:
+        """
+        计数写入成功后合并对应的HLL草图（失败的操作会整体重试，这里跳过）
+
+        Returns:
+            List[tuple]: 草图写入失败的项目只含$addToSet的重试操作 [(key, update_fields, retry_count), ...]
+        """
+        retries = []
+        for i, sketch_values in sketch_updates.items():
+            if i in failed_indices:
+                continue
+            try:
+                if await apply_hll_updates(items[i][0], sketch_values):
+                    continue
+            except Exception as e:
+                logger.error(f"HLL sketch update failed for {items[i][0]}: {e}", exc_info=True)
+            with self._metrics_lock:
+                self.metrics['hll_sketch_errors'] += 1
+            retries.append((items[i][0], {'$addToSet': items[i][1]['$addToSet']}, 0))
+        return retries
+
+    async def _apply_user_dimension_updates(self, items: List[tuple],
+                                            user_dimension_updates: Dict[int, Dict[Tuple[str, int], Dict[str, int]]],
+                                            failed_indices: set = frozenset()) -> List[tuple]:
+        """
+        计数写入成功后写入对应的分桶用户维度（失败的操作会整体重试，这里跳过）
+
+        Returns:
+            List[tuple]: 写入失败的分桶还原为每日文档字段的重试操作 [(key, {'$inc': ...}, retry_count), ...]
+        """
+        operations, origins = [], []  # origins与operations一一对应：(原始索引, 维度, 字段)
+        for i, user_updates in user_dimension_updates.items():
+            if i in failed_indices:
+                continue
+            key = items[i][0]
+            for (dimension, bucket), fields in user_updates.items():
+                operations.extend(build_user_dimension_operations(key, {(dimension, bucket): fields}))
+                origins.append((i, dimension, fields))
+        if not operations:
+            return []
+        try:
+            await user_stats_collection.bulk_write(operations, ordered=False)
+            return []
+        except Exception as e:
+            logger.error(f"User dimension bulk write failed: {e}", exc_info=True)
+            details = getattr(e, 'details', None)
+            if isinstance(details, dict) and details.get('writeErrors'):
+                failed = sorted({error['index'] for error in details['writeErrors']})
+            else:
+                failed = range(len(operations))
+        with self._metrics_lock:
+            self.metrics['user_dimension_errors'] += 1
+
+        # 只重试失败的分桶，已写入的分桶不会重复计数
+        retry_fields: Dict[int, Dict[str, int]] = {}
+        for index in failed:
+            i, dimension, fields = origins[index]
+            counters = retry_fields.setdefault(i, {})
+            for path, value in fields.items():
+                counters[f'data.{dimension}.{path[len("data."):]}'] = value
+        return [(items[i][0], {'$inc': counters}, 0) for i, counters in retry_fields.items()]
+
+    async def _apply_topk_folds(self, items: List[tuple], failed_indices: set = frozenset()):
+        """计数写入成功后把被淘汰的键折叠进(other)（冲突或失败时留到下次刷新）"""
+        for i, (key, _) in enumerate(items):
+            if i not in failed_indices:
+                await topk_limiter.fold_pending(key, get_stats_target(key))
+
+    async def _retry_backoff(self, delay: float):
+        """重试前的退避等待；停止时不超过停止期限，期限已过时不再等待"""
+        if self._stop_deadline is None:
+            try:
+                await asyncio.wait_for(self._stop_requested.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                return
+        remaining = min(delay, self._stop_deadline - time.monotonic())
+        if remaining > 0:
+            await asyncio.sleep(remaining)
 
     async def _retry_operation(self, key: Tuple, update_fields: Dict, current_retry_count: int = 0) -> bool:
         """重试失败的操作"""
@@ -396,7 +983,7 @@ class BatchProcessor:
 
         # 指数退避
         delay = min(BATCH_RETRY_BASE_DELAY * (2 ** current_retry_count), 30)
-        await asyncio.sleep(delay)
+        await self._retry_backoff(delay)
 
         try:
             # 重新放入队列
@@ -438,9 +1025,22 @@ class BatchProcessor:
             Dict[str, Any]: 包含所有批处理统计指标的字典
         """
         with self._metrics_lock:
-            return self.metrics.copy()  # 返回副本以避免外部修改
+            metrics = self.metrics.copy()  # 返回副本以避免外部修改
+        if self.aggregator:
+            metrics['aggregator'] = self.aggregator.get_metrics()
+        if self.wal:
+            metrics['wal'] = self.wal.get_metrics()
+        if self.controller:
+            metrics['adaptive'] = self.controller.get_metrics()
+        metrics['histograms'] = self.get_histograms()
+        return metrics
+
+    def get_histograms(self) -> Dict[str, Dict[str, Any]]:
+        """各直方图的快照（累计值，不重置）"""
+        return {name: histogram.snapshot() for name, histogram in self.histograms.items()}
 
-    def _merge_update_fields(self, existing: Dict, new: Dict) -> Dict:
+    @staticmethod
+    def _merge_update_fields(existing: Dict, new: Dict) -> Dict:
         """
         合并两个MongoDB更新字段字典（优化版）
 
@@ -470,28 +1070,30 @@ class BatchProcessor:
                 result['$addToSet'] = {}
             for key, value in new['$addToSet'].items():
                 if key in result['$addToSet']:
-                    # 处理$each的情况
+                    # 统一转换为$each形式后合并去重，避免丢失不同的简单值
+                    existing_value = result['$addToSet'][key]
+                    if isinstance(existing_value, dict) and '$each' in existing_value:
+                        merged_values = set(existing_value['$each'])
+                    else:
+                        merged_values = {existing_value}
                     if isinstance(value, dict) and '$each' in value:
-                        if isinstance(result['$addToSet'][key], dict) and '$each' in result['$addToSet'][key]:
-                            # 合并两个$each数组，去重
-                            existing_values = set(result['$addToSet'][key]['$each'])
-                            new_values = set(value['$each'])
-                            merged_values = list(existing_values.union(new_values))
-                            result['$addToSet'][key]['$each'] = merged_values
-                        else:
-                            # 现有值不是$each，保留现有值并添加新值
-                            existing_value = result['$addToSet'][key]
-                            new_values = set(value['$each'])
-                            new_values.add(existing_value)
-                            result['$addToSet'][key] = {
-                                '$each': list(new_values)
-                            }
+                        merged_values.update(value['$each'])
+                    else:
+                        merged_values.add(value)
+                    if len(merged_values) == 1:
+                        result['$addToSet'][key] = merged_values.pop()
                     else:
-                        # 简单值处理
-                        pass  # $addToSet本身就会处理唯一性，不需要额外操作
+                        result['$addToSet'][key] = {'$each': list(merged_values)}
                 else:
                     result['$addToSet'][key] = value
 
+        # 合并$max操作（top-K误差上界）
+        if '$max' in new:
+            if '$max' not in result:
+                result['$max'] = {}
+            for key, value in new['$max'].items():
+                result['$max'][key] = max(result['$max'].get(key, value), value)
+
         # 合并其他MongoDB操作符（如$push, $pull等）
         for operator in ['$push', '$pull', '$pullAll']:
             if operator in new:
@@ -526,14 +1128,24 @@ class BatchProcessor:
         # 添加实时信息
         metrics_copy['is_running'] = self.running
         metrics_copy['current_time'] = datetime.utcnow().isoformat()
-        metrics_copy['queue_size'] = self.queue.qsize()  # 实时队列大小
+        metrics_copy['queue_size'] = self.pending_count()  # 实时队列大小
+        if self.accumulator:
+            metrics_copy['accumulator_keys'] = self.accumulator.key_count
+        if self.aggregator:
+            metrics_copy['aggregator'] = self.aggregator.get_metrics()
+        if self.wal:
+            metrics_copy['wal'] = self.wal.get_metrics()
+        if self.controller:
+            metrics_copy['adaptive'] = self.controller.get_metrics()
+        metrics_copy['top_k'] = topk_limiter.get_metrics()
+        metrics_copy['histograms'] = self.get_histograms()
         
         return metrics_copy
     
     async def wait_for_empty_queue(self, timeout: float = 30.0):
         """等待队列为空（用于优雅关闭）"""
         start_time = time.time()
-        while self.running and not self.queue.empty():
+        while self.running and self.pending_count() > 0:
             if time.time() - start_time > timeout:
                 logger.warning(f"Timeout waiting for empty queue")
                 break
@@ -0,0 +1,5 @@
+"""
+性能基准（不属于应用本身，在仓库根目录下以模块方式运行）：
+- benchmarks.e2e：进程内通过ASGI客户端驱动整个应用的上报/查询压测
+- benchmarks.micro：热点纯函数的微基准，与baseline.json比较检查回归
+"""
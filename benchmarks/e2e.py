@@ -0,0 +1,397 @@
+"""
+端到端上报与查询压测
+在进程内通过ASGI客户端驱动FastAPI应用（包括生命周期中启动的批处理器等后台任务，不经过网络），
+用可配置基数的合成数据上报pageview/event/download/duration，然后按不同的日期范围查询统计。
+
+输出：
+- 上报吞吐（请求返回的速率，以及包括批处理器写完所有数据的速率）和请求延迟p50/p95/p99
+- 合并率：每个UpdateOne平均包含的事件数（批处理器bulk_write的操作总数）
+- 批处理器的刷新和bulk_write延迟分位数
+- 各统计类型的查询延迟随日期范围增长的变化（每次查询前清除5秒的结果缓存）
+
+用法（在仓库根目录下）：
+    python -m benchmarks.e2e --fake --events 20000 --concurrency 32
+    python -m benchmarks.e2e --mongo-uri mongodb://localhost:27017/ --database page_monitor_bench
+    python -m benchmarks.e2e --fake --env BATCH_ACCUMULATOR_MODE=true --json result.json
+
+--env 在导入应用之前设置环境变量，用于对比不同的开关。
+使用真实mongod时写入单独的数据库（默认page_monitor_bench，结束后删除，--keep保留），不允许使用应用的数据库。
+--fake 不需要mongod：统计写入内存中的SQLite（STATS_STORAGE=sqlite，不支持依赖MongoDB的开关），
+网站注册在进程内的网站校验缓存中，查询以内置的超级用户登录。
+需要安装httpx。
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import random
+import secrets
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 上报类型：(上报接口, 统计类型, 查询接口)
+TRACK_TYPES = {
+    'pageview': ('/api/track/pageview', 'pageViews', '/api/stats/pageview'),
+    'download': ('/api/track/download', 'downloads', '/api/stats/downloads'),
+    'event': ('/api/track/event', 'events', '/api/stats/events'),
+    'duration': ('/api/track/duration', 'duration', '/api/stats/duration'),
+}
+APP_DATABASE = 'page_monitor'
+SITE_URL = 'https://bench.example.com'
+BROWSERS = ('Chrome', 'Firefox', 'Safari', 'Edge', 'Opera')
+OPERATING_SYSTEMS = ('Windows', 'macOS', 'Linux', 'Android', 'iOS')
+DEVICES = ('desktop', 'mobile', 'tablet')
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """最近秩分位数（values已排序）"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(len(values) * q + 0.5) - 1))]
+
+
+def latency_summary(values: List[float]) -> Dict[str, Any]:
+    values = sorted(values)
+    summary = {'count': len(values)}
+    for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1.0)):
+        value = percentile(values, q)
+        summary[f'{name}_ms'] = round(value * 1000, 3) if value is not None else None
+    return summary
+
+
+class PayloadGenerator:
+    """按配置的基数生成上报数据（URL、用户指纹、IP前缀等取值按Zipf式分布，少数键占大部分流量）"""
+
+    def __init__(self, args: argparse.Namespace):
+        self._random = random.Random(args.seed)
+        self._args = args
+        self.types = args.types
+
+    def _pick(self, cardinality: int) -> int:
+        # 平方分布：小编号的键更常见，接近真实站点的长尾
+        return int(cardinality * self._random.random() ** 2)
+
+    def ip(self) -> str:
+        prefix = self._pick(self._args.ip_prefixes)
+        return f"10.{prefix // 256}.{prefix % 256}.{self._random.randrange(1, 255)}"
+
+    def payload(self, track_type: str) -> Dict[str, Any]:
+        args = self._args
+        url = f"{SITE_URL}/page/{self._pick(args.urls)}"
+        data = {
+            'system': args.system,
+            'url': url,
+            'userFingerprint': f"user-{self._pick(args.users)}",
+            'browser': self._random.choice(BROWSERS),
+            'os': self._random.choice(OPERATING_SYSTEMS),
+            'device': self._random.choice(DEVICES),
+        }
+        if track_type == 'pageview':
+            data['referrer'] = f"https://ref{self._pick(args.referrers)}.example.org/"
+        elif track_type == 'download':
+            file_id = self._pick(args.files)
+            data.update(downloadUrl=f"{SITE_URL}/files/{file_id}.pdf", fileName=f"{file_id}.pdf", sourcePage=url)
+        elif track_type == 'event':
+            data.update(eventType='click', eventCategory=f"category-{self._pick(args.categories)}",
+                        eventAction=f"action-{self._pick(args.actions)}", eventLabel=f"label-{self._pick(args.urls)}",
+                        selector=f"#button-{self._pick(args.actions)}")
+        else:
+            data['duration'] = self._random.randint(1, 600)
+        return data
+
+    def next(self) -> Tuple[str, Dict[str, Any]]:
+        track_type = self._random.choice(self.types)
+        return track_type, self.payload(track_type)
+
+
+def bind_database(client, database: str):
+    """把mongodb模块中的集合换成指定数据库中的同名集合（必须在导入应用的其他模块之前调用）"""
+    import mongodb
+    from motor.motor_asyncio import AsyncIOMotorCollection
+
+    db = client[database]
+    for name, value in list(vars(mongodb).items()):
+        if isinstance(value, AsyncIOMotorCollection):
+            setattr(mongodb, name, db[value.name])
+    mongodb.client, mongodb.db = client, db
+
+
+async def setup_site(client, args: argparse.Namespace) -> str:
+    """注册用户、登录并创建网站，返回API密钥"""
+    password = 'bench-password'
+    response = await client.post('/register', json={'username': args.user, 'full_name': 'benchmark', 'password': password,
+                                                    'phone': '', 'email': f'{args.user}@bench.example.com'})
+    if response.status_code not in (200, 400):  # 400：用户已存在（--keep保留的数据库）
+        raise RuntimeError(f"register failed: {response.status_code} {response.text}")
+    response = await client.post('/login', data={'username': args.user, 'password': password})
+    response.raise_for_status()
+    response = await client.post('/sites', json={'site_name': args.system, 'site_url': SITE_URL})
+    if response.status_code == 200:
+        return response.json()['api_key']
+    # 网站已存在（--keep保留的数据库）时使用已有的API密钥
+    sites = await client.get('/sites')
+    sites.raise_for_status()
+    for site in sites.json():
+        if site.get('site_name') == args.system:
+            return site['api_key']
+    raise RuntimeError(f"create site failed: {response.status_code} {response.text}")
+
+
+def setup_fake_site(client, args: argparse.Namespace) -> str:
+    """--fake：注册/登录/网站接口使用MongoDB，改为在进程内注册网站并以内置的超级用户登录，返回API密钥"""
+    from security import InMemoryUserService, create_access_token, set_user_service
+    from track import _site_cache, sanitize_key
+
+    set_user_service(InMemoryUserService())
+    client.cookies.set('access_token', create_access_token(data={'sub': 'admin'}))
+    api_key = secrets.token_hex(16)
+    _site_cache.set((sanitize_key(args.system), api_key), {'site_name': args.system, 'site_url': SITE_URL},
+                    ttl=float('inf'))
+    return api_key
+
+
+async def _skip_init_db():
+    """--fake不连接mongod，不创建索引"""
+
+
+async def seed_history(generator: PayloadGenerator, args: argparse.Namespace, today: datetime):
+    """写入今天之前history_days天的每日文档（直接调用上报的处理函数和批处理器的写库逻辑，不经过接口）"""
+    from batch import BatchProcessor
+    from dimension_dict import STATS_DIMENSION_DICTIONARY, dimension_dictionary
+    from track import TRACK_TYPE_HANDLERS, get_batch_processor, sanitize_fingerprint, sanitize_key
+
+    processor = get_batch_processor() or BatchProcessor()
+    for offset in range(args.history_days, 0, -1):
+        date = (today - timedelta(days=offset)).strftime('%Y-%m-%d')
+        batch_cache = {}
+        for _ in range(args.seed_events_per_day):
+            track_type, data = generator.next()
+            stats_type, handler = TRACK_TYPE_HANDLERS[track_type]
+            ip_prefix = '.'.join(generator.ip().split('.')[:2])
+            if STATS_DIMENSION_DICTIONARY:
+                [data], ip_key = dimension_dictionary.encode_items(args.system, [(stats_type, data)], ip_prefix)
+                ip_prefix = ip_key or sanitize_key(ip_prefix)
+            else:
+                ip_prefix = sanitize_key(ip_prefix)
+            update_fields = handler(data, stats_type, args.system, sanitize_fingerprint(data['userFingerprint']),
+                                    '', ip_prefix, date)
+            key = (args.system, date, stats_type)
+            batch_cache[key] = (BatchProcessor._merge_update_fields(batch_cache[key], update_fields)
+                                if key in batch_cache else update_fields)
+        _, failed = await processor._execute_bulk_write(batch_cache)
+        if failed:
+            raise RuntimeError(f"seeding {date} failed for {len(failed)} keys")
+
+
+async def run_ingest(client, generator: PayloadGenerator, args: argparse.Namespace, api_key: str) -> Dict[str, Any]:
+    """并发上报args.events条记录，返回吞吐、延迟和合并率"""
+    from track import get_batch_processor
+
+    processor = get_batch_processor()
+    ops_before = processor.get_histograms()['bulk_write_ops']['sum'] if processor else 0
+    headers = {'X-API-Key': api_key, 'Origin': SITE_URL}
+    per_request = max(1, args.batch_items)
+    requests_total = (args.events + per_request - 1) // per_request
+    latencies, errors = [], {}
+    counter = iter(range(requests_total))
+
+    async def worker():
+        for _ in counter:
+            if args.batch_items > 0:
+                items = []
+                for _ in range(per_request):
+                    track_type, data = generator.next()
+                    items.append(dict(data, type=track_type))
+                path, body = '/api/track/batch', {'system': args.system, 'items': items}
+            else:
+                track_type, body = generator.next()
+                path = TRACK_TYPES[track_type][0]
+            request_headers = dict(headers, **{'X-Forwarded-For': generator.ip()})
+            started = time.perf_counter()
+            response = await client.post(path, json=body, headers=request_headers)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors[response.status_code] = errors.get(response.status_code, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    accepted_seconds = time.perf_counter() - started
+    if processor:
+        # 停止时等待进行中的刷新并写完剩余数据，再重新启动供查询阶段使用
+        await processor.stop()
+        drained_seconds = time.perf_counter() - started
+        histograms = processor.get_histograms()
+        await processor.start()
+    else:
+        drained_seconds, histograms = accepted_seconds, {}
+
+    events = requests_total * per_request
+    result = {
+        'events': events,
+        'requests': requests_total,
+        'errors': errors,
+        'seconds': round(accepted_seconds, 3),
+        'events_per_second': round(events / accepted_seconds, 1),
+        'drained_seconds': round(drained_seconds, 3),
+        'drained_events_per_second': round(events / drained_seconds, 1),
+        'latency': latency_summary(latencies),
+    }
+    if histograms:
+        operations = histograms['bulk_write_ops']['sum'] - ops_before
+        result['update_operations'] = int(operations)
+        result['events_per_update'] = round(events / operations, 2) if operations else None
+        result['batch'] = {name: {key: histograms[name][key] for key in ('count', 'p50', 'p99', 'max')}
+                           for name in ('queue_time_seconds', 'flush_seconds', 'bulk_write_seconds', 'bulk_write_ops')}
+    return result
+
+
+async def run_queries(client, args: argparse.Namespace, today: datetime) -> List[Dict[str, Any]]:
+    """按日期范围查询各类型统计，每次查询前清除结果缓存"""
+    from track import _stats_common
+
+    results = []
+    for days in args.ranges:
+        start_date = (today - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        end_date = today.strftime('%Y-%m-%d')
+        for track_type in args.types:
+            path = TRACK_TYPES[track_type][2]
+            latencies, errors = [], 0
+            for _ in range(args.query_repeats):
+                _stats_common.cache_clear()
+                started = time.perf_counter()
+                response = await client.get(path, params={'system': args.system, 'start_date': start_date,
+                                                          'end_date': end_date, 'limit': args.limit})
+                latencies.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    errors += 1
+            results.append(dict(latency_summary(latencies), type=track_type, days=days, errors=errors))
+    return results
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    import httpx
+
+    import mongodb
+    if args.fake:
+        mongodb.init_db = _skip_init_db
+    else:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        bind_database(AsyncIOMotorClient(args.mongo_uri), args.database)
+
+    from app import app
+
+    generator = PayloadGenerator(args)
+    today = datetime.utcnow()
+    result: Dict[str, Any] = {'config': {key: value for key, value in vars(args).items() if key != 'json'}}
+    try:
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app, client=('127.0.0.1', 50000))
+            async with httpx.AsyncClient(transport=transport, base_url='http://bench.local') as client:
+                api_key = setup_fake_site(client, args) if args.fake else await setup_site(client, args)
+                seed_started = time.perf_counter()
+                await seed_history(generator, args, today)
+                result['seed_seconds'] = round(time.perf_counter() - seed_started, 3)
+                logger.info(f"已写入{args.history_days}天的历史数据，开始上报")
+                result['ingest'] = await run_ingest(client, generator, args, api_key)
+                logger.info("上报完成，开始查询")
+                result['queries'] = await run_queries(client, args, today)
+    finally:
+        if not args.fake and not args.keep:
+            await mongodb.client.drop_database(args.database)
+    return result
+
+
+def print_report(result: Dict[str, Any]):
+    ingest = result['ingest']
+    print(f"ingest: {ingest['events']} events in {ingest['requests']} requests, errors={ingest['errors'] or 0}")
+    print(f"  accepted {ingest['events_per_second']}/s ({ingest['seconds']}s), "
+          f"durable {ingest['drained_events_per_second']}/s ({ingest['drained_seconds']}s)")
+    latency = ingest['latency']
+    print(f"  latency p50={latency['p50_ms']}ms p95={latency['p95_ms']}ms p99={latency['p99_ms']}ms "
+          f"max={latency['max_ms']}ms")
+    if 'events_per_update' in ingest:
+        print(f"  {ingest['update_operations']} UpdateOne, {ingest['events_per_update']} events per UpdateOne")
+        for name, values in ingest['batch'].items():
+            print(f"  {name}: " + ' '.join(f"{key}={value}" for key, value in values.items()))
+    print(f"queries (seeded {result['config']['history_days']} days in {result['seed_seconds']}s):")
+    print(f"  {'type':<10}{'days':>6}{'p50_ms':>12}{'p95_ms':>12}{'p99_ms':>12}{'max_ms':>12}{'errors':>8}")
+    for query in result['queries']:
+        print(f"  {query['type']:<10}{query['days']:>6}{query['p50_ms']:>12}{query['p95_ms']:>12}"
+              f"{query['p99_ms']:>12}{query['max_ms']:>12}{query['errors']:>8}")
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端上报与查询压测")
+    target = parser.add_argument_group('数据库')
+    target.add_argument('--fake', action='store_true', help="不使用mongod，统计写入内存中的SQLite")
+    target.add_argument('--mongo-uri', default=os.getenv("MONGO_DB_CONN_STR", "mongodb://localhost:27017/"))
+    target.add_argument('--database', default='page_monitor_bench', help="压测使用的数据库")
+    target.add_argument('--keep', action='store_true', help="结束后保留压测数据库")
+    target.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help="导入应用前设置的环境变量，可重复")
+
+    load = parser.add_argument_group('负载')
+    load.add_argument('--events', type=int, default=10000, help="上报的记录数")
+    load.add_argument('--concurrency', type=int, default=32, help="并发请求数")
+    load.add_argument('--batch-items', type=int, default=0, help="大于0时使用批量上报接口，每个请求包含的记录数")
+    load.add_argument('--types', default=','.join(TRACK_TYPES), help="上报和查询的类型，逗号分隔")
+    load.add_argument('--system', default='bench-site')
+    load.add_argument('--user', default='bench-user')
+    load.add_argument('--seed', type=int, default=1, help="随机数种子")
+
+    cardinality = parser.add_argument_group('基数')
+    cardinality.add_argument('--urls', type=int, default=500)
+    cardinality.add_argument('--users', type=int, default=5000)
+    cardinality.add_argument('--ip-prefixes', type=int, default=200)
+    cardinality.add_argument('--referrers', type=int, default=50)
+    cardinality.add_argument('--files', type=int, default=100)
+    cardinality.add_argument('--categories', type=int, default=20)
+    cardinality.add_argument('--actions', type=int, default=10)
+
+    query = parser.add_argument_group('查询')
+    query.add_argument('--history-days', type=int, default=90, help="预先写入的历史天数")
+    query.add_argument('--seed-events-per-day', type=int, default=2000, help="每天写入的历史记录数")
+    query.add_argument('--ranges', type=_int_list, default=[1, 7, 30, 90], help="查询的天数，逗号分隔")
+    query.add_argument('--query-repeats', type=int, default=5, help="每个范围和类型的查询次数")
+    query.add_argument('--limit', type=int, default=10)
+
+    parser.add_argument('--json', help="结果另存为JSON文件")
+    args = parser.parse_args()
+
+    args.types = [item.strip() for item in args.types.split(',') if item.strip()]
+    unknown = [item for item in args.types if item not in TRACK_TYPES]
+    if unknown:
+        parser.error(f"unsupported types: {', '.join(unknown)}")
+    if not args.fake and args.database == APP_DATABASE:
+        parser.error(f"refusing to benchmark against the application database '{APP_DATABASE}'")
+    for item in args.env:
+        key, sep, value = item.partition('=')
+        if not sep:
+            parser.error(f"--env expects KEY=VALUE, got {item!r}")
+        os.environ[key] = value
+    if args.fake:
+        if os.environ.setdefault('STATS_STORAGE', 'sqlite') != 'sqlite':
+            parser.error("--fake requires STATS_STORAGE=sqlite")
+        os.environ.setdefault('STATS_SQLITE_PATH', ':memory:')
+    if importlib.util.find_spec('httpx') is None:
+        parser.error("httpx is required: pip install httpx")
+
+    logging.basicConfig(level=logging.INFO)
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+"""
+热点纯函数的微基准与回归检查
+每次上报或查询都会执行的辅助函数（sanitize_key、restore_all_keys_recursive、FlatStatsMerger、get_top_entries、
+BatchProcessor._merge_update_fields和各类型的update构建函数），使用接近真实规模的数据
+（一天1万个URL、5万个用户指纹）计时，与保存的基线比较，超过阈值时退出码为1。
+
+用法（在仓库根目录下）：
+    python -m benchmarks.micro                      # 与基线比较
+    python -m benchmarks.micro --save               # 保存（覆盖）基线
+    python -m benchmarks.micro -k merge -k handler  # 只运行名称包含merge或handler的基准
+    python -m benchmarks.micro --threshold 0.4
+
+显示的耗时为多轮中最快一轮的单次耗时。为了减少不同机器和机器负载变化带来的差异，比较的是与固定校准负载
+交替计时得到的耗时比（各轮的中位数）；更换Python版本后应重新保存基线。
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+from typing import Any, Callable, Dict, List, Tuple
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+URLS = 10000
+FINGERPRINTS = 50000
+IP_PREFIXES = 300
+REFERRERS = 500
+MERGE_DAYS = 7
+QUEUE_ITEMS = 100  # 一次刷新中同一个键的更新数（BATCH_SIZE * 2）
+
+# {名称: 返回无参计时函数的准备函数}
+BENCHMARKS: Dict[str, Callable[[], Callable[[], Any]]] = {}
+
+
+def benchmark(name: str):
+    def register(setup: Callable[[], Callable[[], Any]]):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+class Fixtures:
+    """按需生成并缓存固定随机种子的数据"""
+
+    def __init__(self, seed: int = 42):
+        self._random = random.Random(seed)
+        self._cache: Dict[str, Any] = {}
+
+    def get(self, name: str):
+        if name not in self._cache:
+            self._cache[name] = getattr(self, f'_build_{name}')()
+        return self._cache[name]
+
+    def _build_raw_urls(self) -> List[str]:
+        return [f"https://www.example.com/docs/section-{i % 50}/page-{i}.html?ref=home" for i in range(URLS)]
+
+    def _build_fingerprints(self) -> List[str]:
+        return [hashlib.md5(str(i).encode()).hexdigest() for i in range(FINGERPRINTS)]
+
+    def _build_urls(self) -> List[str]:
+        from track import sanitize_key
+        return [sanitize_key(url) for url in self.get('raw_urls')]
+
+    def _count(self, rank: int) -> int:
+        # 长尾分布：排名靠前的键计数大
+        return max(1, int(5000 / (rank + 1))) + self._random.randint(0, 3)
+
+    def _build_pageview_day(self) -> Dict[str, Any]:
+        """一天的pageViews文档data（已转义的键）"""
+        from track import sanitize_key
+        urls, fingerprints = self.get('urls'), self.get('fingerprints')
+        browsers = ['Chrome', 'Firefox', 'Safari', 'Edge', 'Opera']
+        systems = ['Windows', 'macOS', 'Linux', 'Android', 'iOS']
+        ip_prefixes = [sanitize_key(f"10.{i}") for i in range(IP_PREFIXES)]
+        referrers = [sanitize_key(f"https://ref{i}.example.org/") for i in range(REFERRERS)]
+        data: Dict[str, Any] = {
+            'total': 0,
+            'byUrl': {}, 'byBrowser': {}, 'byOS': {}, 'byDevice': {'desktop': 0, 'mobile': 0, 'tablet': 0},
+            'byIPPrefix': {}, 'byUrlAndIPPrefix': {}, 'byUrlAndBrowser': {}, 'byUrlAndDevice': {},
+            'byBrowserAndOS': {}, 'byReferrer': {}, 'byUrlAndReferrer': {},
+            'uniqueUsers': list(fingerprints),
+            'byUrlUniqueUsers': {}, 'byIPPrefixUniqueUsers': {}, 'byBrowserAndOsUniqueUsers': {},
+        }
+        for rank, url in enumerate(urls):
+            count = self._count(rank)
+            data['total'] += count
+            data['byUrl'][url] = count
+            browser, device = browsers[rank % 5], ('desktop', 'mobile', 'tablet')[rank % 3]
+            data['byUrlAndBrowser'][url] = {browser: count}
+            data['byUrlAndDevice'][url] = {device: count}
+            data['byUrlAndIPPrefix'][url] = {ip_prefixes[(rank + j) % IP_PREFIXES]: max(1, count // 3) for j in range(3)}
+            data['byUrlAndReferrer'][url] = {referrers[rank % REFERRERS]: count}
+            data['byUrlUniqueUsers'][url] = [fingerprints[(rank * 5 + j) % FINGERPRINTS] for j in range(5)]
+        for i, browser in enumerate(browsers):
+            data['byBrowser'][browser] = data['total'] // 5
+            data['byBrowserAndOS'][browser] = {os_name: data['total'] // 25 for os_name in systems}
+            data['byBrowserAndOsUniqueUsers'][browser] = {os_name: fingerprints[i * 5000 + j * 1000:i * 5000 + j * 1000 + 1000]
+                                                          for j, os_name in enumerate(systems)}
+        for os_name in systems:
+            data['byOS'][os_name] = data['total'] // 5
+        for rank, prefix in enumerate(ip_prefixes):
+            data['byIPPrefix'][prefix] = self._count(rank)
+            data['byIPPrefixUniqueUsers'][prefix] = fingerprints[rank * 100:rank * 100 + 100]
+        for rank, referrer in enumerate(referrers):
+            data['byReferrer'][referrer] = self._count(rank)
+        for device in data['byDevice']:
+            data['byDevice'][device] = data['total'] // 3
+        return data
+
+    def _build_pageview_days(self) -> List[Dict[str, Any]]:
+        """MERGE_DAYS天的摘要维度（计数各不相同）"""
+        day = self.get('pageview_day')
+        days = []
+        for offset in range(MERGE_DAYS):
+            days.append({
+                'byUrl': {url: count + offset for url, count in day['byUrl'].items()},
+                'byUrlAndBrowser': {url: {browser: count + offset for browser, count in value.items()}
+                                    for url, value in day['byUrlAndBrowser'].items()},
+                'byUrlAndIPPrefix': {url: {prefix: count + offset for prefix, count in value.items()}
+                                     for url, value in day['byUrlAndIPPrefix'].items()},
+            })
+        return days
+
+    def _build_track_payloads(self) -> Dict[str, Dict[str, Any]]:
+        raw_urls = self.get('raw_urls')
+        base = {'url': raw_urls[17], 'browser': 'Chrome', 'os': 'Windows', 'device': 'desktop'}
+        return {
+            'pageview': dict(base, referrer='https://www.google.com/search?q=example'),
+            'download': dict(base, downloadUrl='https://www.example.com/files/report-2026.pdf',
+                             fileName='report-2026.pdf', sourcePage=raw_urls[17]),
+            'event': dict(base, eventType='click', eventCategory='engagement', eventAction='subscribe',
+                          eventLabel='footer.newsletter', selector='#subscribe-button'),
+            'duration': dict(base, duration=42),
+        }
+
+    def _build_queue_updates(self) -> List[Dict[str, Any]]:
+        """一次刷新中同一个(system, date, type)键的pageview更新"""
+        from track import _pageview_handler, sanitize_fingerprint, sanitize_key
+        urls, payload = self.get('raw_urls'), self.get('track_payloads')['pageview']
+        updates = []
+        for i in range(QUEUE_ITEMS):
+            data = dict(payload, url=urls[int(URLS * self._random.random() ** 2)])
+            updates.append(_pageview_handler(data, 'pageViews', 'example', sanitize_fingerprint(f"user-{i % 40}"),
+                                             '10.1.2.3', sanitize_key(f"10.{i % 20}"), '2026-10-17'))
+        return updates
+
+
+fixtures = Fixtures()
+
+
+@benchmark('sanitize_key[10k urls]')
+def _bench_sanitize_key():
+    from track import sanitize_key
+    raw_urls = fixtures.get('raw_urls')
+    return lambda: [sanitize_key(url) for url in raw_urls]
+
+
+@benchmark('restore_all_keys_recursive[day document]')
+def _bench_restore_day():
+    from track import restore_all_keys_recursive
+    day = fixtures.get('pageview_day')
+    return lambda: restore_all_keys_recursive(day)
+
+
+@benchmark('restore_all_keys_recursive[top 10 result]')
+def _bench_restore_result():
+    from track import get_top_entries, restore_all_keys_recursive
+    day = fixtures.get('pageview_day')
+    result = {dimension: get_top_entries(value, 10) for dimension, value in day.items() if isinstance(value, dict)}
+    return lambda: restore_all_keys_recursive(result)
+
+
+@benchmark('FlatStatsMerger[7 days x 10k urls, top 10]')
+def _bench_flat_merger():
+    from stats_merge import FlatStatsMerger
+    days = fixtures.get('pageview_days')
+
+    def run():
+        merger = FlatStatsMerger()
+        for day in days:
+            for dimension, value in day.items():
+                merger.add(dimension, value)
+        return {dimension: merger.to_nested(dimension, 10) for dimension in days[0]}
+    return run
+
+
+@benchmark('get_top_entries[10k flat]')
+def _bench_top_flat():
+    from track import get_top_entries
+    by_url = fixtures.get('pageview_day')['byUrl']
+    return lambda: get_top_entries(by_url, 10)
+
+
+@benchmark('get_top_entries[10k nested]')
+def _bench_top_nested():
+    from track import get_top_entries
+    by_url_and_ip = fixtures.get('pageview_day')['byUrlAndIPPrefix']
+    return lambda: get_top_entries(by_url_and_ip, 10)
+
+
+@benchmark('BatchProcessor._merge_update_fields[100 pageviews]')
+def _bench_merge_update_fields():
+    from batch import BatchProcessor
+    updates = fixtures.get('queue_updates')
+    merge = BatchProcessor._merge_update_fields
+
+    def run():
+        merged = updates[0]
+        for update in updates[1:]:
+            merged = merge(merged, update)
+        return merged
+    return run
+
+
+def _register_handler(track_type: str):
+    @benchmark(f'handler[{track_type}]')
+    def setup():
+        from track import TRACK_TYPE_HANDLERS, sanitize_fingerprint, sanitize_key
+        stats_type, handler = TRACK_TYPE_HANDLERS[track_type]
+        payload = fixtures.get('track_payloads')[track_type]
+        fingerprint, ip_prefix = sanitize_fingerprint('user-1'), sanitize_key('10.1')
+        return lambda: handler(payload, stats_type, 'example', fingerprint, '10.1.2.3', ip_prefix, '2026-10-17')
+
+
+for _track_type in ('pageview', 'download', 'event', 'duration'):
+    _register_handler(_track_type)
+
+
+def _calibration():
+    """固定的纯Python负载（字典、字符串和排序），用于把耗时换算为与机器无关的比值"""
+    counts = {}
+    for i in range(20000):
+        key = f"key-{i % 1000}"
+        counts[key] = counts.get(key, 0) + i
+    return sorted(counts.items(), key=lambda item: item[1], reverse=True)[:10]
+
+
+def _timer(func: Callable[[], Any], min_time: float) -> Tuple[timeit.Timer, int]:
+    """返回计时器和每轮的调用次数（每轮至少min_time秒）"""
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    if elapsed < min_time:
+        number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    return timer, number
+
+
+def measure(func: Callable[[], Any], calibration: Tuple[timeit.Timer, int], repeat: int,
+            min_time: float) -> Tuple[float, float, float]:
+    """
+    校准负载和基准交替计时repeat轮，返回 (最快一轮的单次耗时, 对应的校准耗时, 各轮耗时比的中位数)
+    相邻两轮的比值可以抵消运行期间CPU频率和机器负载的变化
+    """
+    timer, number = _timer(func, min_time)
+    calibration_timer, calibration_number = calibration
+    samples = []
+    for _ in range(repeat):
+        calibration_seconds = calibration_timer.timeit(calibration_number) / calibration_number
+        seconds = timer.timeit(number) / number
+        samples.append((seconds, calibration_seconds))
+    ratios = sorted(seconds / calibration_seconds for seconds, calibration_seconds in samples)
+    fastest = min(samples)
+    return fastest[0], fastest[1], ratios[len(ratios) // 2]
+
+
+def run_benchmarks(names: List[str], repeat: int, min_time: float) -> Dict[str, Any]:
+    calibration = _timer(_calibration, min_time)
+    results, calibrations = {}, []
+    for name in names:
+        func = BENCHMARKS[name]()
+        func()  # 预热（导入模块、生成数据）
+        seconds, calibration_seconds, relative = measure(func, calibration, repeat, min_time)
+        calibrations.append(calibration_seconds)
+        results[name] = {'seconds': seconds, 'relative': relative}
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'calibration_seconds': min(calibrations),
+        'results': results,
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> Tuple[List[tuple], List[str]]:
+    """返回 (报告行, 回归的基准)；比较相对于校准负载的耗时比"""
+    rows, regressions = [], []
+    for name, result in current['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            rows.append((name, result['seconds'], None, None, 'new'))
+            continue
+        change = result['relative'] / base['relative'] - 1
+        status = 'ok'
+        if change > threshold:
+            status = 'REGRESSION'
+            regressions.append(name)
+        elif change < -threshold:
+            status = 'faster'
+        rows.append((name, result['seconds'], base['seconds'], change, status))
+    return rows, regressions
+
+
+def _format_seconds(seconds) -> str:
+    if seconds is None:
+        return '-'
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f}ms"
+    return f"{seconds * 1e6:.2f}us"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="热点函数微基准与回归检查")
+    parser.add_argument('-k', dest='filters', action='append', default=[], help="只运行名称包含该字符串的基准，可重复")
+    parser.add_argument('--save', action='store_true', help="把本次结果保存为基线（合并到已有基线）")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="基线文件路径")
+    parser.add_argument('--threshold', type=float, default=0.25, help="相对基线变慢超过该比例视为回归")
+    parser.add_argument('--repeat', type=int, default=7, help="每个基准的计时轮数")
+    parser.add_argument('--min-time', type=float, default=0.2, help="每轮的最短计时（秒）")
+    parser.add_argument('--list', action='store_true', help="列出所有基准")
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if not args.filters or any(item in name for item in args.filters)]
+    if args.list:
+        print('\n'.join(names))
+        return
+    if not names:
+        parser.error("no benchmark matches")
+
+    current = run_benchmarks(names, args.repeat, args.min_time)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    if args.save:
+        # 只运行部分基准时保留其他基准的旧结果（耗时按本次的校准负载换算）
+        results = {name: {'seconds': value['relative'] * current['calibration_seconds'], 'relative': value['relative']}
+                   for name, value in baseline.get('results', {}).items()}
+        results.update(current['results'])
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(dict(current, results=results), f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"baseline saved to {args.baseline}")
+
+    rows, regressions = compare(current, baseline, args.threshold)
+    if baseline and baseline.get('python') != current['python']:
+        print(f"warning: baseline was recorded with Python {baseline.get('python')}, running {current['python']}")
+    width = max(len(row[0]) for row in rows)
+    print(f"{'benchmark':<{width}}  {'time':>10}  {'baseline':>10}  {'change':>8}  status")
+    for name, seconds, base_seconds, change, status in rows:
+        change_text = f"{change:+.1%}" if change is not None else '-'
+        print(f"{name:<{width}}  {_format_seconds(seconds):>10}  {_format_seconds(base_seconds):>10}  "
+              f"{change_text:>8}  {status}")
+    if regressions and not args.save:
+        print(f"{len(regressions)} benchmark(s) regressed more than {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
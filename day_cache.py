@@ -0,0 +1,134 @@
+import os
+import pickle
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from mongodb import stats_collection, hourly_stats_collection
+from rollup import STATS_HOURLY_BUCKETS, current_bucket, to_hour_range
+
+# 已结束日期的合并结果缓存条目数（0表示不启用）
+# 已结束的日期不会再变化，缓存不过期，只在删除统计或迟到写入（文档版本变化）时失效
+STATS_DAY_CACHE_SIZE = int(os.getenv("STATS_DAY_CACHE_SIZE", "0"))
+# 缓存占用的最大字节数（按序列化后的大小计算）
+STATS_DAY_CACHE_BYTES = int(os.getenv("STATS_DAY_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# 文档版本：迟到写入更新lastUpdated，HLL草图写入递增hllVersion，top-K折叠递增topKVersion
+_VERSION_FIELDS = ('lastUpdated', 'hllVersion', 'topKVersion')
+
+
+class DayStatsCache:
+    """
+    缓存范围查询中已结束日期合并后的部分结果，查询时只需再合并尚未结束的日期（通常只有当天）
+    - 键为 (system, type, 结果参数, 查询日期范围, 第一个未结束日期)，日期进入下一天时自然换用新键
+    - 每次查询先用一次只投影date和版本字段的查询校验缓存（其他worker的迟到写入、HLL/top-K写入和删除同样会被发现），
+      任何一天的版本变化都重新读取并合并已结束的日期
+    - 部分结果以pickle保存：命中时反序列化得到独立的副本，大小按序列化后的字节数计算
+    """
+
+    def __init__(self, maxsize: int, max_bytes: int = STATS_DAY_CACHE_BYTES):
+        self.enabled = maxsize > 0
+        self._maxsize = maxsize
+        self._max_bytes = max_bytes
+        # {key: (各日期版本, 序列化的部分结果)}，按访问顺序排列
+        self._entries: "OrderedDict[Tuple[Any, ...], Tuple[tuple, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.late_write_invalidations = 0
+
+    async def _first_open_date(self, query: dict) -> str:
+        """第一个尚未结束的日期：当天，或仍有未汇总小时文档的更早日期"""
+        today = current_bucket()[:len('YYYY-MM-DD')]
+        if not STATS_HOURLY_BUCKETS:
+            return today
+        hour_query = dict(query, merged={'$exists': False})
+        if 'date' in query:
+            hour_query['date'] = to_hour_range(query['date'])
+        cursor = hourly_stats_collection.find(hour_query, {'_id': 0, 'date': 1}).sort('date', 1).limit(1)
+        async for hour_doc in cursor:
+            return min(today, hour_doc['date'][:len('YYYY-MM-DD')])
+        return today
+
+    @staticmethod
+    async def _versions(query: dict) -> tuple:
+        """已结束日期的当前版本（文档被删除的日期不会出现）"""
+        projection = {'_id': 0, 'date': 1}
+        projection.update({field: 1 for field in _VERSION_FIELDS})
+        return tuple([
+            (doc['date'],) + tuple(doc.get(field) for field in _VERSION_FIELDS)
+            async for doc in stats_collection.find(query, projection).sort('date', 1)
+        ])
+
+    def _discard(self, key):
+        _, blob = self._entries.pop(key)
+        self._bytes -= len(blob)
+
+    def _store(self, key, versions: tuple, blob: bytes):
+        if len(blob) > self._max_bytes:
+            return
+        self._entries[key] = (versions, blob)
+        self._bytes += len(blob)
+        while len(self._entries) > self._maxsize or self._bytes > self._max_bytes:
+            oldest = next(iter(self._entries))
+            self._discard(oldest)
+            self.evictions += 1
+
+    async def merged_closed_days(self, query: dict, projection: dict, variant: Tuple[Any, ...],
+                                 merge: Callable[[Any], Awaitable[Any]]) -> Tuple[Any, Optional[dict]]:
+        """
+        返回已结束日期合并后的部分结果
+        :param query: 统计查询条件（system、type和可选的date范围）
+        :param projection: 每日文档的投影
+        :param variant: 影响合并结果的其他参数（如返回条目数），作为缓存键的一部分
+        :param merge: 合并函数，参数为按日期排序的文档游标，返回可序列化的部分结果（调用方之后会修改，缓存保存副本）
+        :return: (部分结果, 尚未结束日期的查询条件；查询范围不包含未结束日期时为None)
+        """
+        system, stats_type = query['system'], query['type']
+        date_query = query.get('date', {})
+        open_from = await self._first_open_date(query)
+        closed_query = dict(query, date=dict(date_query, **{'$lt': open_from}))
+
+        key = (system, stats_type, variant, tuple(sorted(date_query.items())), open_from)
+        versions = await self._versions(closed_query)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == versions:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            partial = pickle.loads(entry[1])
+        else:
+            if entry is not None:
+                self.late_write_invalidations += 1
+                self._discard(key)
+            self.misses += 1
+            partial = await merge(stats_collection.find(closed_query, projection).sort('date', 1))
+            self._store(key, versions, pickle.dumps(partial, protocol=pickle.HIGHEST_PROTOCOL))
+
+        fresh_query = None
+        if date_query.get('$lte', open_from) >= open_from:
+            fresh_query = dict(query, date=dict(date_query, **{'$gte': max(date_query.get('$gte', open_from), open_from)}))
+        return partial, fresh_query
+
+    def invalidate_system(self, system: str) -> int:
+        """删除某个system的统计后清除其缓存"""
+        keys = [key for key in self._entries if key[0] == system]
+        for key in keys:
+            self._discard(key)
+        return len(keys)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self._maxsize,
+            'bytes': self._bytes,
+            'max_bytes': self._max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+            'late_write_invalidations': self.late_write_invalidations,
+        }
+
+
+day_cache = DayStatsCache(STATS_DAY_CACHE_SIZE)
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import os
+import secrets
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from mongodb import (user_stats_collection, hourly_stats_collection, period_stats_collection,
+                     dimension_dict_collection, jobs_collection)
+from storage import stats_storage
+
+STATS_DELETE_CHUNK_SIZE = int(os.getenv("STATS_DELETE_CHUNK_SIZE", "500"))  # 每批删除的文档数
+STATS_DELETE_RATE = float(os.getenv("STATS_DELETE_RATE", "2000"))  # 每秒最多删除的文档数（0表示不限速）
+STATS_DELETE_STALE_SECONDS = float(os.getenv("STATS_DELETE_STALE_SECONDS", "300"))  # 进行中的任务超过该时间没有进度视为已中断
+
+# 按顺序删除的集合（字典最后删除，删除过程中的查询仍能解析已编码的键）
+# 每日统计文档通过存储后端删除，集合为None
+DELETE_COLLECTIONS = (
+    ('stats', None),
+    ('user_stats', user_stats_collection),
+    ('hourly_stats', hourly_stats_collection),
+    ('period_stats', period_stats_collection),
+    ('dimension_dict', dimension_dict_collection),
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _collection_chunks(collection, system: str) -> Callable[[], Awaitable[Optional[int]]]:
+    """按_id顺序分批删除集合中system的文档，返回的函数每次删除一批，返回删除数量，没有剩余文档时返回None"""
+    last_id = None
+
+    async def delete_chunk() -> Optional[int]:
+        nonlocal last_id
+        query = {'system': system}
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        ids: List[Any] = [doc['_id'] async for doc in collection.find(query, {'_id': 1})
+                          .sort('_id', 1).limit(STATS_DELETE_CHUNK_SIZE)]
+        if not ids:
+            return None
+        result = await collection.delete_many({'_id': {'$in': ids}})
+        last_id = ids[-1]
+        return result.deleted_count
+
+    return delete_chunk
+
+
+def _storage_chunks(system: str) -> Callable[[], Awaitable[Optional[int]]]:
+    """通过存储后端分批删除每日统计文档"""
+    async def delete_chunk() -> Optional[int]:
+        return await stats_storage.delete_system(system, STATS_DELETE_CHUNK_SIZE) or None
+
+    return delete_chunk
+
+
+class StatsDeleteJobs:
+    """
+    后台删除某个system的所有统计数据
+    每个集合按_id顺序分批删除并限速，避免长时间占用请求和突发的MongoDB I/O影响写入；
+    任务状态保存在monitor_jobs集合中，任何worker都可以查询进度
+    """
+
+    def __init__(self, invalidate_caches: Callable[[str], Any]):
+        """
+        Args:
+            invalidate_caches: 清除该system在本进程中缓存的函数，任务开始和结束时各调用一次
+        """
+        self._invalidate_caches = invalidate_caches
+        self._tasks = set()
+
+    async def start(self, system: str) -> Dict[str, Any]:
+        """启动删除任务；该system已有进行中的任务时返回已有任务"""
+        now = datetime.utcnow()
+        running = await jobs_collection.find_one({'kind': 'delete_stats', 'system': system, 'status': 'running'})
+        if running:
+            if (now - running['updatedAt']).total_seconds() < STATS_DELETE_STALE_SECONDS:
+                return running
+            # 执行任务的worker已退出，标记失败后重新开始
+            await jobs_collection.update_one({'_id': running['_id'], 'status': 'running'},
+                                             {'$set': {'status': 'failed', 'error': 'worker lost', 'updatedAt': now}})
+        job = {
+            '_id': secrets.token_hex(12),
+            'kind': 'delete_stats',
+            'system': system,
+            'status': 'running',
+            'deleted': 0,
+            'collections': {name: 0 for name, _ in DELETE_COLLECTIONS},
+            'pid': os.getpid(),
+            'startedAt': now,
+            'updatedAt': now,
+        }
+        await jobs_collection.insert_one(job)
+        self._invalidate_caches(system)
+        task = asyncio.create_task(self._run(job['_id'], system))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def _run(self, job_id: str, system: str):
+        started = time.monotonic()
+        deleted = 0
+        try:
+            for name, collection in DELETE_COLLECTIONS:
+                delete_chunk = _collection_chunks(collection, system) if collection is not None else _storage_chunks(system)
+                while True:
+                    chunk_started = time.monotonic()
+                    chunk_count = await delete_chunk()
+                    if chunk_count is None:
+                        break
+                    deleted += chunk_count
+                    elapsed = time.monotonic() - started
+                    await jobs_collection.update_one({'_id': job_id}, {
+                        '$inc': {'deleted': chunk_count, f'collections.{name}': chunk_count},
+                        '$set': {'updatedAt': datetime.utcnow(),
+                                 'docsPerSecond': round(deleted / elapsed, 1) if elapsed else None},
+                    })
+                    if STATS_DELETE_RATE > 0:
+                        # 限速：本批按速率应占用的时间减去实际耗时
+                        await asyncio.sleep(max(0.0, chunk_count / STATS_DELETE_RATE - (time.monotonic() - chunk_started)))
+            status, error = 'completed', None
+        except asyncio.CancelledError:
+            status, error = 'cancelled', 'worker stopped'
+            raise
+        except Exception as e:
+            logger.error(f"删除系统统计数据失败: {str(e)}", exc_info=True)
+            status, error = 'failed', str(e)
+        finally:
+            self._invalidate_caches(system)
+            elapsed = time.monotonic() - started
+            update = {'status': status, 'finishedAt': datetime.utcnow(), 'updatedAt': datetime.utcnow(),
+                      'elapsedSeconds': round(elapsed, 3),
+                      'docsPerSecond': round(deleted / elapsed, 1) if elapsed else None}
+            if error:
+                update['error'] = error
+            try:
+                await jobs_collection.update_one({'_id': job_id}, {'$set': update})
+            except Exception as e:
+                logger.error(f"更新删除任务状态失败: {e}")
+
+    async def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = await jobs_collection.find_one({'_id': job_id, 'kind': 'delete_stats'})
+        if not job:
+            return None
+        job['job_id'] = job.pop('_id')
+        if job['status'] == 'running':
+            job['elapsedSeconds'] = round((datetime.utcnow() - job['startedAt']).total_seconds(), 3)
+        return job
@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import os
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+
+from mongodb import dimension_dict_collection, sites_collection
+from util import BoundedTTLCache
+
+logger = logging.getLogger(__name__)
+
+# 是否把维度值编码为按站点分配的小整数id（统计文档以id为键，不再转义键名；读取时只解析返回的前N条）
+STATS_DIMENSION_DICTIONARY = os.getenv("STATS_DIMENSION_DICTIONARY", "False").lower() == "true"
+# 每个进程缓存的 值↔id 映射条数（映射分配后不再变化，不过期）
+DIMENSION_DICT_CACHE_SIZE = int(os.getenv("DIMENSION_DICT_CACHE_SIZE", "100000"))
+# 等待后台分配id的新值条数上限（超出的值本次按原值写入，下次出现时再排队）
+DIMENSION_DICT_PENDING_SIZE = int(os.getenv("DIMENSION_DICT_PENDING_SIZE", "10000"))
+
+# 编码后的键以该前缀开头，与未编码的旧数据区分
+ID_PREFIX = '~'
+
+# 各统计类型中编码的上报字段及其默认值（与各跟踪处理函数一致）
+DICTIONARY_FIELDS = {
+    'pageViews': {'url': 'unknown', 'browser': 'unknown', 'os': 'unknown', 'device': 'unknown', 'referrer': ''},
+    'downloads': {'downloadUrl': 'unknown', 'fileName': 'unknown', 'sourcePage': 'unknown'},
+    'events': {'eventType': 'click', 'eventCategory': 'engagement', 'eventAction': 'click',
+               'eventLabel': 'unknown', 'selector': 'unknown', 'url': 'unknown'},
+    'duration': {'url': 'unknown', 'browser': 'unknown', 'os': 'unknown', 'device': 'unknown'},
+}
+
+def _raw_value(value) -> str:
+    """与sanitize_key一致，空值记为unknown"""
+    return str(value) if value else 'unknown'
+
+
+def _is_encoded(part: str) -> bool:
+    return part.startswith(ID_PREFIX) and part[len(ID_PREFIX):].isdigit()
+
+
+class DimensionDictionary:
+    """
+    按站点的维度值字典（monitor_dimension_dict: {system, value, id}）
+    - 上报请求只查询进程内缓存，不访问数据库：缓存未命中的值按原值写入，并交给后台任务分配id
+    - 后台任务首次遇到某个站点时预加载该站点的字典，之后按批查询/分配新值
+    - 新值的id按块从站点文档的dimension_seq分配，多个worker同时插入同一个值时以先插入的为准
+    """
+
+    def __init__(self, cache_size: int, pending_size: int = DIMENSION_DICT_PENDING_SIZE):
+        self._cache_size = cache_size
+        self._ids = BoundedTTLCache(maxsize=cache_size, ttl=float('inf'))  # (system, 值) → 键
+        self._values = BoundedTTLCache(maxsize=cache_size, ttl=float('inf'))  # (system, 键) → 值
+        self._preloaded: Set[str] = set()
+        self._pending: Dict[str, Set[str]] = {}  # system → 等待分配id的值
+        self._pending_size = pending_size
+        self._pending_count = 0
+        self._task: Optional[asyncio.Task] = None
+        self.metrics = {'lookups': 0, 'allocated': 0, 'insert_conflicts': 0, 'unresolved': 0,
+                        'preloaded_sites': 0, 'deferred': 0, 'dropped': 0, 'errors': 0}
+
+    def _remember(self, system: str, value: str, id_: int) -> str:
+        key = f'{ID_PREFIX}{id_}'
+        self._ids.set((system, value), key)
+        self._values.set((system, key), value)
+        return key
+
+    async def _preload(self, system: str):
+        """加载站点的字典（最多缓存容量条）"""
+        self._preloaded.add(system)
+        self.metrics['preloaded_sites'] += 1
+        cursor = dimension_dict_collection.find({'system': system}, {'_id': 0, 'value': 1, 'id': 1})
+        async for document in cursor.limit(self._cache_size):
+            self._remember(system, document['value'], document['id'])
+
+    async def _allocate(self, system: str, values: List[str]) -> Dict[str, str]:
+        """为新值分配id并插入字典，返回 {值: 键}"""
+        site = await sites_collection.find_one_and_update(
+            {'site_name': system}, {'$inc': {'dimension_seq': len(values)}},
+            projection={'dimension_seq': 1}, return_document=ReturnDocument.AFTER
+        )
+        if not site:
+            return {}
+        first_id = site['dimension_seq'] - len(values) + 1
+        documents = [{'system': system, 'value': value, 'id': first_id + i} for i, value in enumerate(values)]
+        try:
+            await dimension_dict_collection.insert_many(documents, ordered=False)
+        except BulkWriteError:
+            # 其他worker已插入同一个值（或值过长无法建索引），重新读取实际生效的id
+            self.metrics['insert_conflicts'] += 1
+            return await self._find(system, values)
+        self.metrics['allocated'] += len(values)
+        return {document['value']: self._remember(system, document['value'], document['id'])
+                for document in documents}
+
+    async def _find(self, system: str, values: List[str]) -> Dict[str, str]:
+        self.metrics['lookups'] += 1
+        found = {}
+        async for document in dimension_dict_collection.find({'system': system, 'value': {'$in': values}},
+                                                             {'_id': 0, 'value': 1, 'id': 1}):
+            found[document['value']] = self._remember(system, document['value'], document['id'])
+        return found
+
+    async def resolve(self, system: str, values: Iterable[str]):
+        """预加载站点字典，并为仍未缓存的值查询或分配id"""
+        if system not in self._preloaded:
+            await self._preload(system)
+        misses = [value for value in set(values) if not self._ids.get((system, value))[0]]
+        if not misses:
+            return
+        found = await self._find(system, misses)
+        missing = [value for value in misses if value not in found]
+        if missing:
+            allocated = await self._allocate(system, missing)
+            self.metrics['unresolved'] += sum(1 for value in missing if value not in allocated)
+
+    async def _resolve_pending(self):
+        while self._pending:
+            system, values = self._pending.popitem()
+            self._pending_count -= len(values)
+            try:
+                await self.resolve(system, values)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 这些值继续按原值写入，下次出现时重新排队
+                self.metrics['errors'] += 1
+                logger.error(f"Dimension dictionary resolve failed for {system}: {e}")
+
+    def _defer(self, system: str, values: List[str]):
+        pending = self._pending.setdefault(system, set())
+        for value in values:
+            if value in pending:
+                continue
+            if self._pending_count >= self._pending_size:
+                self.metrics['dropped'] += 1
+                continue
+            pending.add(value)
+            self._pending_count += 1
+            self.metrics['deferred'] += 1
+        if not pending:
+            self._pending.pop(system, None)
+        if self._pending and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self._resolve_pending())
+
+    def encode(self, system: str, values: Iterable[str]) -> Dict[str, str]:
+        """
+        返回 {值: 键}，只查询缓存
+        缓存未命中的值不在返回结果中（调用方按原值写入），由后台任务预加载站点字典或分配id
+        """
+        keys, misses = {}, []
+        for value in set(values):
+            hit, key = self._ids.get((system, value))
+            if hit:
+                keys[value] = key
+            else:
+                misses.append(value)
+        if misses or system not in self._preloaded:
+            self._defer(system, misses)
+        return keys
+
+    def encode_items(self, system: str, items: List[Tuple[str, dict]], ip_prefix: str) -> Tuple[List[dict], str]:
+        """
+        编码一次上报中各条记录的维度字段和IP前缀
+        :param items: [(统计类型, 上报数据), ...]
+        :param ip_prefix: 未转义的IP前缀
+        :return: (替换为键的上报数据列表, IP前缀的键)
+        """
+        values = {ip_prefix}
+        for track_type, data in items:
+            for field, default in DICTIONARY_FIELDS.get(track_type, {}).items():
+                values.add(_raw_value(data.get(field, default)))
+        keys = self.encode(system, values)
+
+        encoded = []
+        for track_type, data in items:
+            data = dict(data)
+            for field, default in DICTIONARY_FIELDS.get(track_type, {}).items():
+                key = keys.get(_raw_value(data.get(field, default)))
+                if key:
+                    data[field] = key
+            encoded.append(data)
+        return encoded, keys.get(ip_prefix)
+
+    async def decode(self, system: str, keys: Iterable[str],
+                     restore: Callable[[str], str] = lambda part: part) -> Dict[str, str]:
+        """
+        返回 {键: 值}，找不到的键不在结果中
+        组合键（如事件趋势的 类别.动作）按 . 分段解析：编码的段替换为原值，未编码的旧段用restore还原
+        """
+        keys = set(keys)
+        values, misses = {}, []
+        for part in {part for key in keys for part in key.split('.') if _is_encoded(part)}:
+            hit, value = self._values.get((system, part))
+            if hit:
+                values[part] = value
+            else:
+                misses.append(int(part[len(ID_PREFIX):]))
+        if misses:
+            self.metrics['lookups'] += 1
+            async for document in dimension_dict_collection.find({'system': system, 'id': {'$in': misses}},
+                                                                 {'_id': 0, 'value': 1, 'id': 1}):
+                values[self._remember(system, document['value'], document['id'])] = document['value']
+        decoded = {}
+        for key in keys:
+            parts = key.split('.')
+            if all(part in values or not _is_encoded(part) for part in parts):
+                decoded[key] = '.'.join(values[part] if part in values else restore(part) for part in parts)
+        return decoded
+
+    def invalidate_system(self, system: str):
+        """删除站点统计（及字典）后清除缓存"""
+        self._ids.invalidate(lambda key: key[0] == system)
+        self._values.invalidate(lambda key: key[0] == system)
+        self._preloaded.discard(system)
+        self._pending_count -= len(self._pending.pop(system, ()))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def get_metrics(self) -> Dict[str, Any]:
+        metrics = dict(self.metrics)
+        metrics['enabled'] = STATS_DIMENSION_DICTIONARY
+        metrics['pending'] = self._pending_count
+        metrics['cached_values'] = self._ids.get_metrics()
+        metrics['cached_ids'] = self._values.get_metrics()
+        return metrics
+
+
+def collect_keys(data: Any, keys: Optional[set] = None) -> set:
+    """收集结果中所有编码过的键，包括部分段编码的组合键（只遍历最终返回的前N条结果）"""
+    if keys is None:
+        keys = set()
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            for key, value in item.items():
+                if isinstance(key, str) and (key.startswith(ID_PREFIX) or '.' + ID_PREFIX in key):
+                    keys.add(key)
+                if isinstance(value, (dict, list, tuple)):
+                    stack.append(value)
+        elif isinstance(item, (list, tuple)):
+            stack.extend(value for value in item if isinstance(value, (dict, list, tuple)))
+    return keys
+
+
+dimension_dictionary = DimensionDictionary(DIMENSION_DICT_CACHE_SIZE)
@@ -0,0 +1,135 @@
+import csv
+import io
+import json
+import logging
+from itertools import chain
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Tuple
+
+from fastapi import APIRouter, HTTPException, Request
+from starlette.responses import StreamingResponse
+
+from batch import USER_DIMENSIONS
+from dimension_dict import collect_keys, dimension_dictionary
+from hll import count_unique
+from retention import STATS_RETENTION
+from track import _iter_stats_documents, restore_key, sanitize_key
+from util import access_system
+
+logger = logging.getLogger(__name__)
+
+export_router = APIRouter(prefix="/api")
+
+# 导出路径中的类型与 /api/stats/* 一致
+EXPORT_TYPES = {'pageview': 'pageViews', 'downloads': 'downloads', 'events': 'events', 'duration': 'duration'}
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+# CSV的键列数（最深的维度如停留时长的 byUrlAndIPPrefix.count.<url>.<ip> 有三级键）
+CSV_KEY_COLUMNS = 3
+
+
+def _walk(dimension: str, path: tuple, value: Any, sketch: Any) -> Iterator[Tuple[str, tuple, Any]]:
+    """展开一个维度，唯一用户集合（指纹列表和/或HLL草图）输出为唯一用户数"""
+    if isinstance(value, dict) or isinstance(sketch, dict):
+        value = value if isinstance(value, dict) else {}
+        sketch = sketch if isinstance(sketch, dict) else {}
+        for key in chain(value, (key for key in sketch if key not in value)):
+            yield from _walk(dimension, path + (key,), value.get(key), sketch.get(key))
+    elif isinstance(value, list) or sketch is not None:
+        yield dimension, path, count_unique(value, sketch)
+    elif isinstance(value, (int, float)):
+        yield dimension, path, value
+
+
+def flatten_stats_data(data: dict) -> Iterator[Tuple[str, tuple, Any]]:
+    """把每日文档的data展开为 (维度, 键路径, 值) 行，键路径未还原"""
+    sketches = data.get('hll') or {}
+    for dimension in chain(data, (dimension for dimension in sketches if dimension not in data)):
+        if dimension != 'hll':
+            yield from _walk(dimension, (), data.get(dimension), sketches.get(dimension))
+
+
+async def iter_export_rows(system: str, stats_type: str, start_date: Optional[str] = None,
+                           end_date: Optional[str] = None) -> AsyncIterator[Tuple[str, Iterator[Dict[str, Any]]]]:
+    """
+    按日期顺序逐个读取每日文档，返回 (日期, 该日的行迭代器)
+    行为 {'date', 'dimension', 'keys', 'value'}，键在输出时才还原（字典编码的键每个文档解析一次）
+    不包含按用户指纹的维度
+    """
+    query = {'system': system, 'type': stats_type}
+    if start_date or end_date:
+        query['date'] = {}
+        if start_date:
+            query['date']['$gte'] = start_date
+        if end_date:
+            query['date']['$lte'] = end_date
+    projection = {'_id': 0}
+    projection.update({f'data.{dimension}': 0 for dimension in USER_DIMENSIONS})
+
+    # 保留策略归档的月份只有月汇总，以月初日期输出一行
+    async for stats in _iter_stats_documents(query, projection, 'day', archived_only=STATS_RETENTION):
+        data = stats.get('data') or {}
+        encoded = collect_keys(data)
+        decoded = await dimension_dictionary.decode(system, encoded, restore_key) if encoded else {}
+        yield stats['date'], _document_rows(stats['date'], data, decoded)
+
+
+def _document_rows(date: str, data: dict, decoded: Dict[str, str]) -> Iterator[Dict[str, Any]]:
+    restored = {}
+
+    def restore(key: str) -> str:
+        if key not in restored:
+            restored[key] = decoded[key] if key in decoded else restore_key(key)
+        return restored[key]
+
+    for dimension, path, value in flatten_stats_data(data):
+        yield {'date': date, 'dimension': dimension, 'keys': [restore(key) for key in path], 'value': value}
+
+
+def _ndjson_chunk(rows: Iterator[Dict[str, Any]]) -> str:
+    return ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows)
+
+
+def _csv_chunk(rows: Iterator[Dict[str, Any]], header: bool = False) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(['date', 'dimension'] + [f'key{level + 1}' for level in range(CSV_KEY_COLUMNS)] + ['value'])
+    for row in rows:
+        keys = row['keys'] + [''] * (CSV_KEY_COLUMNS - len(row['keys']))
+        writer.writerow([row['date'], row['dimension']] + keys + [row['value']])
+    return buffer.getvalue()
+
+
+async def _stream_export(system: str, stats_type: str, start_date: Optional[str], end_date: Optional[str],
+                         fmt: str) -> AsyncIterator[str]:
+    """每个每日文档输出一块，内存占用与导出的天数无关"""
+    if fmt == 'csv':
+        yield _csv_chunk(iter(()), header=True)
+    try:
+        async for _, rows in iter_export_rows(system, stats_type, start_date, end_date):
+            yield _csv_chunk(rows) if fmt == 'csv' else _ndjson_chunk(rows)
+    except Exception as e:
+        # 响应头已发送，只能记录错误并截断输出
+        logger.error(f"导出{stats_type}统计失败: {str(e)}", exc_info=True)
+        raise
+
+
+@export_router.get("/export/{export_type}")
+@access_system("${system}")
+async def export_stats(request: Request, export_type: str, system: str = "default", start_date: Optional[str] = None,
+                       end_date: Optional[str] = None, format: str = "ndjson"):
+    """
+    按天流式导出原始统计（不合并、不截断），每行一个维度条目
+    format为ndjson（默认）或csv
+    """
+    stats_type = EXPORT_TYPES.get(export_type)
+    if not stats_type:
+        raise HTTPException(status_code=404, detail=f"Unsupported type: {export_type}")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'csv'")
+    system = sanitize_key(system)
+    filename = f"{system}-{export_type}.{format}"
+    return StreamingResponse(
+        _stream_export(system, stats_type, start_date, end_date, format),
+        media_type=EXPORT_FORMATS[format],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
@@ -0,0 +1,175 @@
+"""
+把统计导出为按 system/type/月份 分区的Parquet文件（长表：date, type, dimension, key, subkey, value），供离线分析
+
+用法：
+    python export_parquet.py --system my-site --start 2026-01-01 --end 2026-06-30 --out ./stats-parquet
+
+默认从副本集的从节点读取（没有从节点时读主节点），逐个每日文档展开并按批写入行组，内存占用与导出范围无关。
+只导出已写入monitor_stats的每日文档（启用按小时分桶时尚未汇总的当前小时不包含在内），不包含按用户指纹的维度。
+需要安装pyarrow（可选依赖，不在requirements.txt中）：pip install -r requirements-export.txt
+"""
+import argparse
+import asyncio
+import importlib.util
+import logging
+import os
+from typing import Dict, List, Optional
+
+from pymongo import ReadPreference
+
+from batch import USER_DIMENSIONS
+from dimension_dict import collect_keys, dimension_dictionary
+from export import EXPORT_TYPES, flatten_stats_data
+from mongodb import stats_collection
+from track import restore_key, sanitize_key
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ('date', 'type', 'dimension', 'key', 'subkey', 'value')
+READ_PREFERENCES = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+}
+
+
+def to_long_rows(date: str, stats_type: str, data: dict, decoded: Dict[str, str]):
+    """
+    展开一个每日文档为长表行
+    超过两级的键（如停留时长的 byUrlAndIPPrefix.count.<url>.<ip>）把前面的键并入维度名，最后两级作为key和subkey
+    """
+    restored = {}
+    for dimension, path, value in flatten_stats_data(data):
+        keys = []
+        for key in path:
+            if key not in restored:
+                restored[key] = decoded[key] if key in decoded else restore_key(key)
+            keys.append(restored[key])
+        if len(keys) > 2:
+            dimension = '.'.join([dimension] + keys[:-2])
+            keys = keys[-2:]
+        keys += [None] * (2 - len(keys))
+        yield date, stats_type, dimension, keys[0], keys[1], float(value)
+
+
+class PartitionedParquetWriter:
+    """按 type/月份 分区写入，同一时间只打开一个分区（文档按type和日期顺序读取）"""
+
+    def __init__(self, root: str, system: str, batch_rows: int, compression: str):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self._pa, self._pq = pa, pq
+        self.schema = pa.schema([('date', pa.string()), ('type', pa.string()), ('dimension', pa.string()),
+                                 ('key', pa.string()), ('subkey', pa.string()), ('value', pa.float64())])
+        self.root = os.path.join(root, f'system={system}')
+        self.batch_rows = batch_rows
+        self.compression = compression
+        self._partition: Optional[tuple] = None
+        self._writer = None
+        self._columns: List[list] = [[] for _ in COLUMNS]
+        self.rows_written = 0
+        self.files_written = 0
+
+    def _open(self, partition: tuple):
+        self.close()
+        stats_type, month = partition
+        directory = os.path.join(self.root, f'type={stats_type}', f'month={month}')
+        os.makedirs(directory, exist_ok=True)
+        # 重复导出同一分区时追加新文件，不覆盖已有文件
+        index = sum(1 for name in os.listdir(directory) if name.endswith('.parquet'))
+        path = os.path.join(directory, f'part-{index:05d}.parquet')
+        self._writer = self._pq.ParquetWriter(path, self.schema, compression=self.compression)
+        self._partition = partition
+        self.files_written += 1
+
+    def _flush(self):
+        if not self._columns[0]:
+            return
+        table = self._pa.Table.from_arrays([self._pa.array(column, type=field.type)
+                                            for column, field in zip(self._columns, self.schema)], schema=self.schema)
+        self._writer.write_table(table)
+        self.rows_written += table.num_rows
+        self._columns = [[] for _ in COLUMNS]
+
+    def write_rows(self, partition: tuple, rows):
+        if partition != self._partition:
+            self._open(partition)
+        for row in rows:
+            for column, value in zip(self._columns, row):
+                column.append(value)
+            if len(self._columns[0]) >= self.batch_rows:
+                self._flush()
+
+    def close(self):
+        if self._writer is not None:
+            self._flush()
+            self._writer.close()
+            self._writer = None
+            self._partition = None
+
+
+async def export_parquet(system: str, start_date: Optional[str], end_date: Optional[str], out: str,
+                         stats_types: List[str], batch_rows: int = 100000, batch_docs: int = 20,
+                         compression: str = 'zstd', read_preference: str = 'secondaryPreferred') -> Dict[str, int]:
+    """导出一个system在日期范围内的统计，返回写入的文件数、行数和文档数"""
+    system = sanitize_key(system)
+    collection = stats_collection.with_options(read_preference=READ_PREFERENCES[read_preference])
+    projection = {'_id': 0}
+    projection.update({f'data.{dimension}': 0 for dimension in USER_DIMENSIONS})
+
+    writer = PartitionedParquetWriter(out, system, batch_rows, compression)
+    documents = 0
+    try:
+        for stats_type in stats_types:
+            query = {'system': system, 'type': stats_type}
+            if start_date or end_date:
+                query['date'] = {}
+                if start_date:
+                    query['date']['$gte'] = start_date
+                if end_date:
+                    query['date']['$lte'] = end_date
+            cursor = collection.find(query, projection).sort('date', 1).batch_size(batch_docs)
+            async for stats in cursor:
+                data = stats.get('data') or {}
+                encoded = collect_keys(data)
+                decoded = await dimension_dictionary.decode(system, encoded, restore_key) if encoded else {}
+                date = stats['date']
+                writer.write_rows((stats_type, date[:len('YYYY-MM')]), to_long_rows(date, stats_type, data, decoded))
+                documents += 1
+    finally:
+        writer.close()
+    return {'files': writer.files_written, 'rows': writer.rows_written, 'documents': documents}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="导出统计为分区Parquet文件（长表）")
+    parser.add_argument('--system', required=True, help="网站名称")
+    parser.add_argument('--start', dest='start_date', help="开始日期 YYYY-MM-DD")
+    parser.add_argument('--end', dest='end_date', help="结束日期 YYYY-MM-DD")
+    parser.add_argument('--out', required=True, help="输出目录")
+    parser.add_argument('--types', default=','.join(EXPORT_TYPES),
+                        help=f"导出的类型，逗号分隔（{', '.join(EXPORT_TYPES)}）")
+    parser.add_argument('--batch-rows', type=int, default=100000, help="每个行组的行数")
+    parser.add_argument('--batch-docs', type=int, default=20, help="每次从MongoDB读取的文档数")
+    parser.add_argument('--compression', default='zstd', help="Parquet压缩算法")
+    parser.add_argument('--read-preference', default='secondaryPreferred', choices=list(READ_PREFERENCES),
+                        help="读取节点偏好，默认优先从节点以免影响线上库")
+    args = parser.parse_args()
+
+    if importlib.util.find_spec('pyarrow') is None:
+        parser.error("pyarrow is required: pip install -r requirements-export.txt")
+    types = [item.strip() for item in args.types.split(',') if item.strip()]
+    unknown = [item for item in types if item not in EXPORT_TYPES]
+    if unknown:
+        parser.error(f"unsupported types: {', '.join(unknown)}")
+
+    logging.basicConfig(level=logging.INFO)
+    result = asyncio.run(export_parquet(args.system, args.start_date, args.end_date, args.out,
+                                        [EXPORT_TYPES[item] for item in types], args.batch_rows, args.batch_docs,
+                                        args.compression, args.read_preference))
+    logger.info(f"导出完成: {result['documents']}个每日文档, {result['rows']}行, {result['files']}个文件")
+
+
+if __name__ == "__main__":
+    main()
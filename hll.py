@@ -0,0 +1,153 @@
+import hashlib
+import math
+import os
+import struct
+from typing import Iterable, Optional
+
+# 唯一用户统计方式：set（$addToSet保存全部指纹，精确）或 hll（HyperLogLog草图，估算）
+UNIQUE_USERS_MODE = os.getenv("UNIQUE_USERS_MODE", "set").lower()
+HLL_ENABLED = UNIQUE_USERS_MODE == "hll"
+# 精度p：寄存器数m=2^p，标准误差约1.04/sqrt(m)（p=12时约1.6%）
+HLL_PRECISION = int(os.getenv("HLL_PRECISION", "12"))
+
+# 二进制格式：[格式, p] + 负载；稠密格式负载为m个寄存器，稀疏格式负载为(下标uint16, 值uint8)序列
+_FORMAT_DENSE = 0
+_FORMAT_SPARSE = 1
+_SPARSE_ENTRY = struct.Struct(">HB")
+
+
+def _hash64(value: str) -> int:
+    """指纹已是md5十六进制串时直接取前64位，否则先做md5"""
+    if len(value) == 32:
+        try:
+            return int(value[:16], 16)
+        except ValueError:
+            pass
+    return int(hashlib.md5(value.encode()).hexdigest()[:16], 16)
+
+
+def new_registers(precision: int = HLL_PRECISION) -> bytearray:
+    return bytearray(1 << precision)
+
+
+def add(registers: bytearray, value: str):
+    """将一个值加入草图"""
+    precision = (len(registers) - 1).bit_length()
+    h = _hash64(value)
+    index = h >> (64 - precision)
+    rest_bits = 64 - precision
+    rest = h & ((1 << rest_bits) - 1)
+    rank = rest_bits - rest.bit_length() + 1
+    if rank > registers[index]:
+        registers[index] = rank
+
+
+def merge(registers: bytearray, other: bytearray):
+    """按寄存器取最大值合并（精度不同时按较低精度折叠）"""
+    if len(other) != len(registers):
+        other = _fold(other, len(registers))
+    for index, rank in enumerate(other):
+        if rank > registers[index]:
+            registers[index] = rank
+
+
+def _fold(registers: bytearray, size: int) -> bytearray:
+    """将高精度草图折叠为低精度（无法提升精度）"""
+    if len(registers) < size:
+        raise ValueError("Cannot merge a lower precision sketch into a higher precision one")
+    shift = (len(registers) // size).bit_length() - 1
+    folded = bytearray(size)
+    for index, rank in enumerate(registers):
+        if rank:
+            # 高精度下标的低位移入rank计算
+            low_bits = index & ((1 << shift) - 1)
+            new_rank = rank + shift if low_bits == 0 else shift - low_bits.bit_length() + 1
+            target = index >> shift
+            if new_rank > folded[target]:
+                folded[target] = new_rank
+    return folded
+
+
+def estimate(registers: bytearray) -> int:
+    """估算基数（含小基数线性计数修正）"""
+    m = len(registers)
+    if m >= 128:
+        alpha = 0.7213 / (1 + 1.079 / m)
+    else:
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213)
+    total = 0.0
+    zeros = 0
+    for rank in registers:
+        total += 2.0 ** -rank
+        if rank == 0:
+            zeros += 1
+    result = alpha * m * m / total
+    if result <= 2.5 * m and zeros:
+        result = m * math.log(m / zeros)
+    return int(round(result))
+
+
+def encode(registers: bytearray) -> bytes:
+    """序列化为BSON二进制，非零寄存器较少时使用稀疏格式"""
+    precision = (len(registers) - 1).bit_length()
+    non_zero = [(index, rank) for index, rank in enumerate(registers) if rank]
+    if len(non_zero) * _SPARSE_ENTRY.size < len(registers):
+        return bytes([_FORMAT_SPARSE, precision]) + b"".join(
+            _SPARSE_ENTRY.pack(index, rank) for index, rank in non_zero
+        )
+    return bytes([_FORMAT_DENSE, precision]) + bytes(registers)
+
+
+def decode(data: bytes) -> bytearray:
+    data = bytes(data)
+    fmt, precision = data[0], data[1]
+    if fmt == _FORMAT_DENSE:
+        return bytearray(data[2:])
+    registers = new_registers(precision)
+    for index, rank in _SPARSE_ENTRY.iter_unpack(data[2:]):
+        registers[index] = rank
+    return registers
+
+
+class UniqueUserCounter:
+    """
+    统计查询中聚合唯一用户的计数器，兼容旧数据
+    只有指纹列表时精确计数；一旦合并过HLL草图，则把指纹也加入草图并返回估算值
+    """
+
+    def __init__(self):
+        self.values = set()
+        self.registers: Optional[bytearray] = None
+
+    def update(self, users: Iterable[str]):
+        self.values.update(users)
+
+    def merge_sketch(self, data: bytes):
+        sketch = decode(data)
+        if self.registers is None:
+            self.registers = sketch
+        elif len(sketch) < len(self.registers):
+            # 精度不同时统一折叠到较低精度
+            self.registers = _fold(self.registers, len(sketch))
+            merge(self.registers, sketch)
+        else:
+            merge(self.registers, sketch)
+
+    def __len__(self) -> int:
+        if self.registers is None:
+            return len(self.values)
+        for value in self.values:
+            add(self.registers, value)
+        self.values.clear()
+        return estimate(self.registers)
+
+
+def count_unique(users: Optional[Iterable[str]], sketch: Optional[bytes]) -> int:
+    """计算单日单个维度的唯一用户数（指纹列表和/或草图）"""
+    if not sketch:
+        return len(users) if users else 0
+    counter = UniqueUserCounter()
+    counter.merge_sketch(sketch)
+    if users:
+        counter.update(users)
+    return len(counter)
@@ -26,6 +26,21 @@ client = AsyncIOMotorClient(MONGODB_URI, **MONGODB_OPTIONS)
 db = client["page_monitor"]
 stats_collection = db["monitor_stats"]
 
+# 按用户指纹的高基数维度集合（按system+date+type+dimension+bucket分桶存储，只在下钻查询时读取）
+user_stats_collection = db["monitor_user_stats"]
+
+# 按小时分桶的统计集合（date为YYYY-MM-DDTHH，已结束的小时由后台任务汇总进monitor_stats）
+hourly_stats_collection = db["monitor_hourly_stats"]
+
+# 周/月汇总集合（按system+type+period+start存储已结束周期合并后的统计）
+period_stats_collection = db["monitor_period_stats"]
+
+# 维度值字典集合（按system把维度值映射为小整数id，启用STATS_DIMENSION_DICTIONARY时统计文档以id为键）
+dimension_dict_collection = db["monitor_dimension_dict"]
+
+# 后台任务状态集合（如按system删除统计数据的进度，所有worker共享）
+jobs_collection = db["monitor_jobs"]
+
 # 网站信息集合（存储site_name, site_url, creator, api_key等）
 sites_collection = db["sites"]
 
@@ -46,7 +61,34 @@ async def init_db():
         await stats_collection.create_index([("type", 1)], background=True)
         # 为lastUpdated字段创建索引，方便按时间排序
         await stats_collection.create_index([("lastUpdated", -1)], background=True)
+
+        # 分桶用户维度文档：写入按五元组upsert，查询按system+type+日期范围
+        await user_stats_collection.create_index(
+            [("system", 1), ("date", 1), ("type", 1), ("dimension", 1), ("bucket", 1)], unique=True, background=True
+        )
+        await user_stats_collection.create_index([("system", 1), ("type", 1), ("date", 1)], background=True)
+
+        # 小时文档：同一小时只有一个接收写入（active）的文档，冻结后迟到的写入会创建新文档
+        await hourly_stats_collection.create_index(
+            [("system", 1), ("date", 1), ("type", 1)], unique=True, background=True,
+            partialFilterExpression={"active": True}, name="system_date_type_active"
+        )
+        await hourly_stats_collection.create_index([("system", 1), ("type", 1), ("date", 1)], background=True)
+        await hourly_stats_collection.create_index([("date", 1)], background=True)
+
+        # 周/月汇总文档
+        await period_stats_collection.create_index(
+            [("system", 1), ("type", 1), ("period", 1), ("start", 1)], unique=True, background=True
+        )
+        await period_stats_collection.create_index([("system", 1), ("type", 1), ("start", 1), ("end", 1)], background=True)
+
+        # 维度值字典：写入时按值查id，读取时按id查值
+        await dimension_dict_collection.create_index([("system", 1), ("value", 1)], unique=True, background=True)
+        await dimension_dict_collection.create_index([("system", 1), ("id", 1)], unique=True, background=True)
         
+        # 后台任务：按system查询进行中的任务
+        await jobs_collection.create_index([("system", 1), ("status", 1)], background=True)
+
         # 为sites_collection的字段添加索引
         await sites_collection.create_index([("site_name", 1)], unique=True, background=True)  # 网站名称唯一
         await sites_collection.create_index([("api_key", 1)], unique=True, background=True)    # API密钥唯一
@@ -0,0 +1,282 @@
+"""
+慢查询性能分析（默认关闭）
+对 /api/stats/* 请求按比例或按耗时阈值做性能分析，结果保存在本地目录，管理员可以通过 /api/profiles 查看最近的记录：
+- cprofile：确定性分析，保存为pstats文件（python -m pstats 或 snakeviz 打开），开销较大
+- sampler：后台线程按间隔采样事件循环线程的调用栈，保存为折叠栈文件（flamegraph.pl / speedscope 打开），开销小；
+  等待MongoDB返回的时间表现为事件循环的select帧
+分析的是整个事件循环线程，同一时间只分析一个请求，期间并发执行的其他请求也会计入
+"""
+import asyncio
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import APIRouter, HTTPException, Request
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import FileResponse
+
+from security import get_current_user, require_login
+
+# 分析方式：cprofile或sampler，为空则不启用
+STATS_PROFILE_MODE = os.getenv("STATS_PROFILE_MODE", "").lower()
+STATS_PROFILE_PATH_PREFIX = os.getenv("STATS_PROFILE_PATH_PREFIX", "/api/stats/")  # 分析的请求路径前缀
+STATS_PROFILE_SAMPLE_RATE = float(os.getenv("STATS_PROFILE_SAMPLE_RATE", "0"))  # 不论快慢都保存的请求比例
+STATS_PROFILE_SLOW_SECONDS = float(os.getenv("STATS_PROFILE_SLOW_SECONDS", "1.0"))  # 超过该耗时的请求保存结果，0表示只按比例
+STATS_PROFILE_INTERVAL = float(os.getenv("STATS_PROFILE_INTERVAL", "0.005"))  # sampler的采样间隔（秒）
+STATS_PROFILE_DIR = os.getenv("STATS_PROFILE_DIR", "profiles")  # 结果保存目录
+STATS_PROFILE_MAX_CAPTURES = int(os.getenv("STATS_PROFILE_MAX_CAPTURES", "200"))  # 最多保留的记录数，超过时删除最早的
+
+PROFILE_MODES = ('cprofile', 'sampler')
+STATS_PROFILE_ENABLED = STATS_PROFILE_MODE in PROFILE_MODES
+# 记录中列出的耗时最多的函数数
+SUMMARY_ENTRIES = 15
+
+logger = logging.getLogger(__name__)
+
+profiler_router = APIRouter(prefix="/api")
+
+
+class StackSampler(threading.Thread):
+    """按固定间隔采样指定线程的调用栈，按折叠栈（根在前，;分隔）计数"""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(daemon=True)
+        self._thread_id = thread_id
+        self._interval = interval
+        self._stop_event = threading.Event()
+        self.stacks = Counter()
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                name = getattr(code, 'co_qualname', code.co_name)
+                stack.append(f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class _Capture:
+    """一次请求的分析过程"""
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self._profile: Optional[cProfile.Profile] = None
+        self._sampler: Optional[StackSampler] = None
+
+    def start(self):
+        if self.mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._sampler = StackSampler(threading.get_ident(), STATS_PROFILE_INTERVAL)
+            self._sampler.start()
+
+    def stop(self):
+        if self._profile:
+            self._profile.disable()
+        else:
+            self._sampler.stop()
+
+    def write(self, path_prefix: str) -> Tuple[str, List[Dict[str, Any]]]:
+        """写入结果文件，返回 (文件名, 耗时最多的函数)"""
+        if self._profile:
+            filename = path_prefix + '.pstats'
+            self._profile.dump_stats(filename)
+            stats = pstats.Stats(self._profile, stream=io.StringIO())
+            entries = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:SUMMARY_ENTRIES]
+            summary = [{'function': f"{name} ({os.path.basename(file)}:{line})", 'calls': calls,
+                        'self_seconds': round(self_time, 6), 'cumulative_seconds': round(cumulative, 6)}
+                       for (file, line, name), (_, calls, self_time, cumulative, _) in entries]
+        else:
+            filename = path_prefix + '.collapsed'
+            with open(filename, 'w', encoding='utf-8') as f:
+                for stack, count in self._sampler.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            # 按栈顶函数（自身耗时）汇总
+            leaves = Counter()
+            for stack, count in self._sampler.stacks.items():
+                leaves[stack.rsplit(';', 1)[-1]] += count
+            summary = [{'function': function, 'samples': count,
+                        'self_seconds': round(count * STATS_PROFILE_INTERVAL, 6)}
+                       for function, count in leaves.most_common(SUMMARY_ENTRIES)]
+        return os.path.basename(filename), summary
+
+
+class StatsProfiler:
+    """决定是否分析、保存结果并清理旧记录"""
+
+    def __init__(self, directory: str, max_captures: int):
+        self.directory = directory
+        self.max_captures = max_captures
+        self._active = False  # 同一时间只分析一个请求
+        self.metrics = {'profiled': 0, 'saved_slow': 0, 'saved_sampled': 0, 'skipped_busy': 0, 'errors': 0}
+
+    def should_profile(self) -> Optional[bool]:
+        """返回None表示不分析，否则返回是否为按比例抽中的请求（抽中的请求不论快慢都保存）"""
+        sampled = STATS_PROFILE_SAMPLE_RATE > 0 and random.random() < STATS_PROFILE_SAMPLE_RATE
+        if not sampled and STATS_PROFILE_SLOW_SECONDS <= 0:
+            return None
+        if self._active:
+            self.metrics['skipped_busy'] += 1
+            return None
+        return sampled
+
+    def begin(self) -> _Capture:
+        capture = _Capture(STATS_PROFILE_MODE)
+        capture.start()
+        self._active = True
+        self.metrics['profiled'] += 1
+        return capture
+
+    def end(self, capture: _Capture):
+        capture.stop()
+        self._active = False
+
+    def save(self, capture: _Capture, request: Request, status_code: int, duration: float, reason: str):
+        """写入结果文件和记录（在线程中执行）"""
+        os.makedirs(self.directory, exist_ok=True)
+        created = datetime.utcnow()
+        capture_id = f"{created.strftime('%Y%m%dT%H%M%S%f')}-{secrets.token_hex(4)}"
+        filename, summary = capture.write(os.path.join(self.directory, capture_id))
+        record = {
+            'id': capture_id,
+            'created': created.isoformat(),
+            'pid': os.getpid(),
+            'mode': capture.mode,
+            'reason': reason,
+            'method': request.method,
+            'path': request.url.path,
+            'query': request.url.query,
+            'status_code': status_code,
+            'duration_seconds': round(duration, 6),
+            'file': filename,
+            'top_functions': summary,
+        }
+        with open(os.path.join(self.directory, capture_id + '.json'), 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False)
+        self._prune()
+
+    def _prune(self):
+        records = sorted(name for name in os.listdir(self.directory) if name.endswith('.json'))
+        for name in records[:max(0, len(records) - self.max_captures)]:
+            capture_id = name[:-len('.json')]
+            for suffix in ('.json', '.pstats', '.collapsed'):
+                try:
+                    os.remove(os.path.join(self.directory, capture_id + suffix))
+                except FileNotFoundError:
+                    pass
+
+    def list_captures(self, limit: int) -> List[Dict[str, Any]]:
+        """最近的记录（所有worker写入同一目录），按时间倒序"""
+        if not os.path.isdir(self.directory):
+            return []
+        records = []
+        for name in sorted((name for name in os.listdir(self.directory) if name.endswith('.json')), reverse=True):
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                    records.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # 正在写入或已被清理
+            if len(records) >= limit:
+                break
+        return records
+
+    def capture_path(self, capture_id: str) -> Optional[str]:
+        """结果文件路径（只接受list_captures返回的id）"""
+        if not capture_id.replace('-', '').isalnum():
+            return None
+        for suffix in ('.pstats', '.collapsed'):
+            path = os.path.join(self.directory, capture_id + suffix)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return dict(self.metrics, mode=STATS_PROFILE_MODE, sample_rate=STATS_PROFILE_SAMPLE_RATE,
+                    slow_seconds=STATS_PROFILE_SLOW_SECONDS)
+
+
+stats_profiler = StatsProfiler(STATS_PROFILE_DIR, STATS_PROFILE_MAX_CAPTURES)
+
+
+class StatsProfilerMiddleware(BaseHTTPMiddleware):
+    """分析路径匹配的请求，慢请求或按比例抽中的请求保存结果"""
+
+    async def dispatch(self, request: Request, call_next):
+        if not request.url.path.startswith(STATS_PROFILE_PATH_PREFIX):
+            return await call_next(request)
+        sampled = stats_profiler.should_profile()
+        if sampled is None:
+            return await call_next(request)
+
+        try:
+            capture = stats_profiler.begin()
+        except Exception as e:
+            # 例如已有其他分析工具（调试器、覆盖率）占用
+            stats_profiler.metrics['errors'] += 1
+            logger.warning(f"启动性能分析失败: {e}")
+            return await call_next(request)
+        started = time.perf_counter()
+        try:
+            response = await call_next(request)
+        finally:
+            duration = time.perf_counter() - started
+            stats_profiler.end(capture)
+
+        if sampled or duration >= STATS_PROFILE_SLOW_SECONDS > 0:
+            reason = 'slow' if STATS_PROFILE_SLOW_SECONDS > 0 and duration >= STATS_PROFILE_SLOW_SECONDS else 'sampled'
+            try:
+                await asyncio.to_thread(stats_profiler.save, capture, request, response.status_code, duration, reason)
+                stats_profiler.metrics[f'saved_{reason}'] += 1
+            except Exception as e:
+                stats_profiler.metrics['errors'] += 1
+                logger.error(f"保存性能分析结果失败: {e}", exc_info=True)
+        return response
+
+
+async def _require_admin(request: Request):
+    current_user = await get_current_user(request)
+    if not getattr(current_user, 'is_super', False):
+        raise HTTPException(status_code=403, detail="只有管理员可以查看性能分析结果")
+
+
+@profiler_router.get("/profiles")
+@require_login()
+async def list_profiles(request: Request, limit: int = 20):
+    """最近保存的性能分析记录（含耗时最多的函数）"""
+    await _require_admin(request)
+    return {
+        "enabled": STATS_PROFILE_ENABLED,
+        "metrics": stats_profiler.get_metrics(),
+        "captures": await asyncio.to_thread(stats_profiler.list_captures, max(1, min(limit, 200))),
+    }
+
+
+@profiler_router.get("/profiles/{capture_id}")
+@require_login()
+async def download_profile(request: Request, capture_id: str):
+    """下载pstats或折叠栈文件"""
+    await _require_admin(request)
+    path = stats_profiler.capture_path(capture_id)
+    if not path:
+        raise HTTPException(status_code=404, detail="记录不存在")
+    return FileResponse(path, filename=os.path.basename(path), media_type='application/octet-stream')
@@ -72,6 +72,11 @@ function getSelectedDateRange() {
 }
 
 // 加载数据
+// 当前摘要查询的参数，按用户下钻时复用
+let currentQueryParams = null;
+// 已加载按用户数据的标签（重新加载数据后重置）
+let loadedUserDrilldowns = new Set();
+
 async function loadData() {
     try {
         // 显示加载状态
@@ -140,6 +145,9 @@ async function loadData() {
             usernameElement.textContent = username;
         }
         
+        currentQueryParams = new URLSearchParams(queryParams);
+        loadedUserDrilldowns = new Set();
+
         // 构建API URL（使用相对路径，确保在Docker容器内正常工作）
         const apiBaseUrl = 'api/stats';
         const pageviewUrl = `${apiBaseUrl}/pageview?${queryParams.toString()}`;
@@ -201,6 +209,40 @@ async function loadData() {
     }
 }
 
+// 按用户下钻：摘要查询不返回按用户的维度，切换到“按用户”标签时再带include_users=true查询
+async function loadUserDrilldown(tabId) {
+    const drilldownTypes = {
+        users: ['pageview', 'duration'],
+        downloadUsers: ['downloads'],
+        eventUsers: ['events']
+    };
+    const types = drilldownTypes[tabId];
+    if (!types || !currentQueryParams || loadedUserDrilldowns.has(tabId)) {
+        return;
+    }
+    loadedUserDrilldowns.add(tabId);
+    try {
+        const queryParams = new URLSearchParams(currentQueryParams);
+        queryParams.append('include_users', 'true');
+        const responses = await Promise.all(types.map(type => apiFetch(`api/stats/${type}?${queryParams.toString()}`)));
+        if (responses.some(response => !response.ok)) {
+            throw new Error(`Failed to fetch user data: ${responses.map(response => response.status).join(', ')}`);
+        }
+        const [data, durationData] = await Promise.all(responses.map(response => response.json()));
+        if (tabId === 'users') {
+            renderPageviewCharts(data, durationData);
+        } else if (tabId === 'downloadUsers') {
+            renderDownloadCharts(data);
+        } else {
+            renderEventCharts(data);
+        }
+    } catch (error) {
+        // 失败后允许再次点击重试
+        loadedUserDrilldowns.delete(tabId);
+        console.error('加载按用户数据失败:', error);
+    }
+}
+
 // 渲染所有图表
 function renderCharts(pageviewData, downloadData, eventData, durationData) {
     renderPageviewCharts(pageviewData, durationData);
@@ -336,6 +378,7 @@ function updatePageviewTable(pageviewData, durationData) {
     
     // 获取页面URL数据和用户数据
     const urls = pageviewData.urls || {};
+    const urlUniqueUsers = pageviewData.byUrlUniqueUsers || {};
     const urlUsers = pageviewData.byUrlAndUser || {};
     const urlDurations = durationData ? durationData.byUrl || {} : {};
     
@@ -350,7 +393,7 @@ function updatePageviewTable(pageviewData, durationData) {
         return {
             url: url,
             totalViews: urls[url] || 0,
-            uniqueUsers: urlUsers[url] ? Object.keys(urlUsers[url]).length : 0,
+            uniqueUsers: url in urlUniqueUsers ? urlUniqueUsers[url] : (urlUsers[url] ? Object.keys(urlUsers[url]).length : 0),
             avgDuration: avgDuration
         };
     });
@@ -402,6 +445,10 @@ function updateEventTable(eventData) {
     // 从byCategoryAndAction中提取数据
     const eventEntries = [];
     
+    // 优先使用接口返回的唯一用户数，旧接口才需要从按用户的明细中计算
+    const byCategoryAndActionUniqueUsers = eventData.byCategoryAndActionUniqueUsers || {};
+    const byCategoryUniqueUsers = eventData.byCategoryUniqueUsers || {};
+    const byActionUniqueUsers = eventData.byActionUniqueUsers || {};
     const byCategoryAndActionAndUser = eventData.byCategoryAndActionAndUser || {};
     
     // 添加类别和动作的组合数据
@@ -410,7 +457,9 @@ function updateEventTable(eventData) {
             for (const [action, count] of Object.entries(actions)) {
                 // 计算该类别和动作组合的唯一用户数
                 let userCount = 0;
-                if (byCategoryAndActionAndUser[category] && byCategoryAndActionAndUser[category][action]) {
+                if (byCategoryAndActionUniqueUsers[category] && action in byCategoryAndActionUniqueUsers[category]) {
+                    userCount = byCategoryAndActionUniqueUsers[category][action];
+                } else if (byCategoryAndActionAndUser[category] && byCategoryAndActionAndUser[category][action]) {
                     userCount = Object.keys(byCategoryAndActionAndUser[category][action]).length;
                 }
                 
@@ -431,7 +480,9 @@ function updateEventTable(eventData) {
             for (const [category, count] of Object.entries(eventData.byCategory)) {
                 // 计算该类别的唯一用户数
                 let userCount = 0;
-                if (byCategoryAndActionAndUser[category]) {
+                if (category in byCategoryUniqueUsers) {
+                    userCount = byCategoryUniqueUsers[category];
+                } else if (byCategoryAndActionAndUser[category]) {
                     userCount = new Set();
                     for (const [action, users] of Object.entries(byCategoryAndActionAndUser[category])) {
                         Object.keys(users).forEach(user => userCount.add(user));
@@ -459,7 +510,7 @@ function updateEventTable(eventData) {
                         Object.keys(actions[action]).forEach(user => usersSet.add(user));
                     }
                 }
-                userCount = usersSet.size;
+                userCount = action in byActionUniqueUsers ? byActionUniqueUsers[action] : usersSet.size;
                 
                 eventEntries.push({
                     category: t('allCategories'),
@@ -94,6 +94,11 @@ function setupTabs() {
             } else if (tabId === 'eventCombinations' && eventCombinationChart) {
                 eventCombinationChart.update();
             }
+
+            // 按用户的标签在切换时才加载用户维度数据
+            if (typeof loadUserDrilldown === 'function') {
+                loadUserDrilldown(tabId);
+            }
         });
     });
 }
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import os
+from datetime import date as date_type, datetime, timedelta
+from typing import Any, Dict, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DocumentTooLarge
+
+from batch import USER_DIMENSIONS
+from mongodb import (stats_collection, user_stats_collection, hourly_stats_collection, period_stats_collection,
+                     sites_collection)
+from rollup import (STATS_PERIOD_ROLLUP_LAG_DAYS, PeriodCompactor, merge_stats_data, period_bounds, to_hour_range,
+                    _format_date, _parse_date)
+
+# 保留策略：站点设置retention_days后，早于该天数的每日文档按自然月合并为归档的月汇总（不含按用户指纹的维度），
+# 然后删除原每日文档、用户维度分桶和小时文档；启用后查询会读取归档的月汇总
+STATS_RETENTION = os.getenv("STATS_RETENTION", "False").lower() == "true"
+STATS_RETENTION_INTERVAL = float(os.getenv("STATS_RETENTION_INTERVAL", "21600"))  # 保留任务的执行间隔（秒）
+STATS_RETENTION_BATCH_SIZE = int(os.getenv("STATS_RETENTION_BATCH_SIZE", "200"))  # 每批删除的文档数
+STATS_RETENTION_BATCH_PAUSE = float(os.getenv("STATS_RETENTION_BATCH_PAUSE", "0.5"))  # 每批之间的暂停（秒），降低对线上库的影响
+
+logger = logging.getLogger(__name__)
+
+
+async def has_archived_months(system: str, stats_type: str, start_date: Optional[str], end_date: Optional[str]) -> bool:
+    """日期范围内是否有已归档（每日文档已删除）的月份"""
+    query = {'system': system, 'type': stats_type, 'period': 'month', 'archived': True}
+    if start_date:
+        query['end'] = {'$gte': start_date}
+    if end_date:
+        query['start'] = {'$lte': end_date}
+    return await period_stats_collection.find_one(query, {'_id': 1}) is not None
+
+
+class StatsRetention:
+    """
+    按站点保留策略归档旧的每日文档
+    每个月先生成（或补齐）月汇总并标记为archived，再分批删除汇总时已包含的每日文档；
+    汇总之后才写入的迟到文档在下一轮合并进归档汇总后再删除，不会丢失
+    """
+
+    def __init__(self, compactor: PeriodCompactor):
+        self._compactor = compactor
+        self._task: Optional[asyncio.Task] = None
+        self.metrics = {
+            'runs': 0,
+            'sites_processed': 0,
+            'months_archived': 0,
+            'late_documents_merged': 0,
+            'documents_deleted': 0,
+            'user_documents_deleted': 0,
+            'hourly_documents_deleted': 0,
+            'errors': 0,
+            'last_run_time': None,
+            # 当前正在处理的站点/类型/月份（空闲时为None）
+            'progress': None,
+        }
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Stats retention task started")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Stats retention failed: {e}", exc_info=True)
+            await asyncio.sleep(STATS_RETENTION_INTERVAL)
+
+    async def run_once(self, today: Optional[date_type] = None):
+        """对所有设置了retention_days的站点执行一次保留策略"""
+        today = today or datetime.utcnow().date()
+        async for site in sites_collection.find({'retention_days': {'$gt': 0}},
+                                                {'_id': 0, 'site_name': 1, 'retention_days': 1}):
+            try:
+                await self.apply_site(site['site_name'], site['retention_days'], today)
+                self.metrics['sites_processed'] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Stats retention for {site['site_name']} failed: {e}", exc_info=True)
+                self.metrics['errors'] += 1
+        self.metrics['progress'] = None
+        self.metrics['runs'] += 1
+        self.metrics['last_run_time'] = datetime.utcnow().isoformat()
+
+    async def apply_site(self, system: str, retention_days: int, today: date_type):
+        """归档结束日期早于保留期（且已超过汇总等待期）的所有自然月"""
+        cutoff = today - timedelta(days=max(retention_days, STATS_PERIOD_ROLLUP_LAG_DAYS + 1))
+        cursor = stats_collection.aggregate([
+            {'$match': {'system': system, 'date': {'$lt': _format_date(cutoff)}}},
+            {'$group': {'_id': '$type', 'first': {'$min': '$date'}}}
+        ])
+        async for group in cursor:
+            start, end = period_bounds('month', _parse_date(group['first'][:len('YYYY-MM-DD')]))
+            while end < cutoff:
+                await self._archive_month(system, group['_id'], _format_date(start), _format_date(end))
+                start, end = period_bounds('month', end + timedelta(days=1))
+
+    async def _archive_month(self, system: str, stats_type: str, start: str, end: str):
+        key = {'system': system, 'type': stats_type, 'period': 'month', 'start': start}
+        self.metrics['progress'] = {'system': system, 'type': stats_type, 'month': start[:len('YYYY-MM')],
+                                    'deleted': 0}
+        rollup = await period_stats_collection.find_one(key, {'_id': 0, 'archived': 1, 'sourceLastUpdated': 1})
+        if rollup and rollup.get('archived'):
+            rollup = await self._merge_late_documents(key, rollup, start, end)
+        else:
+            await self._compactor.ensure_period(system, stats_type, 'month', start, end)
+            rollup = await period_stats_collection.find_one_and_update(
+                key, {'$set': {'archived': True}}, projection={'_id': 0, 'sourceLastUpdated': 1},
+                return_document=ReturnDocument.AFTER
+            )
+            if rollup:
+                self.metrics['months_archived'] += 1
+        if not rollup:
+            # 该月没有每日文档、汇总文档过大无法生成或合并迟到文档时有并发修改，本轮保留每日文档
+            return
+
+        date_range = {'$gte': start, '$lte': end}
+        result = await user_stats_collection.delete_many({'system': system, 'type': stats_type,
+                                                          'date': to_hour_range(date_range)})
+        self.metrics['user_documents_deleted'] += result.deleted_count
+        result = await hourly_stats_collection.delete_many({'system': system, 'type': stats_type,
+                                                            'date': to_hour_range(date_range)})
+        self.metrics['hourly_documents_deleted'] += result.deleted_count
+
+        # 只删除汇总时已包含的每日文档（lastUpdated不晚于汇总的来源时间）
+        daily_query = {'system': system, 'type': stats_type, 'date': date_range,
+                       'lastUpdated': {'$lte': rollup['sourceLastUpdated']}}
+        while True:
+            ids = [doc['_id'] async for doc in stats_collection.find(daily_query, {'_id': 1}).limit(STATS_RETENTION_BATCH_SIZE)]
+            if not ids:
+                break
+            result = await stats_collection.delete_many({'_id': {'$in': ids}})
+            self.metrics['documents_deleted'] += result.deleted_count
+            self.metrics['progress']['deleted'] += result.deleted_count
+            await asyncio.sleep(STATS_RETENTION_BATCH_PAUSE)
+
+    async def _merge_late_documents(self, key: Dict[str, Any], rollup: Dict[str, Any], start: str,
+                                    end: str) -> Optional[Dict[str, Any]]:
+        """把归档后迟到写入的每日文档合并进归档汇总，返回更新后的汇总（并发修改或过大时返回None，下一轮重试）"""
+        late_query = {'system': key['system'], 'type': key['type'], 'date': {'$gte': start, '$lte': end},
+                      'lastUpdated': {'$gt': rollup['sourceLastUpdated']}}
+        late_documents = [doc async for doc in stats_collection.find(
+            late_query, {'_id': 0, 'date': 1, 'data': 1, 'lastUpdated': 1}).sort('date', 1)]
+        if not late_documents:
+            return rollup
+
+        archived = await period_stats_collection.find_one(key, {'_id': 0})
+        data, trend = archived.get('data', {}), archived.get('trend', [])
+        trend_dates = {entry.get('date') for entry in trend}
+        source_last_updated = archived['sourceLastUpdated']
+        for stats in late_documents:
+            stats_data = stats.get('data', {})
+            for dimension in USER_DIMENSIONS:
+                stats_data.pop(dimension, None)
+            merge_stats_data(data, stats_data)
+            # 同一天已删除的每日文档的趋势数据已在汇总中，只为新出现的日期补充趋势
+            if stats['date'] not in trend_dates:
+                trend.append(self._compactor.build_trend(key['type'], stats['date'], stats_data))
+            source_last_updated = max(source_last_updated, stats['lastUpdated'])
+        trend.sort(key=lambda entry: entry.get('date', ''))
+
+        try:
+            result = await period_stats_collection.update_one(
+                dict(key, sourceLastUpdated=archived['sourceLastUpdated']),
+                {'$set': {'data': data, 'trend': trend, 'days': len(trend), 'sourceLastUpdated': source_last_updated,
+                          'builtAt': datetime.utcnow()}}
+            )
+        except DocumentTooLarge:
+            logger.warning(f"Archived rollup too large to merge late documents, skipped: {key}")
+            self.metrics['errors'] += 1
+            return None
+        if not result.matched_count:
+            return None
+        self.metrics['late_documents_merged'] += len(late_documents)
+        return {'sourceLastUpdated': source_last_updated}
+
+    def get_metrics(self) -> Dict[str, Any]:
+        metrics = self.metrics.copy()
+        metrics['progress'] = dict(metrics['progress']) if metrics['progress'] else None
+        return metrics
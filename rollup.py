@@ -0,0 +1,424 @@
+import asyncio
+import logging
+import os
+from datetime import date as date_type, datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bson import Binary
+from pymongo.errors import DocumentTooLarge, DuplicateKeyError
+
+import hll
+from batch import HLL_CAS_MAX_ATTEMPTS, USER_DIMENSIONS, _get_path
+from mongodb import stats_collection, hourly_stats_collection, period_stats_collection
+
+# 按小时分桶：写入(system, YYYY-MM-DDTHH, type)小时文档，后台任务把已结束的小时汇总进每日文档
+STATS_HOURLY_BUCKETS = os.getenv("STATS_HOURLY_BUCKETS", "False").lower() == "true"
+STATS_ROLLUP_INTERVAL = float(os.getenv("STATS_ROLLUP_INTERVAL", "300"))  # 汇总任务的执行间隔（秒）
+STATS_ROLLUP_DELAY = float(os.getenv("STATS_ROLLUP_DELAY", "120"))  # 小时结束后等待批处理刷新的时间（秒）
+STATS_HOURLY_RETENTION_HOURS = int(os.getenv("STATS_HOURLY_RETENTION_HOURS", "48"))  # 已汇总小时文档的保留时间
+# 周/月汇总：后台为已结束的周和月预先合并每日文档，长日期范围的查询读取汇总文档
+STATS_PERIOD_ROLLUPS = os.getenv("STATS_PERIOD_ROLLUPS", "False").lower() == "true"
+STATS_PERIOD_ROLLUP_INTERVAL = float(os.getenv("STATS_PERIOD_ROLLUP_INTERVAL", "3600"))  # 周/月汇总任务的执行间隔（秒）
+STATS_PERIOD_ROLLUP_LAG_DAYS = int(os.getenv("STATS_PERIOD_ROLLUP_LAG_DAYS", "1"))  # 周期结束后等待迟到写入的天数
+STATS_PERIOD_TREND_TOP = int(os.getenv("STATS_PERIOD_TREND_TOP", "50"))  # 汇总文档中每天趋势数据保留的子类别条目数
+
+HOUR_BUCKET_FORMAT = '%Y-%m-%dT%H'
+DAY_BUCKET_FORMAT = '%Y-%m-%d'
+
+logger = logging.getLogger(__name__)
+
+
+def current_bucket(now: Optional[datetime] = None) -> str:
+    """当前写入的时间分片：按小时分桶时为 YYYY-MM-DDTHH，否则为 YYYY-MM-DD"""
+    now = now or datetime.utcnow()
+    return now.strftime(HOUR_BUCKET_FORMAT if STATS_HOURLY_BUCKETS else DAY_BUCKET_FORMAT)
+
+
+def to_hour_range(date_query: Optional[Dict[str, str]]) -> Dict[str, str]:
+    """把按天的日期范围条件转换为小时文档的范围（结束日期包含当天所有小时）"""
+    hour_query = {}
+    for op, value in (date_query or {}).items():
+        if op == '$lte' and len(value) == len('YYYY-MM-DD'):
+            value = f"{value}T23"
+        hour_query[op] = value
+    return hour_query
+
+
+def _parse_date(value: str) -> date_type:
+    return datetime.strptime(value, DAY_BUCKET_FORMAT).date()
+
+
+def _format_date(value: date_type) -> str:
+    return value.strftime(DAY_BUCKET_FORMAT)
+
+
+def period_bounds(period: str, day: date_type) -> Tuple[date_type, date_type]:
+    """返回包含day的周（周一到周日）或自然月的起止日期"""
+    if period == 'week':
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=6)
+    start = day.replace(day=1)
+    next_month = (start + timedelta(days=32)).replace(day=1)
+    return start, next_month - timedelta(days=1)
+
+
+def merge_stats_data(target: Dict[str, Any], source: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    把一个统计文档的data合并到另一个（原地修改target）
+    数值相加，指纹列表取并集，HLL草图按寄存器取最大值
+    """
+    for key, value in source.items():
+        if key not in target:
+            target[key] = value
+            continue
+        existing = target[key]
+        if isinstance(existing, dict) and isinstance(value, dict):
+            merge_stats_data(existing, value)
+        elif isinstance(existing, bytes) and isinstance(value, bytes):
+            registers = hll.decode(existing)
+            hll.merge(registers, hll.decode(value))
+            target[key] = Binary(hll.encode(registers))
+        elif isinstance(existing, list) and isinstance(value, list):
+            target[key] = list(dict.fromkeys(existing + value))
+        elif isinstance(existing, (int, float)) and isinstance(value, (int, float)):
+            target[key] = existing + value
+        else:
+            target[key] = value
+    return target
+
+
+def flatten_stats_data(data: Dict[str, Any], prefix: str = 'data') -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, bytearray]]:
+    """
+    把小时文档的data展开为每日文档的更新操作
+
+    Returns:
+        tuple: ($inc字段, $addToSet字段, {草图路径: 寄存器})
+    """
+    counters, unique_users, sketches = {}, {}, {}
+    stack = [(prefix, data)]
+    while stack:
+        path, value = stack.pop()
+        if isinstance(value, dict):
+            stack.extend((f"{path}.{key}", item) for key, item in value.items())
+        elif isinstance(value, bytes):
+            sketches[path] = hll.decode(value)
+        elif isinstance(value, list):
+            unique_users[path] = {'$each': value}
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            counters[path] = value
+    return counters, unique_users, sketches
+
+
+class StatsRollup:
+    """
+    小时文档汇总任务
+    1. 冻结已结束的小时文档（去掉active标记，之后的迟到写入会创建新的小时文档）
+    2. 把冻结的小时文档合并进每日文档，每日文档的rolledUpHours记录已合并的小时文档_id，保证重复执行不会重复累加
+    3. 标记merged，超过保留时间后删除
+    多个worker同时运行也是安全的
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self.metrics = {
+            'runs': 0,
+            'hours_frozen': 0,
+            'hours_merged': 0,
+            'hours_deleted': 0,
+            'merge_errors': 0,
+            'last_run_time': None,
+        }
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Hourly stats rollup started")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.rollup_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Hourly stats rollup failed: {e}", exc_info=True)
+            await asyncio.sleep(STATS_ROLLUP_INTERVAL)
+
+    async def rollup_once(self, now: Optional[datetime] = None):
+        """执行一次汇总"""
+        now = now or datetime.utcnow()
+        closed_before = (now - timedelta(seconds=STATS_ROLLUP_DELAY)).strftime(HOUR_BUCKET_FORMAT)
+
+        # 1. 冻结已结束的小时文档
+        result = await hourly_stats_collection.update_many(
+            {'active': True, 'date': {'$lt': closed_before}},
+            {'$unset': {'active': ''}}
+        )
+        self.metrics['hours_frozen'] += result.modified_count
+
+        # 2. 合并冻结但尚未合并的小时文档（包括上次中断的）
+        cursor = hourly_stats_collection.find({'active': {'$exists': False}, 'merged': {'$exists': False}})
+        async for hour_doc in cursor:
+            if await self._merge_into_daily(hour_doc):
+                await hourly_stats_collection.update_one({'_id': hour_doc['_id']}, {'$set': {'merged': True}})
+                self.metrics['hours_merged'] += 1
+            else:
+                self.metrics['merge_errors'] += 1
+
+        # 3. 删除超过保留时间的已合并小时文档
+        retention_before = (now - timedelta(hours=STATS_HOURLY_RETENTION_HOURS)).strftime(HOUR_BUCKET_FORMAT)
+        result = await hourly_stats_collection.delete_many({'merged': True, 'date': {'$lt': retention_before}})
+        self.metrics['hours_deleted'] += result.deleted_count
+
+        self.metrics['runs'] += 1
+        self.metrics['last_run_time'] = now.isoformat()
+
+    async def _merge_into_daily(self, hour_doc: Dict[str, Any]) -> bool:
+        """把一个小时文档合并进每日文档（计数、指纹、草图和rolledUpHours标记在同一次更新中写入）"""
+        marker = str(hour_doc['_id'])
+        date = hour_doc['date'][:len('YYYY-MM-DD')]
+        filter_criteria = {'system': hour_doc['system'], 'date': date, 'type': hour_doc['type']}
+        counters, unique_users, sketches = flatten_stats_data(hour_doc.get('data', {}))
+
+        projection = {'_id': 0, 'hllVersion': 1, 'rolledUpHours': 1}
+        projection.update({path: 1 for path in sketches})
+        for _ in range(HLL_CAS_MAX_ATTEMPTS):
+            daily = await stats_collection.find_one(filter_criteria, projection)
+            if daily and marker in daily.get('rolledUpHours', []):
+                return True  # 已经合并过
+
+            update = {
+                '$set': dict(filter_criteria, lastUpdated=datetime.utcnow()),
+                '$addToSet': dict(unique_users, rolledUpHours=marker),
+            }
+            if counters:
+                update['$inc'] = dict(counters)
+            cas_filter = dict(filter_criteria, rolledUpHours={'$ne': marker})
+            if sketches:
+                # 草图无法用更新操作符合并，与HLL写入一样以hllVersion做乐观并发控制
+                for path, registers in sketches.items():
+                    existing = _get_path(daily, path)
+                    if existing:
+                        registers = hll.decode(existing)
+                        hll.merge(registers, sketches[path])
+                    update['$set'][path] = Binary(hll.encode(registers))
+                update.setdefault('$inc', {})['hllVersion'] = 1
+                version = daily.get('hllVersion') if daily else None
+                cas_filter['hllVersion'] = version if version is not None else {'$exists': False}
+
+            try:
+                result = await stats_collection.update_one(cas_filter, update, upsert=daily is None)
+            except DuplicateKeyError:
+                continue  # 其他worker同时创建了每日文档，重新读取
+            if result.matched_count or result.upserted_id is not None:
+                return True
+
+        logger.error(f"Rollup of hourly stats {marker} into {filter_criteria} gave up after "
+                     f"{HLL_CAS_MAX_ATTEMPTS} attempts")
+        return False
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return self.metrics.copy()
+
+
+stats_rollup = StatsRollup()
+
+
+class PeriodCompactor:
+    """
+    周/月汇总任务
+    为已结束（超过STATS_PERIOD_ROLLUP_LAG_DAYS天）的每个周和自然月合并每日文档，写入monitor_period_stats。
+    汇总文档记录来源每日文档的最大lastUpdated，之后有迟到写入的周期会被重新汇总，查询时也会跳过。
+    """
+
+    def __init__(self, trend_builder: Callable[[str, str, Dict[str, Any], int], Dict[str, Any]]):
+        """
+        Args:
+            trend_builder: 构建单日趋势数据的函数 (stats_type, date, stats_data, limit) -> dict，
+                汇总文档保存每天的趋势数据，查询长日期范围时趋势图仍然按天显示
+        """
+        self._trend_builder = trend_builder
+        self._task: Optional[asyncio.Task] = None
+        self.metrics = {
+            'runs': 0,
+            'periods_built': 0,
+            'periods_skipped': 0,
+            'build_errors': 0,
+            'last_run_time': None,
+        }
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Period stats compactor started")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.compact_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Period stats compaction failed: {e}", exc_info=True)
+            await asyncio.sleep(STATS_PERIOD_ROLLUP_INTERVAL)
+
+    async def compact_once(self, today: Optional[date_type] = None):
+        """为所有system和统计类型补齐或重建已结束周期的汇总文档"""
+        today = today or datetime.utcnow().date()
+        closed_before = today - timedelta(days=STATS_PERIOD_ROLLUP_LAG_DAYS)
+
+        cursor = stats_collection.aggregate([
+            {'$group': {'_id': {'system': '$system', 'type': '$type'}, 'first': {'$min': '$date'}}}
+        ])
+        async for group in cursor:
+            system, stats_type = group['_id']['system'], group['_id']['type']
+            first_day = _parse_date(group['first'])
+            for period in ('month', 'week'):
+                start, end = period_bounds(period, first_day)
+                while end < closed_before:
+                    await self.ensure_period(system, stats_type, period, _format_date(start), _format_date(end))
+                    start, end = period_bounds(period, end + timedelta(days=1))
+
+        self.metrics['runs'] += 1
+        self.metrics['last_run_time'] = datetime.utcnow().isoformat()
+
+    def build_trend(self, stats_type: str, date: str, stats_data: Dict[str, Any]) -> Dict[str, Any]:
+        """汇总文档中保存的单日趋势数据"""
+        return self._trend_builder(stats_type, date, stats_data, STATS_PERIOD_TREND_TOP)
+
+    async def ensure_period(self, system: str, stats_type: str, period: str, start: str, end: str):
+        """汇总文档不存在或来源每日文档有更新时重新汇总"""
+        key = {'system': system, 'type': stats_type, 'period': period, 'start': start}
+        date_range = {'$gte': start, '$lte': end}
+        existing = await period_stats_collection.find_one(key, {'_id': 0, 'sourceLastUpdated': 1, 'archived': 1})
+        if existing and existing.get('archived'):
+            # 已归档的月份每日文档已删除，不能重新汇总（迟到写入由保留任务合并）
+            self.metrics['periods_skipped'] += 1
+            return
+        if existing:
+            newer = await stats_collection.find_one(
+                {'system': system, 'type': stats_type, 'date': date_range,
+                 'lastUpdated': {'$gt': existing['sourceLastUpdated']}},
+                {'_id': 1}
+            )
+            if not newer:
+                self.metrics['periods_skipped'] += 1
+                return
+
+        projection = {'_id': 0, 'date': 1, 'data': 1, 'lastUpdated': 1}
+        data, trend, days, source_last_updated = {}, [], 0, None
+        cursor = stats_collection.find({'system': system, 'type': stats_type, 'date': date_range},
+                                       projection).sort('date', 1)
+        async for stats in cursor:
+            stats_data = stats.get('data', {})
+            # 按用户指纹的维度只在下钻时读取，不进入汇总
+            for dimension in USER_DIMENSIONS:
+                stats_data.pop(dimension, None)
+            trend.append(self.build_trend(stats_type, stats['date'], stats_data))
+            merge_stats_data(data, stats_data)
+            days += 1
+            last_updated = stats.get('lastUpdated')
+            if last_updated and (source_last_updated is None or last_updated > source_last_updated):
+                source_last_updated = last_updated
+
+        if not days:
+            await period_stats_collection.delete_one(key)
+            return
+        try:
+            await period_stats_collection.update_one(key, {'$set': {
+                'end': end,
+                'data': data,
+                'trend': trend,
+                'days': days,
+                'sourceLastUpdated': source_last_updated or datetime.utcnow(),
+                'builtAt': datetime.utcnow(),
+            }}, upsert=True)
+            self.metrics['periods_built'] += 1
+        except DocumentTooLarge:
+            # 精确指纹列表过大时无法汇总（HLL模式不会出现），查询会回退到每日文档
+            logger.warning(f"Period rollup too large, skipped: {key}")
+            self.metrics['build_errors'] += 1
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return self.metrics.copy()
+
+
+async def plan_period_rollups(system: str, stats_type: str, start_date: Optional[str], end_date: Optional[str],
+                              archived_only: bool = False) -> Tuple[List[Dict[str, Any]], List[Tuple[Optional[str], Optional[str]]]]:
+    """
+    把[start_date, end_date]拆分为尽量少的汇总文档和每日文档：先选完整包含的月，再选不与之重叠的周，
+    其余日期读取每日文档；来源每日文档在汇总后有更新的汇总文档不使用
+    archived_only为True时只使用保留策略归档的月汇总（这些月份已没有每日文档）
+
+    Returns:
+        tuple: (按开始日期排序的汇总文档 [{'date', 'end', 'data', 'trend'}],
+                需要读取每日文档的日期范围 [(开始, 结束)]，None表示不限)
+    """
+    query = {'system': system, 'type': stats_type}
+    if start_date:
+        query['start'] = {'$gte': start_date}
+    if end_date:
+        query['end'] = {'$lte': end_date}
+    if archived_only:
+        query['archived'] = True
+    candidates = [doc async for doc in period_stats_collection.find(
+        query, {'_id': 0, 'period': 1, 'start': 1, 'end': 1, 'sourceLastUpdated': 1, 'archived': 1}
+    )]
+    if not candidates:
+        return [], [(start_date, end_date)]
+
+    chosen = sorted((doc for doc in candidates if doc['period'] == 'month'), key=lambda doc: doc['start'])
+    for week in sorted((doc for doc in candidates if doc['period'] == 'week'), key=lambda doc: doc['start']):
+        if not any(week['start'] <= month['end'] and month['start'] <= week['end'] for month in chosen):
+            chosen.append(week)
+
+    # 来源每日文档在汇总之后又有写入（迟到数据）的汇总文档不使用，等待重新汇总
+    # （已归档的月份每日文档已删除，总是使用，迟到数据由保留任务合并）
+    stale_query = {
+        'system': system, 'type': stats_type,
+        'date': {'$gte': min(doc['start'] for doc in chosen), '$lte': max(doc['end'] for doc in chosen)},
+        'lastUpdated': {'$gt': min(doc['sourceLastUpdated'] for doc in chosen)},
+    }
+    async for daily in stats_collection.find(stale_query, {'_id': 0, 'date': 1, 'lastUpdated': 1}):
+        chosen = [doc for doc in chosen
+                  if doc.get('archived') or not (doc['start'] <= daily['date'] <= doc['end']
+                                                 and daily['lastUpdated'] > doc['sourceLastUpdated'])]
+    if not chosen:
+        return [], [(start_date, end_date)]
+    chosen.sort(key=lambda doc: doc['start'])
+
+    rollups = []
+    rollup_query = {'system': system, 'type': stats_type,
+                    '$or': [{'period': doc['period'], 'start': doc['start']} for doc in chosen]}
+    async for doc in period_stats_collection.find(rollup_query, {'_id': 0, 'start': 1, 'end': 1, 'data': 1, 'trend': 1}):
+        rollups.append({'date': doc['start'], 'end': doc['end'], 'data': doc.get('data', {}), 'trend': doc.get('trend', [])})
+    rollups.sort(key=lambda doc: doc['date'])
+
+    # 汇总文档之间未覆盖的日期范围
+    gaps = []
+    cursor = start_date
+    for doc in rollups:
+        if cursor is None or cursor < doc['date']:
+            gaps.append((cursor, _format_date(_parse_date(doc['date']) - timedelta(days=1))))
+        cursor = _format_date(_parse_date(doc['end']) + timedelta(days=1))
+    if end_date is None or cursor <= end_date:
+        gaps.append((cursor, end_date))
+    return rollups, gaps
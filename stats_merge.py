@@ -0,0 +1,108 @@
+from typing import Any, Dict, Iterable, Optional
+
+
+def _flatten_into(inner: dict, prefix: tuple, nested: dict):
+    """把第三级及更深的字典展开为 (键路径元组 → 计数) 累加进inner"""
+    level = [(prefix, nested)]
+    while level:
+        next_level = []
+        for path, node in level:
+            for key, value in node.items():
+                if isinstance(value, dict):
+                    next_level.append((path + (key,), value))
+                else:
+                    _accumulate(inner, path + (key,), value)
+        level = next_level
+
+
+def _accumulate(counter: dict, key, value):
+    current = counter.get(key)
+    if isinstance(current, (int, float)) and isinstance(value, (int, float)):
+        counter[key] = current + value
+    else:
+        counter[key] = value
+
+
+class FlatStatsMerger:
+    """
+    按维度累加多天的嵌套统计字典
+    每个一级键下的数据只展开一次为 (二级键或键路径元组 → 计数)，合并时不再为每一层分配新字典；
+    最后只为保留下来的前N个一级键重建嵌套结构
+    """
+
+    def __init__(self):
+        # {维度: {一级键: 计数 或 {二级键/键路径元组: 计数}}}
+        self._counters: Dict[str, Dict[str, Any]] = {}
+
+    def __contains__(self, dimension: str) -> bool:
+        return dimension in self._counters
+
+    def add(self, dimension: str, nested: Optional[dict]):
+        """累加一天的维度字典（数值相加，类型不一致时使用新值，与原先逐日合并一致）"""
+        if not nested:
+            return
+        store = self._counters.setdefault(dimension, {})
+        for key, value in nested.items():
+            if not isinstance(value, dict):
+                _accumulate(store, key, value)
+                continue
+            inner = store.get(key)
+            if not isinstance(inner, dict):
+                inner = store[key] = {}
+            get = inner.get
+            for sub_key, sub_value in value.items():
+                if isinstance(sub_value, dict):
+                    _flatten_into(inner, (sub_key,), sub_value)
+                    continue
+                current = get(sub_key)
+                inner[sub_key] = sub_value if current is None else current + sub_value
+
+    @staticmethod
+    def _score(value) -> int:
+        """与get_top_entries相同：嵌套字典为所有整数之和"""
+        if isinstance(value, dict):
+            return sum(item for item in value.values() if isinstance(item, int))
+        return value if isinstance(value, int) else 0
+
+    def to_nested(self, dimension: str, limit: Optional[int] = None, except_keys: Iterable[str] = ()) -> dict:
+        """
+        重建嵌套字典
+        :param limit: 只保留总计数最大的前limit个一级键（排序与get_top_entries一致，相同计数按出现顺序）
+        :param except_keys: 不参与排序的一级键（如停留时长的count），只保留其中属于前limit个键的条目
+        """
+        store = self._counters.get(dimension)
+        if not store:
+            return {}
+        except_keys = set(except_keys)
+        if limit is None:
+            survivors = None
+            keys = list(store)
+        else:
+            ranked = [key for key in store if key not in except_keys]
+            ranked.sort(key=lambda key: self._score(store[key]), reverse=True)
+            survivors = set(ranked[:limit])
+            keys = ranked[:limit] + [key for key in store if key in except_keys]
+
+        result = {}
+        for key in keys:
+            value = store[key]
+            if not isinstance(value, dict):
+                result[key] = value
+                continue
+            node = result[key] = {}
+            for sub_key, sub_value in value.items():
+                first = sub_key[0] if isinstance(sub_key, tuple) else sub_key
+                if survivors is not None and key in except_keys and first not in survivors:
+                    continue
+                if not isinstance(sub_key, tuple):
+                    node[sub_key] = sub_value
+                    continue
+                target = node
+                for part in sub_key[:-1]:
+                    target = target.setdefault(part, {})
+                    if not isinstance(target, dict):
+                        # 同一路径在不同日期分别是数值和字典（键名冲突），保留先出现的数值
+                        break
+                else:
+                    target[sub_key[-1]] = sub_value
+        return result
@@ -0,0 +1,382 @@
+import logging
+import os
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from hll import HLL_ENABLED, UniqueUserCounter
+from mongodb import stats_collection, hourly_stats_collection
+from rollup import STATS_HOURLY_BUCKETS, to_hour_range
+
+logger = logging.getLogger(__name__)
+
+# 统计查询引擎：python（读取每日文档后在Python中合并，默认）或 pipeline（聚合管道在MongoDB中合并并取前N）
+# 每个请求可以通过engine参数单独指定，便于对比两种方式
+STATS_QUERY_ENGINE = os.getenv("STATS_QUERY_ENGINE", "python").lower()
+QUERY_ENGINES = ('python', 'pipeline')
+
+# 停留时长统计在每个维度下用count子字典记录会话数
+SESSION_COUNT_KEY = 'count'
+
+# 各统计类型的计数维度及层数（按用户指纹的维度只在按用户下钻时读取，由python引擎处理）
+COUNTER_DIMENSIONS = {
+    'pageViews': {
+        'byUrl': 1, 'byBrowser': 1, 'byOS': 1, 'byDevice': 1, 'byIPPrefix': 1, 'byReferrer': 1,
+        'byUrlAndIPPrefix': 2, 'byUrlAndBrowser': 2, 'byUrlAndDevice': 2, 'byBrowserAndOS': 2, 'byUrlAndReferrer': 2,
+    },
+    'downloads': {
+        'byFile': 1, 'byUrl': 1, 'bySourcePage': 1, 'byIPPrefix': 1,
+        'byFileAndSource': 2, 'byFileAndIPPrefix': 2,
+    },
+    'events': {
+        'byType': 1, 'byCategory': 1, 'byAction': 1, 'byLabel': 1, 'bySelector': 1, 'byUrl': 1, 'byIPPrefix': 1,
+        'byCategoryAndIPPrefix': 2, 'byActionAndIPPrefix': 2, 'byCategoryAndAction': 2, 'byCategoryAndLabel': 2,
+        'byUrlAndAction': 2,
+    },
+    'duration': {
+        'byUrl': 1, 'byBrowser': 1, 'byOS': 1, 'byDevice': 1, 'byIPPrefix': 1,
+        'byUrlAndIPPrefix': 2, 'byUrlAndBrowser': 2, 'byUrlAndDevice': 2, 'byBrowserAndOS': 2,
+    },
+}
+
+# 唯一用户维度：{维度: (层数, 范围)}
+# 范围为top时按用户数取前N，all时返回全部，为计数维度名时只计算该计数维度返回条目的用户数
+UNIQUE_DIMENSIONS = {
+    'pageViews': {
+        'byUrlUniqueUsers': (1, 'byUrl'),
+        'byIPPrefixUniqueUsers': (1, 'top'),
+        'byBrowserAndOsUniqueUsers': (2, 'all'),
+    },
+    'downloads': {
+        'byFileUniqueUsers': (1, 'top'),
+        'byIPPrefixUniqueUsers': (1, 'top'),
+    },
+    'events': {
+        'byCategoryUniqueUsers': (1, 'top'),
+        'byActionUniqueUsers': (1, 'top'),
+        'byCategoryAndActionUniqueUsers': (2, 'byCategoryAndAction'),
+        'byIPPrefixUniqueUsers': (1, 'top'),
+    },
+    'duration': {},
+}
+
+# 趋势数据中的子类别：{统计类型: (维度, 层数, 唯一用户维度)}
+TREND_ITEMS = {
+    'pageViews': ('byUrl', 1, 'byUrlUniqueUsers'),
+    'downloads': ('byFile', 1, 'byFileUniqueUsers'),
+    'events': ('byCategoryAndAction', 2, 'byCategoryAndActionUniqueUsers'),
+    'duration': ('byUrl', 1, None),
+}
+
+
+class CountedUsers(int):
+    """聚合管道在服务端算好的唯一用户数，len()返回该数值，可以代替UniqueUserCounter交给最终结果处理函数"""
+
+    def __len__(self):
+        return int(self)
+
+
+def _unwind_stages(path: str, depth: int, keep: Iterable[str] = (), include_keys: Optional[List[str]] = None,
+                   exclude_keys: Optional[List[str]] = None) -> List[dict]:
+    """
+    把嵌套字典展开为每个叶子一条记录 {k0, ..., k<depth-1>, v}
+    :param path: 字典字段路径，例如 data.byUrl
+    :param depth: 展开的层数
+    :param keep: 需要保留的其他字段（例如date）
+    :param include_keys: 只展开这些第一层键
+    :param exclude_keys: 跳过这些第一层键
+    """
+    keep_fields = {field: 1 for field in keep}
+    entries = {'$objectToArray': {'$ifNull': [f'${path}', {}]}}
+    if include_keys is not None:
+        entries = {'$filter': {'input': entries, 'as': 'entry', 'cond': {'$in': ['$$entry.k', include_keys]}}}
+    stages = [{'$project': dict(keep_fields, _id=0, entry=entries)}, {'$unwind': '$entry'}]
+    if exclude_keys:
+        stages.append({'$match': {'entry.k': {'$nin': exclude_keys}}})
+    stages.append({'$project': dict(keep_fields, k0='$entry.k', v='$entry.v')})
+    for level in range(1, depth):
+        fields = dict(keep_fields, **{f'k{i}': 1 for i in range(level)})
+        # 旧数据中可能混有非字典的值，跳过
+        stages.append({'$match': {'v': {'$type': 'object'}}})
+        stages.append({'$project': dict(fields, entry={'$objectToArray': '$v'})})
+        stages.append({'$unwind': '$entry'})
+        stages.append({'$project': dict(fields, **{f'k{level}': '$entry.k', 'v': '$entry.v'})})
+    return stages
+
+
+def _key_fields(depth: int, prefix: str = '$') -> Dict[str, str]:
+    return {f'k{i}': f'{prefix}k{i}' for i in range(depth)}
+
+
+def _counter_facet(path: str, depth: int, limit: Optional[int] = None, include_keys: Optional[List[str]] = None,
+                   exclude_keys: Optional[List[str]] = None) -> List[dict]:
+    """计数维度求和，按第一层键的总数排序取前limit个（与get_top_entries的排序方式一致）"""
+    stages = _unwind_stages(path, depth, include_keys=include_keys, exclude_keys=exclude_keys)
+    if depth == 1:
+        stages.append({'$group': {'_id': '$k0', 'score': {'$sum': '$v'}}})
+    else:
+        stages.append({'$group': {'_id': _key_fields(depth), 'value': {'$sum': '$v'}}})
+        stages.append({'$group': {'_id': '$_id.k0', 'score': {'$sum': '$value'},
+                                  'entries': {'$push': {'keys': '$_id', 'value': '$value'}}}})
+    stages.append({'$sort': {'score': -1, '_id': 1}})
+    if limit:
+        stages.append({'$limit': limit})
+    return stages
+
+
+def _unique_facet(path: str, depth: int, limit: Optional[int] = None, include_keys: Optional[List[str]] = None,
+                  keep: Iterable[str] = ()) -> List[dict]:
+    """指纹列表维度去重计数，只返回每个键的用户数"""
+    keys = dict(_key_fields(depth), **{field: f'${field}' for field in keep})
+    stages = _unwind_stages(path, depth, keep=keep, include_keys=include_keys)
+    stages += [
+        {'$unwind': '$v'},
+        {'$group': {'_id': dict(keys, user='$v')}},
+        {'$group': {'_id': {key: f'$_id.{key}' for key in keys}, 'users': {'$sum': 1}}},
+        {'$sort': {'users': -1, '_id': 1}},
+    ]
+    if limit:
+        stages.append({'$limit': limit})
+    return stages
+
+
+def _build_counter(rows: List[dict], depth: int) -> dict:
+    """把计数维度的管道结果还原为嵌套字典（保持排序）"""
+    result = {}
+    for row in rows:
+        if depth == 1:
+            result[row['_id']] = row['score']
+            continue
+        nested = result.setdefault(row['_id'], {})
+        for entry in row['entries']:
+            target = nested
+            keys = [entry['keys'][f'k{i}'] for i in range(1, depth)]
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = entry['value']
+    return result
+
+
+def _build_unique(rows: List[dict], depth: int) -> dict:
+    """把唯一用户维度的管道结果还原为嵌套字典 {键: CountedUsers}"""
+    result = {}
+    for row in rows:
+        target = result
+        keys = [row['_id'][f'k{i}'] for i in range(depth)]
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+        target[keys[-1]] = CountedUsers(row['users'])
+    return result
+
+
+async def _pending_hour_ids(query: dict) -> list:
+    """启用按小时分桶时，尚未汇总进每日文档的小时文档_id（跳过每日文档rolledUpHours中已合并的）"""
+    hour_query = dict(query, merged={'$exists': False})
+    if 'date' in query:
+        hour_query['date'] = to_hour_range(query['date'])
+    hour_docs = [doc async for doc in hourly_stats_collection.find(hour_query, {'_id': 1, 'date': 1})]
+    if not hour_docs:
+        return []
+    dates = sorted({doc['date'][:len('YYYY-MM-DD')] for doc in hour_docs})
+    rolled_up = set()
+    async for daily in stats_collection.find(dict(query, date={'$in': dates}), {'_id': 0, 'rolledUpHours': 1}):
+        rolled_up.update(daily.get('rolledUpHours', []))
+    return [doc['_id'] for doc in hour_docs if str(doc['_id']) not in rolled_up]
+
+
+# {类别: {动作: {指纹: 次数}}} 转为 {类别: {动作: [指纹, ...]}}
+_LEGACY_CATEGORY_ACTION_USERS = {'$arrayToObject': {'$map': {
+    'input': {'$objectToArray': {'$ifNull': ['$data.byCategoryAndActionAndUser', {}]}},
+    'as': 'category',
+    'in': {'k': '$$category.k', 'v': {'$arrayToObject': {'$map': {
+        'input': {'$objectToArray': '$$category.v'},
+        'as': 'action',
+        'in': {'k': '$$action.k', 'v': {'$map': {'input': {'$objectToArray': '$$action.v'}, 'as': 'user',
+                                                 'in': '$$user.k'}}},
+    }}}},
+}}}
+
+
+async def _source_stages(query: dict) -> List[dict]:
+    """管道的输入：每日文档，加上尚未汇总的小时文档（date截断为日期）"""
+    stages = [{'$match': query}]
+    if STATS_HOURLY_BUCKETS:
+        hour_ids = await _pending_hour_ids(query)
+        if hour_ids:
+            stages.append({'$unionWith': {'coll': hourly_stats_collection.name, 'pipeline': [
+                {'$match': {'_id': {'$in': hour_ids}}},
+                {'$addFields': {'date': {'$substrBytes': ['$date', 0, len('YYYY-MM-DD')]}}},
+            ]}})
+    if query.get('type') == 'events':
+        # 没有byCategoryAndActionUniqueUsers的旧文档，从byCategoryAndActionAndUser的指纹键生成
+        stages.append({'$addFields': {'data.byCategoryAndActionUniqueUsers': {'$ifNull': [
+            '$data.byCategoryAndActionUniqueUsers', _LEGACY_CATEGORY_ACTION_USERS
+        ]}}})
+    return stages
+
+
+async def _run_facets(source: List[dict], facets: Dict[str, List[dict]]) -> Dict[str, List[dict]]:
+    """一次聚合执行多个子管道，每个子管道只返回最终条目"""
+    cursor = stats_collection.aggregate(source + [{'$facet': facets}], allowDiskUse=True)
+    async for result in cursor:
+        return result
+    return {name: [] for name in facets}
+
+
+async def run_stats_pipeline(query: dict, stats_type: str, limit: int, result_initializer: Callable[[], dict],
+                             unique_users_handler: Callable[[dict, dict, str], None]) -> Tuple[Dict[str, Any], List[dict]]:
+    """
+    使用聚合管道计算统计结果
+    第一次聚合计算总数、各维度前N条和每日趋势行；第二次聚合只为第一次返回的条目计算唯一用户数和会话数。
+    HLL草图无法在服务端合并，HLL模式下唯一用户数改为只读取唯一用户字段在Python中合并。
+
+    Returns:
+        tuple: (与python引擎相同结构的聚合结果（各维度已取前N），趋势数据)
+    """
+    source = await _source_stages(query)
+    counter_dimensions = COUNTER_DIMENSIONS.get(stats_type, {})
+    unique_dimensions = UNIQUE_DIMENSIONS.get(stats_type, {})
+    exclude_keys = [SESSION_COUNT_KEY] if stats_type == 'duration' else None
+    item_dimension, item_depth, item_users_dimension = TREND_ITEMS.get(stats_type, (None, 0, None))
+    item_keys = _key_fields(item_depth)
+
+    facets = {
+        'totals': [{'$group': {'_id': None, 'total': {'$sum': '$data.total'}, 'count': {'$sum': '$data.count'}}}],
+        'trend': [{'$group': {'_id': '$date', 'total': {'$sum': '$data.total'}, 'count': {'$sum': '$data.count'}}},
+                  {'$sort': {'_id': 1}}],
+    }
+    for dimension, depth in counter_dimensions.items():
+        facets[f'counter_{dimension}'] = _counter_facet(f'data.{dimension}', depth, limit, exclude_keys=exclude_keys)
+    if item_dimension:
+        facets['trendItems'] = _unwind_stages(f'data.{item_dimension}', item_depth, keep=('date',),
+                                              exclude_keys=exclude_keys) + [
+            {'$group': {'_id': dict(item_keys, date='$date'), 'value': {'$sum': '$v'}}},
+            {'$sort': {'_id.date': 1, 'value': -1}},
+            {'$group': {'_id': '$_id.date', 'items': {'$push': {'keys': '$_id', 'value': '$value'}}}},
+            {'$project': {'items': {'$slice': ['$items', limit]}}},
+        ]
+    if not HLL_ENABLED:
+        facets['users'] = [{'$unwind': '$data.uniqueUsers'}, {'$group': {'_id': '$data.uniqueUsers'}},
+                           {'$count': 'users'}]
+        facets['trendUsers'] = [
+            {'$unwind': '$data.uniqueUsers'},
+            {'$group': {'_id': {'date': '$date', 'user': '$data.uniqueUsers'}}},
+            {'$group': {'_id': '$_id.date', 'users': {'$sum': 1}}},
+        ]
+        for dimension, (depth, scope) in unique_dimensions.items():
+            if scope in ('top', 'all'):
+                facets[f'unique_{dimension}'] = _unique_facet(f'data.{dimension}', depth,
+                                                              limit if scope == 'top' else None)
+    result = await _run_facets(source, facets)
+
+    aggregated_stats = result_initializer()
+    totals = result['totals'][0] if result['totals'] else {}
+    aggregated_stats['total'] = totals.get('total', 0)
+    if 'count' in aggregated_stats:
+        aggregated_stats['count'] = totals.get('count', 0)
+    for dimension, depth in counter_dimensions.items():
+        aggregated_stats[dimension] = _build_counter(result[f'counter_{dimension}'], depth)
+    trend_items = {row['_id']: row['items'] for row in result.get('trendItems', [])}
+    top_item_keys = sorted({item['keys']['k0'] for items in trend_items.values() for item in items})
+
+    # 第二次聚合：只为第一次返回的条目计算唯一用户数和会话数
+    lookups = {}
+    if stats_type == 'duration':
+        for dimension, depth in counter_dimensions.items():
+            if aggregated_stats[dimension]:
+                lookups[f'sessions_{dimension}'] = _counter_facet(
+                    f'data.{dimension}.{SESSION_COUNT_KEY}', depth, include_keys=list(aggregated_stats[dimension]))
+        if top_item_keys:
+            lookups['trendSessions'] = _unwind_stages(f'data.{item_dimension}.{SESSION_COUNT_KEY}', item_depth,
+                                                      keep=('date',), include_keys=top_item_keys) + [
+                {'$group': {'_id': dict(item_keys, date='$date'), 'sessions': {'$sum': '$v'}}},
+            ]
+    if not HLL_ENABLED:
+        for dimension, (depth, scope) in unique_dimensions.items():
+            if scope not in ('top', 'all') and aggregated_stats.get(scope):
+                lookups[f'unique_{dimension}'] = _unique_facet(f'data.{dimension}', depth,
+                                                               include_keys=list(aggregated_stats[scope]))
+        if item_users_dimension and top_item_keys:
+            lookups['trendItemUsers'] = _unique_facet(f'data.{item_users_dimension}', item_depth,
+                                                      include_keys=top_item_keys, keep=('date',))
+    if lookups:
+        result.update(await _run_facets(source, lookups))
+
+    for dimension, depth in counter_dimensions.items():
+        if f'sessions_{dimension}' in result:
+            aggregated_stats[dimension][SESSION_COUNT_KEY] = _build_counter(result[f'sessions_{dimension}'], depth)
+
+    def item_key(date: str, keys: dict) -> tuple:
+        return (date,) + tuple(keys[f'k{i}'] for i in range(item_depth))
+
+    item_sessions = {item_key(row['_id']['date'], row['_id']): row['sessions'] for row in result.get('trendSessions', [])}
+    if HLL_ENABLED:
+        day_users, item_users = await _merge_unique_users(source, stats_type, aggregated_stats, unique_users_handler,
+                                                          trend_items, item_depth, item_users_dimension)
+    else:
+        users = result['users'][0]['users'] if result['users'] else 0
+        aggregated_stats['uniqueUsers'] = CountedUsers(users)
+        for dimension, (depth, _) in unique_dimensions.items():
+            aggregated_stats[dimension] = _build_unique(result.get(f'unique_{dimension}', []), depth)
+        day_users = {row['_id']: CountedUsers(row['users']) for row in result['trendUsers']}
+        item_users = {item_key(row['_id']['date'], row['_id']): CountedUsers(row['users'])
+                      for row in result.get('trendItemUsers', [])}
+
+    # 组装与python引擎相同格式的趋势数据
+    trend_data = []
+    for row in result['trend']:
+        date = row['_id']
+        day_data = {'date': date, 'total': row.get('total', 0)}
+        if stats_type == 'duration':
+            day_data['count'] = row.get('count', 0)
+        else:
+            day_data['uniqueUsers'] = len(day_users[date]) if date in day_users else 0
+        if date in trend_items:
+            entries = {}
+            for item in trend_items[date]:
+                key = item_key(date, item['keys'])
+                name = '.'.join(key[1:])
+                if stats_type == 'duration':
+                    entries[name] = {'total': item['value'], 'count': item_sessions.get(key) or 1}
+                else:
+                    entries[name] = {'count': item['value'],
+                                     'uniqueUsers': len(item_users[key]) if key in item_users else 0}
+            day_data[item_dimension] = entries
+        trend_data.append(day_data)
+    return aggregated_stats, trend_data
+
+
+async def _merge_unique_users(source: List[dict], stats_type: str, aggregated_stats: dict,
+                              unique_users_handler: Callable[[dict, dict, str], None], trend_items: dict,
+                              item_depth: int, item_users_dimension: Optional[str]) -> Tuple[dict, dict]:
+    """
+    HLL模式：只读取唯一用户字段（草图和旧数据的指纹列表），用与python引擎相同的处理函数合并
+
+    Returns:
+        tuple: ({日期: UniqueUserCounter}, {(日期, 键...): UniqueUserCounter}) 趋势数据使用的每日用户数
+    """
+    projection = {'_id': 0, 'date': 1, 'data.uniqueUsers': 1, 'data.hll': 1}
+    projection.update({f'data.{dimension}': 1 for dimension in UNIQUE_DIMENSIONS.get(stats_type, {})})
+    day_users, item_users = {}, {}
+    cursor = stats_collection.aggregate(source + [{'$project': projection}], allowDiskUse=True)
+    async for doc in cursor:
+        date = doc['date']
+        stats_data = doc.get('data', {})
+        hll_data = stats_data.get('hll', {})
+        for counter in (aggregated_stats['uniqueUsers'], day_users.setdefault(date, UniqueUserCounter())):
+            counter.update(stats_data.get('uniqueUsers') or [])
+            if hll_data.get('uniqueUsers'):
+                counter.merge_sketch(hll_data['uniqueUsers'])
+        unique_users_handler(aggregated_stats, stats_data, stats_type)
+
+        if not item_users_dimension:
+            continue
+        for item in trend_items.get(date, []):
+            keys = tuple(item['keys'][f'k{i}'] for i in range(item_depth))
+            users, sketch = stats_data.get(item_users_dimension, {}), hll_data.get(item_users_dimension, {})
+            for key in keys:
+                users = users.get(key) if isinstance(users, dict) else None
+                sketch = sketch.get(key) if isinstance(sketch, dict) else None
+            counter = item_users.setdefault((date,) + keys, UniqueUserCounter())
+            counter.update(users or [])
+            if sketch:
+                counter.merge_sketch(sketch)
+    return day_users, item_users
@@ -0,0 +1,301 @@
+"""
+每日统计文档的存储后端
+统计写入、按日期范围读取和按system删除通过 StatsStorage 接口完成，由 STATS_STORAGE 选择实现：
+- mongodb（默认）：monitor_stats集合，支持HLL、分桶用户维度、按小时分桶、周/月汇总等全部功能
+- sqlite：内嵌的SQLite数据库（STATS_SQLITE_PATH为 :memory: 时只保存在内存中），
+  适合不部署MongoDB统计集合的小型部署、基准测试和本地测试；只支持基本的每日文档，
+  用户维度直接保存在每日文档内。用户、网站和后台任务仍保存在MongoDB中
+两种实现接受相同的更新文档（$inc、$set、$addToSet、$max）和相同的查询条件/投影子集
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from pymongo import UpdateOne
+
+from mongodb import stats_collection
+
+STATS_STORAGE = os.getenv("STATS_STORAGE", "mongodb").lower()
+STATS_SQLITE_PATH = os.getenv("STATS_SQLITE_PATH", "stats.sqlite3")  # :memory: 表示只保存在内存中
+
+STORAGE_BACKENDS = ('mongodb', 'sqlite')
+
+logger = logging.getLogger(__name__)
+
+
+class StatsStorage(ABC):
+    """每日统计文档存储接口"""
+
+    @abstractmethod
+    async def apply_updates(self, updates: List[Tuple[Tuple[str, str, str], Dict[str, Any]]]) -> Set[int]:
+        """
+        对 (system, date, type) 文档执行upsert更新
+        :param updates: [(键, 更新文档), ...]
+        :return: 写入失败的更新在列表中的索引
+        """
+        pass
+
+    @abstractmethod
+    def find_days(self, query: Dict[str, Any], projection: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """
+        按日期顺序返回每日文档
+        :param query: system、type和可选的date条件（$gte/$gt/$lte/$lt/$in）
+        :param projection: 包含或排除字段的投影（如排除 data.byUser）
+        """
+        pass
+
+    @abstractmethod
+    async def delete_system(self, system: str, limit: Optional[int] = None) -> int:
+        """删除system的每日文档，limit为空时全部删除，返回删除数量"""
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class MongoStatsStorage(StatsStorage):
+    def __init__(self, collection=stats_collection):
+        self.collection = collection
+
+    async def apply_updates(self, updates: List[Tuple[Tuple[str, str, str], Dict[str, Any]]]) -> Set[int]:
+        if not updates:
+            return set()
+        operations = [UpdateOne({'system': system, 'date': date, 'type': track_type}, update_fields, upsert=True)
+                      for (system, date, track_type), update_fields in updates]
+        try:
+            await self.collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            details = getattr(e, 'details', None)
+            if not isinstance(details, dict) or not details.get('writeErrors'):
+                raise
+            return {error['index'] for error in details['writeErrors']}
+        return set()
+
+    async def find_days(self, query: Dict[str, Any], projection: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        async for document in self.collection.find(query, projection).sort('date', 1):
+            yield document
+
+    async def delete_system(self, system: str, limit: Optional[int] = None) -> int:
+        if limit is None:
+            result = await self.collection.delete_many({'system': system})
+            return result.deleted_count
+        ids = [doc['_id'] async for doc in self.collection.find({'system': system}, {'_id': 1})
+               .sort('_id', 1).limit(limit)]
+        if not ids:
+            return 0
+        result = await self.collection.delete_many({'_id': {'$in': ids}})
+        return result.deleted_count
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _parent(document: Dict[str, Any], path: str) -> Tuple[Dict[str, Any], str]:
+    """返回路径最后一级的父字典（不存在时创建）和最后一级的键"""
+    *parents, last = path.split('.')
+    for part in parents:
+        child = document.get(part)
+        if child is None:
+            child = document[part] = {}
+        elif not isinstance(child, dict):
+            raise ValueError(f"Cannot apply update to '{path}': '{part}' is not a document")
+        document = child
+    return document, last
+
+
+def apply_update_document(document: Dict[str, Any], update_fields: Dict[str, Any]) -> None:
+    """在内存中的文档上执行MongoDB风格的更新（只支持统计写入用到的操作符）"""
+    for op, fields in update_fields.items():
+        if op not in ('$inc', '$set', '$addToSet', '$max'):
+            raise ValueError(f"Unsupported update operator {op}")
+        for path, value in fields.items():
+            parent, key = _parent(document, path)
+            current = parent.get(key)
+            if op == '$inc':
+                if current is not None and not isinstance(current, (int, float)):
+                    raise ValueError(f"Cannot apply $inc to non-numeric field '{path}'")
+                parent[key] = (current or 0) + value
+            elif op == '$set':
+                parent[key] = value
+            elif op == '$max':
+                if current is None or value > current:
+                    parent[key] = value
+            else:
+                if current is None:
+                    current = parent[key] = []
+                elif not isinstance(current, list):
+                    raise ValueError(f"Cannot apply $addToSet to non-array field '{path}'")
+                values = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                existing = set(current)
+                for item in values:
+                    if item not in existing:
+                        existing.add(item)
+                        current.append(item)
+
+
+def _project(document: Dict[str, Any], projection: Dict[str, Any]) -> Dict[str, Any]:
+    """按投影选取字段：值为真时只保留列出的字段，否则排除列出的字段（支持点号路径）"""
+    fields = {path: value for path, value in projection.items() if path != '_id'}
+    if any(fields.values()):
+        projected = {}
+        for path in fields:
+            source, target = document, projected
+            *parents, last = path.split('.')
+            for part in parents:
+                source = source.get(part) if isinstance(source, dict) else None
+                if source is None:
+                    break
+                target = target.setdefault(part, {})
+            else:
+                if isinstance(source, dict) and last in source:
+                    target[last] = source[last]
+        return projected
+    for path in fields:
+        *parents, last = path.split('.')
+        parent = document
+        for part in parents:
+            parent = parent.get(part) if isinstance(parent, dict) else None
+        if isinstance(parent, dict):
+            parent.pop(last, None)
+    return document
+
+
+_DATE_OPERATORS = {'$gte': '>=', '$gt': '>', '$lte': '<=', '$lt': '<'}
+
+
+class SQLiteStatsStorage(StatsStorage):
+    """
+    每个(system, type, date)一行，统计数据以JSON保存；更新在事务中读取-修改-写回
+    sqlite3的调用在线程中执行，同一连接的访问由锁串行化（一个进程内只有一个写入者）
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ':memory:':
+            # 多个worker进程共享同一个文件时，WAL模式下读取不阻塞写入
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('PRAGMA busy_timeout=5000')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS stats ('
+            ' system TEXT NOT NULL, type TEXT NOT NULL, date TEXT NOT NULL, document TEXT NOT NULL,'
+            ' PRIMARY KEY (system, type, date)) WITHOUT ROWID'
+        )
+
+    def _apply_updates(self, updates: List[Tuple[Tuple[str, str, str], Dict[str, Any]]]) -> Set[int]:
+        failed = set()
+        with self._lock:
+            connection = self._connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                for i, ((system, date, track_type), update_fields) in enumerate(updates):
+                    row = connection.execute('SELECT document FROM stats WHERE system=? AND type=? AND date=?',
+                                             (system, track_type, date)).fetchone()
+                    document = json.loads(row[0]) if row else {}
+                    try:
+                        apply_update_document(document, update_fields)
+                        encoded = json.dumps(document, default=_json_default, separators=(',', ':'))
+                    except (ValueError, TypeError) as e:
+                        logger.warning(f"SQLite update failed for {(system, date, track_type)}: {e}")
+                        failed.add(i)
+                        continue
+                    connection.execute('INSERT OR REPLACE INTO stats (system, type, date, document) VALUES (?, ?, ?, ?)',
+                                       (system, track_type, date, encoded))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        return failed
+
+    async def apply_updates(self, updates: List[Tuple[Tuple[str, str, str], Dict[str, Any]]]) -> Set[int]:
+        if not updates:
+            return set()
+        return await asyncio.to_thread(self._apply_updates, updates)
+
+    @staticmethod
+    def _where(query: Dict[str, Any]) -> Tuple[str, List[Any]]:
+        conditions, params = [], []
+        for field, condition in query.items():
+            if field not in ('system', 'type', 'date'):
+                raise ValueError(f"Unsupported query field {field}")
+            if not isinstance(condition, dict):
+                conditions.append(f'{field} = ?')
+                params.append(condition)
+                continue
+            for op, value in condition.items():
+                if op == '$in':
+                    conditions.append(f"{field} IN ({', '.join('?' * len(value))})" if value else '0')
+                    params.extend(value)
+                elif op in _DATE_OPERATORS:
+                    conditions.append(f'{field} {_DATE_OPERATORS[op]} ?')
+                    params.append(value)
+                else:
+                    raise ValueError(f"Unsupported query operator {op}")
+        return ' AND '.join(conditions) or '1', params
+
+    def _find_rows(self, query: Dict[str, Any]) -> List[Tuple[str, str, str, str]]:
+        where, params = self._where(query)
+        with self._lock:
+            return self._connection.execute(
+                f'SELECT system, type, date, document FROM stats WHERE {where} ORDER BY date', params).fetchall()
+
+    async def find_days(self, query: Dict[str, Any], projection: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        rows = await asyncio.to_thread(self._find_rows, query)
+        for system, track_type, date, encoded in rows:
+            document = json.loads(encoded)
+            # 与MongoDB文档一致：键字段来自存储的行（查询可能按$in或不按类型过滤）
+            document.update(system=system, type=track_type, date=date)
+            if isinstance(document.get('lastUpdated'), str):
+                document['lastUpdated'] = datetime.fromisoformat(document['lastUpdated'])
+            yield _project(document, projection)
+
+    def _delete_system(self, system: str, limit: Optional[int]) -> int:
+        with self._lock:
+            if limit is None:
+                cursor = self._connection.execute('DELETE FROM stats WHERE system = ?', (system,))
+            else:
+                cursor = self._connection.execute(
+                    'DELETE FROM stats WHERE (system, type, date) IN '
+                    '(SELECT system, type, date FROM stats WHERE system = ? LIMIT ?)', (system, limit))
+            return cursor.rowcount
+
+    async def delete_system(self, system: str, limit: Optional[int] = None) -> int:
+        return await asyncio.to_thread(self._delete_system, system, limit)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def check_storage_features(features: Dict[str, bool]) -> None:
+    """非MongoDB存储不支持依赖MongoDB集合或聚合的功能，启用时在启动阶段报错"""
+    if STATS_STORAGE == 'mongodb':
+        return
+    enabled = [name for name, on in features.items() if on]
+    if enabled:
+        raise ValueError(f"STATS_STORAGE={STATS_STORAGE} does not support: {', '.join(enabled)}")
+
+
+def create_stats_storage(backend: str = STATS_STORAGE) -> StatsStorage:
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"STATS_STORAGE must be one of {', '.join(STORAGE_BACKENDS)}, got '{backend}'")
+    if backend == 'sqlite':
+        logger.info(f"Using SQLite stats storage: {STATS_SQLITE_PATH}")
+        return SQLiteStatsStorage(STATS_SQLITE_PATH)
+    return MongoStatsStorage()
+
+
+stats_storage = create_stats_storage()
@@ -0,0 +1,11 @@
+"""
+测试使用内嵌SQLite统计存储（不需要MongoDB），需要在导入业务模块之前设置环境变量
+"""
+import os
+import sys
+
+os.environ.setdefault("STATS_STORAGE", "sqlite")
+os.environ.setdefault("STATS_SQLITE_PATH", ":memory:")
+os.environ.setdefault("ENABLE_BATCH_PROCESSOR", "False")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
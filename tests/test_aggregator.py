@@ -0,0 +1,78 @@
+import asyncio
+import os
+
+import batch
+from aggregator import WorkerAggregator
+
+KEY = ("agg", "2026-01-01", "pageViews")
+
+
+def _entries(value=1, key=KEY):
+    return [(key, {"$inc": {"data.total": value}})]
+
+
+def test_follower_sends_to_leader_and_takes_over_after_leader_stops(tmp_path):
+    socket_path = os.path.join(str(tmp_path), "a.sock")
+    received = []
+
+    async def on_entries(entries):
+        received.extend(entries)
+        return []
+
+    async def run():
+        leader = WorkerAggregator(socket_path, on_entries)
+        follower = WorkerAggregator(socket_path, on_entries)
+        await leader.start()
+        await follower.start()
+        assert leader.is_leader and not follower.is_leader
+
+        assert await follower.send(_entries(2))
+        assert received == _entries(2)
+
+        await leader.stop()
+        # leader退出后follower接替，本次由调用方直接写库
+        assert not await follower.send(_entries(3))
+        assert follower.is_leader
+        await follower.stop()
+
+    asyncio.run(run())
+
+
+def test_stopped_leader_does_not_become_leader_again(tmp_path):
+    socket_path = os.path.join(str(tmp_path), "a.sock")
+
+    async def on_entries(entries):
+        return []
+
+    async def run():
+        aggregator = WorkerAggregator(socket_path, on_entries)
+        await aggregator.start()
+        assert aggregator.is_leader
+        await aggregator.stop()
+
+        # 停止过程中刷新剩余数据时，锁已空闲也不能重新成为leader
+        assert not await aggregator.send(_entries())
+        assert not aggregator.is_leader
+        assert aggregator._lock_fd is None
+        assert not os.path.exists(socket_path)
+
+    asyncio.run(run())
+
+
+def test_processor_stop_writes_remaining_entries_locally(tmp_path):
+    socket_path = os.path.join(str(tmp_path), "a.sock")
+    key = ("agg-stop", "2026-01-01", "pageViews")
+
+    async def run():
+        processor = batch.BatchProcessor()
+        processor.aggregator = WorkerAggregator(socket_path, processor._accept_aggregated)
+        await processor.start()
+        assert processor.aggregator.is_leader
+        for _ in range(3):
+            assert await processor.add(key, {"$inc": {"data.total": 1}})
+        await processor.stop()
+        assert not processor.aggregator.is_leader
+        return [doc async for doc in batch.stats_storage.find_days({"system": "agg-stop"}, {})]
+
+    days = asyncio.run(run())
+    assert days[0]["data"]["total"] == 3
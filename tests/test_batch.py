@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+import batch
+from wal import WriteAheadLog
+
+
+def _days(system):
+    async def run():
+        return [doc async for doc in batch.stats_storage.find_days({"system": system}, {})]
+    return asyncio.run(run())
+
+
+def test_stop_is_bounded_when_writes_keep_failing(tmp_path, monkeypatch):
+    async def failing_updates(updates):
+        raise ConnectionError("storage down")
+
+    monkeypatch.setattr(batch.stats_storage, "apply_updates", failing_updates)
+    monkeypatch.setattr(batch, "BATCH_STOP_TIMEOUT", 0.3)
+    monkeypatch.setattr(batch, "BATCH_RETRY_BASE_DELAY", 1.0)
+
+    async def run():
+        processor = batch.BatchProcessor()
+        processor.wal = WriteAheadLog(str(tmp_path), fsync_interval=0)
+        await processor.start()
+        for i in range(5):
+            assert await processor.add((f"stop-{i}", "2026-01-01", "pageViews"), {"$inc": {"data.total": 1}})
+        started = time.monotonic()
+        await processor.stop()
+        return time.monotonic() - started, processor
+
+    elapsed, processor = asyncio.run(run())
+    # 不等待1、2、4秒的退避，未写入的数据保留在预写日志中
+    assert elapsed < 1.0
+    assert processor.wal.get_metrics()["outstanding_records"] == 5
+
+
+def test_failed_sketch_update_is_retried_without_counters(monkeypatch):
+    async def failing_sketch(key, sketch_values):
+        raise ConnectionError("sketch write failed")
+
+    monkeypatch.setattr(batch, "apply_hll_updates", failing_sketch)
+    key = ("sketch", "2026-01-01", "pageViews")
+    update_fields = {"$inc": {"data.total": 2}, "$addToSet": {"data.uniqueUsers": {"$each": ["a", "b"]}}}
+
+    async def run():
+        processor = batch.BatchProcessor()
+        retries = await processor._apply_sketch_updates(
+            [(key, update_fields)], {0: {"data.hll.uniqueUsers": {"a", "b"}}})
+        return processor, retries
+
+    processor, retries = asyncio.run(run())
+    assert retries == [(key, {"$addToSet": update_fields["$addToSet"]}, 0)]
+    assert processor.metrics["hll_sketch_errors"] == 1
+
+
+def test_only_failed_user_dimension_buckets_are_retried(monkeypatch):
+    from pymongo.errors import BulkWriteError
+
+    class PartiallyFailingCollection:
+        async def bulk_write(self, operations, ordered=True):
+            raise BulkWriteError({'writeErrors': [{'index': 1, 'errmsg': 'failed'}]})
+
+    monkeypatch.setattr(batch, "user_stats_collection", PartiallyFailingCollection())
+    key = ("buckets", "2026-01-01", "pageViews")
+    user_updates = {("byUser", 0): {"data.u1": 1}, ("byUrlAndUser", 2): {"data.p_dot_html.u2": 2}}
+
+    async def run():
+        processor = batch.BatchProcessor()
+        retries = await processor._apply_user_dimension_updates([(key, {})], {0: user_updates})
+        return processor, retries
+
+    processor, retries = asyncio.run(run())
+    # 第一个分桶已写入，只重试失败的分桶，字段还原为每日文档中的路径
+    assert retries == [(key, {"$inc": {"data.byUrlAndUser.p_dot_html.u2": 2}}, 0)]
+    assert processor.metrics["user_dimension_errors"] == 1
+
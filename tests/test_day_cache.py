@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+
+import day_cache
+from day_cache import DayStatsCache
+
+_OPERATORS = {'$gte': lambda a, b: a >= b, '$lte': lambda a, b: a <= b, '$lt': lambda a, b: a < b}
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self._documents = documents
+
+    def sort(self, field, direction):
+        return FakeCursor(sorted(self._documents, key=lambda doc: doc[field], reverse=direction < 0))
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self._documents:
+            yield dict(document)
+
+
+class FakeStatsCollection:
+    def __init__(self):
+        self.documents = []
+        self.full_reads = 0
+
+    @staticmethod
+    def _matches(document, query):
+        for field, condition in query.items():
+            if isinstance(condition, dict):
+                if not all(_OPERATORS[op](document[field], value) for op, value in condition.items()):
+                    return False
+            elif document.get(field) != condition:
+                return False
+        return True
+
+    def find(self, query, projection):
+        if 'data' not in projection:
+            documents = [{field: doc[field] for field in projection if field in doc}
+                         for doc in self.documents if self._matches(doc, query)]
+        else:
+            self.full_reads += 1
+            documents = [doc for doc in self.documents if self._matches(doc, query)]
+        return FakeCursor(documents)
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    collection = FakeStatsCollection()
+    for day, total in (('2026-01-01', 1), ('2026-01-02', 2), ('2026-01-03', 4)):
+        collection.documents.append({'system': 's', 'type': 'pageViews', 'date': day, 'lastUpdated': day,
+                                     'data': {'total': total}})
+    monkeypatch.setattr(day_cache, 'stats_collection', collection)
+    monkeypatch.setattr(day_cache, 'current_bucket', lambda: '2026-01-03')
+    return collection
+
+
+async def _merge(cursor):
+    partial = {'total': 0, 'dates': []}
+    async for document in cursor:
+        partial['total'] += document['data']['total']
+        partial['dates'].append(document['date'])
+    return partial
+
+
+def _query():
+    return {'system': 's', 'type': 'pageViews', 'date': {'$gte': '2026-01-01'}}
+
+
+def _merged(cache):
+    return asyncio.run(cache.merged_closed_days(_query(), {'_id': 0, 'data': 1, 'date': 1}, (10,), _merge))
+
+
+def test_closed_days_are_merged_once(collection):
+    cache = DayStatsCache(10)
+    partial, fresh_query = _merged(cache)
+    assert partial == {'total': 3, 'dates': ['2026-01-01', '2026-01-02']}
+    assert fresh_query['date'] == {'$gte': '2026-01-03'}
+
+    # 调用方修改返回的部分结果不影响缓存
+    partial['total'] += 100
+    again, _ = _merged(cache)
+    assert again == {'total': 3, 'dates': ['2026-01-01', '2026-01-02']}
+    assert collection.full_reads == 1
+    assert cache.get_metrics()['hits'] == 1
+
+
+@pytest.mark.parametrize('field', ['lastUpdated', 'hllVersion', 'topKVersion'])
+def test_version_change_invalidates(collection, field):
+    cache = DayStatsCache(10)
+    _merged(cache)
+    collection.documents[0][field] = 'changed'
+    collection.documents[0]['data']['total'] = 10
+    partial, _ = _merged(cache)
+    assert partial['total'] == 12
+    assert cache.late_write_invalidations == 1
+
+
+def test_deleted_day_invalidates(collection):
+    cache = DayStatsCache(10)
+    _merged(cache)
+    del collection.documents[0]
+    partial, _ = _merged(cache)
+    assert partial == {'total': 2, 'dates': ['2026-01-02']}
+
+
+def test_cache_is_bounded_by_bytes(collection):
+    cache = DayStatsCache(10)
+    _merged(cache)
+    entry_bytes = cache.get_metrics()['bytes']
+
+    small = DayStatsCache(10, max_bytes=entry_bytes - 1)
+    _merged(small)
+    assert small.get_metrics()['size'] == 0
+
+    bounded = DayStatsCache(10, max_bytes=entry_bytes * 2)
+    for start in ('2026-01-01', '2026-01-02', '2025-12-31'):
+        query = dict(_query(), date={'$gte': start})
+        asyncio.run(bounded.merged_closed_days(query, {'_id': 0, 'data': 1, 'date': 1}, (10,), _merge))
+    metrics = bounded.get_metrics()
+    assert metrics['bytes'] <= entry_bytes * 2
+    assert metrics['evictions'] >= 1
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+import dimension_dict
+from dimension_dict import DimensionDictionary, collect_keys
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self._documents = documents
+
+    def limit(self, count):
+        return FakeCursor(self._documents[:count])
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self._documents:
+            yield dict(document)
+
+
+class FakeDictCollection:
+    def __init__(self):
+        self.documents = []
+        self.calls = 0
+
+    def find(self, query, projection):
+        self.calls += 1
+        documents = [doc for doc in self.documents if doc['system'] == query['system']]
+        for field in ('value', 'id'):
+            if field in query:
+                documents = [doc for doc in documents if doc[field] in query[field]['$in']]
+        return FakeCursor(documents)
+
+    async def insert_many(self, documents, ordered):
+        self.calls += 1
+        self.documents.extend(documents)
+
+
+class FakeSitesCollection:
+    def __init__(self):
+        self.seq = {'s': 0}
+        self.calls = 0
+
+    async def find_one_and_update(self, query, update, projection, return_document):
+        self.calls += 1
+        system = query['site_name']
+        if system not in self.seq:
+            return None
+        self.seq[system] += update['$inc']['dimension_seq']
+        return {'dimension_seq': self.seq[system]}
+
+
+@pytest.fixture
+def collections(monkeypatch):
+    dictionary, sites = FakeDictCollection(), FakeSitesCollection()
+    dictionary.documents.append({'system': 's', 'value': 'engagement', 'id': 1})
+    sites.seq['s'] = 1
+    monkeypatch.setattr(dimension_dict, 'dimension_dict_collection', dictionary)
+    monkeypatch.setattr(dimension_dict, 'sites_collection', sites)
+    return dictionary, sites
+
+
+def test_encode_uses_cache_and_allocates_in_background(collections):
+    dictionary, sites = collections
+    cache = DimensionDictionary(100)
+
+    async def run():
+        # 请求路径不访问数据库：首次上报按原值写入，后台预加载并分配id
+        first = cache.encode('s', ['engagement', '/home'])
+        assert first == {}
+        assert dictionary.calls == 0 and sites.calls == 0
+        await cache._task
+        second = cache.encode('s', ['engagement', '/home'])
+        return second
+
+    keys = asyncio.run(run())
+    assert keys == {'engagement': '~1', '/home': '~2'}
+    assert cache.metrics['preloaded_sites'] == 1
+    assert cache.metrics['allocated'] == 1
+
+
+def test_unknown_site_stays_raw(collections):
+    cache = DimensionDictionary(100)
+
+    async def run():
+        cache.encode('missing', ['/home'])
+        await cache._task
+        return cache.encode('missing', ['/home'])
+
+    assert asyncio.run(run()) == {}
+    assert cache.metrics['unresolved'] >= 1
+
+
+def test_mixed_composite_key_decodes_each_segment(collections):
+    cache = DimensionDictionary(100)
+    data = {'byCategoryAndAction': {'~1.click': 3, 'legacy_dot_x.~1': 1, 'a.b': 2}}
+    keys = collect_keys(data)
+    assert keys == {'~1.click', 'legacy_dot_x.~1'}
+    decoded = asyncio.run(cache.decode('s', keys, lambda part: part.replace('_dot_', '.')))
+    assert decoded == {'~1.click': 'engagement.click', 'legacy_dot_x.~1': 'legacy.x.engagement'}
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from storage import SQLiteStatsStorage, apply_update_document
+
+# 每条用例：(初始文档, 更新, MongoDB执行后的文档)
+MONGO_CASES = [
+    # $inc创建缺失的字段和中间文档
+    ({}, {'$inc': {'data.total': 2, 'data.byUrl.a': 1}}, {'data': {'total': 2, 'byUrl': {'a': 1}}}),
+    ({'data': {'total': 1.5}}, {'$inc': {'data.total': 2}}, {'data': {'total': 3.5}}),
+    # $set覆盖已有值（包括子文档）
+    ({'data': {'byUrl': {'a': 1}}}, {'$set': {'data.byUrl': {'b': 2}, 'lastUpdated': 'x'}},
+     {'data': {'byUrl': {'b': 2}}, 'lastUpdated': 'x'}),
+    # $addToSet：单个值、$each，去重并保持插入顺序
+    ({}, {'$addToSet': {'data.users': 'u1'}}, {'data': {'users': ['u1']}}),
+    ({'data': {'users': ['u1']}}, {'$addToSet': {'data.users': {'$each': ['u2', 'u1', 'u2', 'u3']}}},
+     {'data': {'users': ['u1', 'u2', 'u3']}}),
+    # $max：缺失时设置，只在更大时替换
+    ({}, {'$max': {'data.maxDuration': 5}}, {'data': {'maxDuration': 5}}),
+    ({'data': {'maxDuration': 9}}, {'$max': {'data.maxDuration': 5}}, {'data': {'maxDuration': 9}}),
+    ({'data': {'maxDuration': 3}}, {'$max': {'data.maxDuration': 5}}, {'data': {'maxDuration': 5}}),
+    # 同一更新中的多个操作符
+    ({'data': {'total': 1}},
+     {'$inc': {'data.total': 1}, '$addToSet': {'data.users': {'$each': ['u1']}}, '$set': {'lastUpdated': 'y'}},
+     {'data': {'total': 2, 'users': ['u1']}, 'lastUpdated': 'y'}),
+]
+
+# MongoDB会拒绝的更新（整个更新不生效）
+MONGO_ERRORS = [
+    ({'data': {'total': 'x'}}, {'$inc': {'data.total': 1}}),
+    ({'data': {'users': 'u1'}}, {'$addToSet': {'data.users': 'u2'}}),
+    ({'data': 5}, {'$inc': {'data.total': 1}}),
+    ({}, {'$unset': {'data.total': ''}}),
+]
+
+
+@pytest.mark.parametrize('document, update, expected', MONGO_CASES)
+def test_apply_update_document_matches_mongo(document, update, expected):
+    apply_update_document(document, update)
+    assert document == expected
+
+
+@pytest.mark.parametrize('document, update', MONGO_ERRORS)
+def test_apply_update_document_rejects_like_mongo(document, update):
+    with pytest.raises(ValueError):
+        apply_update_document(document, update)
+
+
+def test_failed_update_leaves_stored_document_unchanged():
+    storage = SQLiteStatsStorage(':memory:')
+
+    async def run():
+        await storage.apply_updates([(('s', '2026-01-01', 'pageViews'), {'$set': {'data.total': 'x'}})])
+        failed = await storage.apply_updates([
+            (('s', '2026-01-01', 'events'), {'$inc': {'data.total': 1}}),
+            (('s', '2026-01-01', 'pageViews'), {'$inc': {'data.total': 1}, '$set': {'data.other': 1}}),
+        ])
+        documents = [doc async for doc in storage.find_days({'system': 's'}, {'_id': 0, 'type': 1, 'data': 1})]
+        return failed, documents
+
+    failed, documents = asyncio.run(run())
+    storage.close()
+    # 与MongoDB一样按更新原子生效：失败的更新不写入任何字段，同一批的其他更新正常写入
+    assert failed == {1}
+    assert sorted(documents, key=lambda doc: doc['type']) == [
+        {'type': 'events', 'data': {'total': 1}},
+        {'type': 'pageViews', 'data': {'total': 'x'}},
+    ]
+
+
+def test_find_days_returns_stored_keys_and_projection():
+    storage = SQLiteStatsStorage(':memory:')
+
+    async def run():
+        await storage.apply_updates([
+            (('s', '2026-01-02', 'events'), {'$inc': {'data.total': 1, 'data.byUrl.a': 1}}),
+            (('s', '2026-01-01', 'pageViews'), {'$inc': {'data.total': 2, 'data.byUrl.a': 2}}),
+        ])
+        included = [doc async for doc in storage.find_days(
+            {'system': 's', 'type': {'$in': ['pageViews', 'events']}},
+            {'_id': 0, 'type': 1, 'date': 1, 'data.total': 1})]
+        excluded = [doc async for doc in storage.find_days(
+            {'system': 's', 'date': {'$gte': '2026-01-02'}}, {'_id': 0, 'data.byUrl': 0})]
+        return included, excluded
+
+    included, excluded = asyncio.run(run())
+    storage.close()
+    assert included == [{'type': 'pageViews', 'date': '2026-01-01', 'data': {'total': 2}},
+                        {'type': 'events', 'date': '2026-01-02', 'data': {'total': 1}}]
+    assert excluded == [{'data': {'total': 1}, 'system': 's', 'type': 'events', 'date': '2026-01-02'}]
@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException, Request
+
+import track
+
+SITE = {"site_name": "shop", "site_url": "https://shop.example"}
+
+
+class FakeSitesCollection:
+    def __init__(self, sites):
+        self.sites = sites
+        self.lookups = 0
+
+    async def find_one(self, query, projection):
+        self.lookups += 1
+        for site in self.sites:
+            if site["site_name"] == query["site_name"] and site["api_key"] == query["api_key"]:
+                return {field: site[field] for field in projection if field in site}
+        return None
+
+
+@pytest.fixture
+def sites(monkeypatch):
+    sites = FakeSitesCollection([dict(SITE, api_key="k")])
+    monkeypatch.setattr(track, "sites_collection", sites)
+    track.invalidate_site_cache()
+    yield sites
+    track.invalidate_site_cache()
+
+
+def _request(origin="https://shop.example"):
+    return Request({"type": "http", "path": "/api/track/batch", "query_string": b"",
+                    "headers": [(b"origin", origin.encode())], "client": ("10.1.2.3", 1234)})
+
+
+def _totals(system):
+    async def run():
+        totals = {}
+        for stats_type in ("pageViews", "downloads", "events", "duration"):
+            async for doc in track.stats_storage.find_days({"system": system, "type": stats_type}, {}):
+                totals[stats_type] = doc["data"]["total"]
+        return totals
+    return asyncio.run(run())
+
+
+def test_batch_reports_each_item_and_writes_accepted(sites):
+    items = [
+        {"type": "pageview", "url": "https://shop.example/a"},
+        "not an object",
+        {"type": "scroll"},
+        {"type": "pageview", "url": "https://other.example/"},
+        {"type": "event", "url": "https://shop.example/b", "eventCategory": "cart", "eventAction": "add"},
+        {"type": "pageview", "url": "https://shop.example/c"},
+    ]
+    result = asyncio.run(track.track_batch(_request(), {"system": "shop", "apiKey": "k", "items": items}))
+
+    assert (result["accepted"], result["rejected"]) == (3, 3)
+    assert [item["index"] for item in result["results"] if not item["accepted"]] == [1, 2, 3]
+    assert result["results"][2]["error"] == "Unsupported type: scroll"
+    # 同一批处理键的两条浏览记录合并后写入
+    assert _totals("shop") == {"pageViews": 2, "events": 1}
+    assert sites.lookups == 1
+
+
+def test_batch_falls_back_for_keys_the_queue_rejects(sites, monkeypatch):
+    class FullProcessor:
+        def __init__(self):
+            self.queued = []
+
+        async def add_many(self, entries):
+            # 队列只接受第一个批处理键
+            self.queued.extend(entries[:1])
+            return entries[1:]
+
+    processor = FullProcessor()
+    monkeypatch.setattr(track, "get_batch_processor", lambda: processor)
+    items = [{"type": "pageview", "url": "https://shop.example/a"},
+             {"type": "download", "url": "https://shop.example/a", "downloadUrl": "https://shop.example/f.zip"}]
+    data = {"system": "fallback", "apiKey": "k", "items": items}
+    sites.sites.append(dict(SITE, site_name="fallback", api_key="k"))
+
+    result = asyncio.run(track.track_batch(_request(), data))
+
+    assert result["accepted"] == 2
+    assert [key for key, _ in processor.queued] == [("fallback", track.current_bucket(), "pageViews")]
+    assert _totals("fallback") == {"downloads": 1}
+
+
+def test_unregistered_site_is_cached_until_invalidated(sites):
+    data = {"system": "new-site", "apiKey": "k2", "items": [{"type": "pageview", "url": "https://new.example/"}]}
+
+    for _ in range(2):
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(track.track_batch(_request("https://new.example"), data))
+        assert error.value.status_code == 404
+    # 负结果被缓存：第二次请求不查询数据库
+    assert sites.lookups == 1
+
+    # 注册网站后使缓存失效，立即生效而不必等待负缓存过期
+    sites.sites.append({"site_name": "new-site", "site_url": "https://new.example", "api_key": "k2"})
+    assert track.invalidate_site_cache("new-site") == 1
+    result = asyncio.run(track.track_batch(_request("https://new.example"), data))
+    assert result["accepted"] == 1
+    assert sites.lookups == 2
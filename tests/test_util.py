@@ -0,0 +1,133 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException, Request
+
+import security
+from util import access_system, lru_cache_with_ttl
+
+
+def test_async_concurrent_calls_share_one_execution():
+    calls = []
+
+    @lru_cache_with_ttl(maxsize=10, ttl=60)
+    async def load(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return key * 2
+
+    async def run():
+        return await asyncio.gather(*(load(3) for _ in range(5)))
+
+    assert asyncio.run(run()) == [6] * 5
+    assert calls == [3]
+    assert load.cache_info()['shared'] == 4
+
+
+def test_async_failure_is_not_shared_with_waiters():
+    calls = []
+
+    @lru_cache_with_ttl(maxsize=10, ttl=60)
+    async def load(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        if len(calls) == 1:
+            raise RuntimeError("first call fails")
+        return key
+
+    async def run():
+        return await asyncio.gather(load(1), load(1), return_exceptions=True)
+
+    leader, waiter = asyncio.run(run())
+    assert isinstance(leader, RuntimeError)
+    assert waiter == 1
+    assert len(calls) == 2
+
+
+def test_async_leader_cancellation_does_not_cancel_waiters():
+    @lru_cache_with_ttl(maxsize=10, ttl=60)
+    async def load(key):
+        await asyncio.sleep(0.02)
+        return key
+
+    async def run():
+        leader = asyncio.ensure_future(load(7))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(load(7))
+        await asyncio.sleep(0)
+        leader.cancel()
+        result = await waiter
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return result
+
+    assert asyncio.run(run()) == 7
+    assert load.cache_info()['size'] == 1
+
+
+def test_sync_calls_for_same_key_never_run_concurrently():
+    running, overlaps = [0], []
+    guard = threading.Lock()
+
+    @lru_cache_with_ttl(maxsize=10, ttl=0)  # 不缓存结果，每次调用都执行
+    def load(key):
+        with guard:
+            running[0] += 1
+            overlaps.append(running[0])
+        time.sleep(0.005)
+        with guard:
+            running[0] -= 1
+        return key
+
+    threads = [threading.Thread(target=load, args=(1,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(overlaps) == 1
+
+
+def _request(system: str, user: str) -> Request:
+    request = Request({'type': 'http', 'path_params': {'system': system}, 'query_string': b'', 'headers': []})
+    request.state.user = user
+    return request
+
+
+def test_permission_is_checked_before_cached_result(monkeypatch):
+    users = {
+        'owner': SimpleNamespace(permissions=['site'], is_super=False),
+        'other': SimpleNamespace(permissions=[], is_super=False),
+    }
+
+    async def get_current_user(request):
+        return users[request.state.user]
+
+    monkeypatch.setattr(security, 'get_current_user', get_current_user)
+    calls = []
+
+    @access_system("${system}")
+    @lru_cache_with_ttl(maxsize=10, ttl=60)
+    async def stats(request, system):
+        calls.append(system)
+        await asyncio.sleep(0.01)
+        return {'system': system}
+
+    async def run():
+        return await asyncio.gather(
+            stats(_request('site', 'other'), 'site'),
+            stats(_request('site', 'owner'), 'site'),
+            stats(_request('site', 'owner'), 'site'),
+            return_exceptions=True,
+        )
+
+    denied, first, second = asyncio.run(run())
+    assert isinstance(denied, HTTPException) and denied.status_code == 403
+    assert first == second == {'system': 'site'}
+    assert calls == ['site']
+
+    # 缓存命中也不能绕过权限检查
+    with pytest.raises(HTTPException):
+        asyncio.run(stats(_request('site', 'other'), 'site'))
@@ -0,0 +1,105 @@
+import asyncio
+import os
+
+import batch
+
+from wal import WriteAheadLog
+
+
+def _crash(wal: WriteAheadLog):
+    """模拟进程崩溃：不调用close()，直接释放文件和目录锁"""
+    wal._file.flush()
+    wal._file.close()
+    os.close(wal._lock_fd)
+
+
+def _replay(base_dir: str):
+    replayer = WriteAheadLog(base_dir)
+    replayer.dir = os.path.join(base_dir, "wal-replayer")
+    records = []
+    for directory, lock_fd in replayer.claim_orphan_dirs():
+        records.extend(replayer.read_dir(directory))
+        replayer.remove_orphan_dir(directory, lock_fd)
+    return records
+
+
+def _entries(count, start=0):
+    return [(("s", "2026-01-01", "pageViews"), {"$inc": {"data.total": i}}) for i in range(start, start + count)]
+
+
+def test_released_records_are_not_replayed_after_crash(tmp_path):
+    wal = WriteAheadLog(str(tmp_path))
+    wal.open()
+    records = wal.append(_entries(5))
+    wal.release(records)
+    _crash(wal)
+
+    assert _replay(str(tmp_path)) == []
+
+
+def test_only_unreleased_records_are_replayed(tmp_path):
+    wal = WriteAheadLog(str(tmp_path))
+    wal.open()
+    records = wal.append(_entries(5))
+    wal.release([records[0], records[1], records[3]])
+    _crash(wal)
+
+    replayed = [update_fields["$inc"]["data.total"] for _, update_fields in _replay(str(tmp_path))]
+    assert replayed == [2, 4]
+
+
+def test_close_keeps_only_unreleased_records(tmp_path):
+    """关闭超时时仍有未写库的记录，目录保留，下次启动只回放这些记录"""
+    wal = WriteAheadLog(str(tmp_path))
+    wal.open()
+    released = wal.append(_entries(3))
+    wal.append(_entries(2, start=3))
+    wal.release(released)
+    wal.close()
+
+    replayed = [update_fields["$inc"]["data.total"] for _, update_fields in _replay(str(tmp_path))]
+    assert replayed == [3, 4]
+
+
+def test_sealed_segments_are_deleted_when_released(tmp_path):
+    wal = WriteAheadLog(str(tmp_path), segment_max_bytes=1)
+    wal.open()
+    first = wal.append(_entries(2))
+    second = wal.append(_entries(1))  # 第一段已满，轮转到新段
+    assert first[0][0] != second[0][0]
+
+    wal.release(first)
+    assert wal.metrics["segments_deleted"] == 1
+    assert sorted(os.listdir(wal.dir)) == [".lock", f"{second[0][0]:08d}.log"]
+
+    wal.release(second)
+    wal.close()
+    assert not os.path.exists(wal.dir)
+
+
+def test_running_worker_directory_is_not_claimed(tmp_path):
+    wal = WriteAheadLog(str(tmp_path))
+    wal.open()
+    wal.append(_entries(1))
+    try:
+        assert _replay(str(tmp_path)) == []
+    finally:
+        wal.close()
+
+
+def test_batch_flush_releases_records(tmp_path):
+    async def run():
+        processor = batch.BatchProcessor()
+        processor.wal = WriteAheadLog(str(tmp_path), fsync_interval=0)
+        processor.wal.open()
+        key = ("wal-flush", "2026-01-01", "pageViews")
+        for _ in range(3):
+            assert await processor.add(key, {"$inc": {"data.total": 1}})
+        await processor._flush_batch(force=True)
+        _crash(processor.wal)
+        days = [doc async for doc in batch.stats_storage.find_days({"system": "wal-flush"}, {})]
+        return days
+
+    days = asyncio.run(run())
+    assert days[0]["data"]["total"] == 3
+    assert _replay(str(tmp_path)) == []
@@ -0,0 +1,387 @@
+import logging
+import os
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from bson import Binary
+
+import hll
+from mongodb import sites_collection
+from util import BoundedTTLCache
+
+# 站点top-K配置（sites文档的top_k字段）的缓存时间（秒）
+TOPK_CONFIG_TTL = float(os.getenv("TOPK_CONFIG_TTL", "60"))
+# 每个进程最多保留的Space-Saving摘要数（每个(system, date, type)文档一个）
+TOPK_MAX_SUMMARIES = int(os.getenv("TOPK_MAX_SUMMARIES", "1024"))
+# 摘要空闲多久后丢弃（秒），再次写入时从文档重新载入
+TOPK_SUMMARY_TTL = float(os.getenv("TOPK_SUMMARY_TTL", "7200"))
+# 每次刷新每个文档最多折叠的被淘汰键数
+TOPK_FOLD_BATCH = int(os.getenv("TOPK_FOLD_BATCH", "200"))
+
+# 未进入top-K的键统一计入该键
+OTHER_KEY = '(other)'
+
+# 各统计类型中值为自由输入的维度：{统计类型: {摘要维度: ((以同一个值为键的维度, 键所在层级), ...)}}
+# 摘要维度本身只有一级键，计数用于Space-Saving排名；层级0的依赖维度在键被淘汰时一起折叠进(other)
+TOPK_DIMENSIONS = {
+    'pageViews': {
+        'byUrl': (('byUrlAndIPPrefix', 0), ('byUrlAndUser', 0), ('byUrlAndBrowser', 0), ('byUrlAndDevice', 0),
+                  ('byUrlAndReferrer', 0), ('byUrlUniqueUsers', 0)),
+        'byReferrer': (('byUrlAndReferrer', 1),),
+    },
+    'downloads': {
+        'byFile': (('byFileAndIPPrefix', 0), ('byFileAndUser', 0), ('byFileAndSource', 0), ('byFileUniqueUsers', 0)),
+        'byUrl': (),
+        'bySourcePage': (('byFileAndSource', 1),),
+    },
+    'events': {
+        'byLabel': (('byCategoryAndLabel', 1),),
+        'bySelector': (),
+        'byUrl': (('byUrlAndAction', 0),),
+    },
+    'duration': {
+        'byUrl': (('byUrlAndIPPrefix', 0), ('byUrlAndUser', 0), ('byUrlAndBrowser', 0), ('byUrlAndDevice', 0),
+                  ('byUrlUniqueUsers', 0)),
+    },
+}
+
+logger = logging.getLogger(__name__)
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class SpaceSaving:
+    """
+    Space-Saving摘要（Metwally等），最多跟踪capacity个键
+    count为键被跟踪期间的实际计数（写入文档的值，是下界），error为键进入摘要时淘汰的最小排名（上界余量）
+    键的真实计数在 [count, count + error] 之间；被淘汰键的计数折叠进(other)，总数保持不变
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: Dict[str, float] = {}
+        self.errors: Dict[str, float] = {}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.counts
+
+    def rank(self, key: str) -> float:
+        return self.counts[key] + self.errors[key]
+
+    def offer(self, key: str, increment: float) -> Optional[str]:
+        """计入一个键，摘要已满时淘汰排名最小的键并返回它"""
+        if key in self.counts:
+            self.counts[key] += increment
+            return None
+        if len(self.counts) < self.capacity:
+            self.counts[key] = increment
+            self.errors[key] = 0
+            return None
+        victim = min(self.counts, key=self.rank)
+        floor = self.rank(victim)
+        del self.counts[victim], self.errors[victim]
+        self.counts[key] = increment
+        self.errors[key] = floor
+        return victim
+
+
+class _DocumentSummaries:
+    """一个统计文档的各维度摘要，以及已写入文档、等待折叠进(other)的被淘汰键"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.summaries: Dict[str, SpaceSaving] = {}
+        self.pending: Dict[str, set] = {}
+
+
+class TopKLimiter:
+    """
+    按站点开启的top-K模式：批量刷新时用Space-Saving摘要限制自由输入维度的键数
+    1. 摘要维度（byUrl、byReferrer等）只写入摘要中的K个键，其余计入(other)
+    2. 以同一个值为键的组合维度和唯一用户维度同步改写，被淘汰的键在计数写入成功后折叠进(other)
+    3. 新进入摘要的键在 data.topKErrors.<维度>.<键> 记录误差上界
+    摘要保存在写库进程内（启用多worker预聚合时只有leader写库，摘要是全局的）；
+    多个进程各自写库时每个进程最多引入K个键，误差也只反映本进程看到的数据
+    """
+
+    def __init__(self, skip_dimensions: Iterable[str] = ()):
+        # 不在统计文档内的维度（按用户指纹分桶存储），只改写不折叠
+        self.skip_dimensions = set(skip_dimensions)
+        self._config = BoundedTTLCache(maxsize=1024, ttl=TOPK_CONFIG_TTL)
+        self._documents = BoundedTTLCache(maxsize=TOPK_MAX_SUMMARIES, ttl=TOPK_SUMMARY_TTL)
+        self.metrics = {
+            'documents_loaded': 0,
+            'remapped_fields': 0,
+            'evictions': 0,
+            'folded_keys': 0,
+            'fold_conflicts': 0,
+            'fold_errors': 0,
+        }
+
+    async def site_top_k(self, system: str) -> int:
+        """站点配置的K，未开启时为0"""
+        hit, top_k = self._config.get(system)
+        if not hit:
+            site = await sites_collection.find_one({'site_name': system}, {'_id': 0, 'top_k': 1})
+            top_k = int((site or {}).get('top_k') or 0)
+            self._config.set(system, top_k)
+        return top_k
+
+    def invalidate_site(self, system: Optional[str] = None):
+        """站点配置变化时调用（只作用于当前进程，其他进程依赖TTL过期）"""
+        if system is None:
+            self._config.invalidate()
+            self._documents.invalidate()
+            return
+        self._config.invalidate(lambda key: key == system)
+        self._documents.invalidate(lambda key: key[0] == system)
+
+    async def _load(self, key: Tuple[str, str, str], target: Tuple[Any, dict], top_k: int) -> _DocumentSummaries:
+        """从文档载入摘要（每个进程每个文档一次），文档中超出K的键排入待折叠"""
+        collection, filter_criteria = target
+        dimensions = TOPK_DIMENSIONS[key[2]]
+        projection = {'_id': 0}
+        for dimension in dimensions:
+            projection[f'data.{dimension}'] = 1
+            projection[f'data.topKErrors.{dimension}'] = 1
+        document = await collection.find_one(filter_criteria, projection) or {}
+        data = document.get('data', {})
+        errors = data.get('topKErrors', {})
+
+        state = _DocumentSummaries(top_k)
+        for dimension in dimensions:
+            summary = SpaceSaving(top_k)
+            dimension_errors = errors.get(dimension, {})
+            entries = [(k, v, dimension_errors.get(k, 0)) for k, v in data.get(dimension, {}).items()
+                       if k != OTHER_KEY and _is_number(v)]
+            entries.sort(key=lambda entry: entry[1] + entry[2], reverse=True)
+            for k, count, error in entries[:top_k]:
+                summary.counts[k] = count
+                summary.errors[k] = error
+            if len(entries) > top_k:
+                state.pending[dimension] = {k for k, _, _ in entries[top_k:]}
+            state.summaries[dimension] = summary
+        self.metrics['documents_loaded'] += 1
+        return state
+
+    async def apply(self, key: Tuple[str, str, str], update_fields: Dict[str, Any],
+                    target: Tuple[Any, dict]) -> Dict[str, Any]:
+        """
+        用摘要改写一个文档的合并更新，站点未开启top-K时原样返回
+        :param key: 批处理键 (system, date, type)
+        :param update_fields: 合并后的更新操作
+        :param target: (集合, 查询条件)，载入摘要和折叠时使用
+        """
+        system, _, track_type = key
+        if track_type not in TOPK_DIMENSIONS:
+            return update_fields
+        top_k = await self.site_top_k(system)
+        if top_k <= 0:
+            return update_fields
+
+        hit, state = self._documents.get(key)
+        if not hit or state.capacity != top_k:
+            state = await self._load(key, target, top_k)
+        self._documents.set(key, state)
+
+        increments = update_fields.get('$inc', {})
+        new_errors = {}
+        for dimension, summary in state.summaries.items():
+            prefix = f'data.{dimension}.'
+            offers = [(field[len(prefix):], value) for field, value in increments.items()
+                      if field.startswith(prefix) and field.count('.') == 2 and _is_number(value)]
+            # 本批次计数大的先进入摘要，同批次中进入又被淘汰的键不会写入文档
+            offers.sort(key=lambda offer: offer[1], reverse=True)
+            admitted = set()
+            for k, value in offers:
+                # 停留时长的 byUrl.count 是会话数字典，不作为键
+                if k == OTHER_KEY or (track_type == 'duration' and k == 'count'):
+                    continue
+                was_tracked = k in summary
+                victim = summary.offer(k, value)
+                if not was_tracked:
+                    admitted.add(k)
+                if victim is None:
+                    continue
+                self.metrics['evictions'] += 1
+                if victim in admitted:
+                    admitted.discard(victim)
+                else:
+                    state.pending.setdefault(dimension, set()).add(victim)
+            for k in admitted:
+                state.pending.get(dimension, set()).discard(k)
+                if summary.errors[k]:
+                    new_errors[f'data.topKErrors.{dimension}.{k}'] = summary.errors[k]
+
+        rewritten = self._remap(track_type, update_fields, state)
+        if new_errors:
+            rewritten.setdefault('$max', {}).update(new_errors)
+        return rewritten
+
+    def _remap_field(self, track_type: str, field: str, state: _DocumentSummaries) -> str:
+        """把字段路径中未被摘要跟踪的键替换为(other)"""
+        parts = field.split('.')
+        if len(parts) < 3 or parts[0] != 'data':
+            return field
+        changed = False
+        for dimension, dependents in TOPK_DIMENSIONS[track_type].items():
+            summary = state.summaries[dimension]
+            for target, level in ((dimension, 0),) + dependents:
+                if parts[1] != target:
+                    continue
+                index = 2 + level
+                # 停留时长的会话数字段多一级 count（data.byUrl.count.<url>）
+                if track_type == 'duration' and parts[2] == 'count' and len(parts) > 3:
+                    index += 1
+                if index < len(parts) and parts[index] != OTHER_KEY and parts[index] not in summary:
+                    parts[index] = OTHER_KEY
+                    changed = True
+        if not changed:
+            return field
+        self.metrics['remapped_fields'] += 1
+        return '.'.join(parts)
+
+    def _remap(self, track_type: str, update_fields: Dict[str, Any], state: _DocumentSummaries) -> Dict[str, Any]:
+        rewritten = dict(update_fields)
+        if '$inc' in update_fields:
+            increments = {}
+            for field, value in update_fields['$inc'].items():
+                field = self._remap_field(track_type, field, state)
+                increments[field] = increments.get(field, 0) + value
+            rewritten['$inc'] = increments
+        if '$addToSet' in update_fields:
+            unique_users = {}
+            for field, value in update_fields['$addToSet'].items():
+                values = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                unique_users.setdefault(self._remap_field(track_type, field, state), set()).update(values)
+            rewritten['$addToSet'] = {
+                field: values.pop() if len(values) == 1 else {'$each': list(values)}
+                for field, values in unique_users.items()
+            }
+        return rewritten
+
+    async def fold_pending(self, key: Tuple[str, str, str], target: Tuple[Any, dict]):
+        """
+        把已写入文档的被淘汰键折叠进(other)（计数写入成功后调用）
+        读取被淘汰键的全部字段，以读到的值为条件更新（其他进程同时写入时本次放弃，下次刷新重试）
+        """
+        hit, state = self._documents.get(key)
+        if not hit:
+            return
+        collection, filter_criteria = target
+        track_type = key[2]
+        for dimension, victims in state.pending.items():
+            if not victims:
+                continue
+            batch = sorted(victims)[:TOPK_FOLD_BATCH]
+            try:
+                folded = await self._fold(collection, filter_criteria, track_type, dimension, batch)
+            except Exception as e:
+                logger.error(f"Top-K fold failed for {key} {dimension}: {e}", exc_info=True)
+                self.metrics['fold_errors'] += 1
+                continue
+            if folded:
+                victims.difference_update(batch)
+                self.metrics['folded_keys'] += len(batch)
+            else:
+                self.metrics['fold_conflicts'] += 1
+
+    def _fold_paths(self, track_type: str, dimension: str, victim: str) -> List[Tuple[str, str]]:
+        """被淘汰键在文档中的字段路径及其对应的(other)路径"""
+        prefixes = [f'data.{dimension}']
+        for dependent, level in TOPK_DIMENSIONS[track_type][dimension]:
+            if level != 0 or dependent in self.skip_dimensions:
+                continue
+            if dependent.endswith('UniqueUsers'):
+                prefixes.append(f'data.hll.{dependent}' if hll.HLL_ENABLED else f'data.{dependent}')
+            else:
+                prefixes.append(f'data.{dependent}')
+        if track_type == 'duration':
+            prefixes += [f'{prefix}.count' for prefix in prefixes if not prefix.startswith('data.hll.')
+                         and not prefix.endswith('UniqueUsers')]
+        return [(f'{prefix}.{victim}', f'{prefix}.{OTHER_KEY}') for prefix in prefixes]
+
+    async def _fold(self, collection, filter_criteria: dict, track_type: str, dimension: str,
+                    victims: List[str]) -> bool:
+        paths = [(victim, path, other) for victim in victims
+                 for path, other in self._fold_paths(track_type, dimension, victim)]
+        projection = {'_id': 0}
+        for _, path, other in paths:
+            projection[path] = 1
+            if path.startswith('data.hll.'):
+                projection[other] = 1
+        document = await collection.find_one(filter_criteria, projection)
+        if not document:
+            return True
+
+        cas_filter = dict(filter_criteria)
+        size_checks = []
+        increments, unique_users, sketches, unset = {}, {}, {}, {}
+        for victim, path, other in paths:
+            unset[f'data.topKErrors.{dimension}.{victim}'] = ''
+            value = _get_path(document, path)
+            if value is None:
+                continue
+            unset[path] = ''
+            if _is_number(value):
+                cas_filter[path] = value
+                increments[other] = increments.get(other, 0) + value
+            elif isinstance(value, dict):
+                # 组合维度：逐个叶子作为条件，并要求没有新出现的子键
+                for sub_key, sub_value in value.items():
+                    if _is_number(sub_value):
+                        cas_filter[f'{path}.{sub_key}'] = sub_value
+                        field = f'{other}.{sub_key}'
+                        increments[field] = increments.get(field, 0) + sub_value
+                size_checks.append({'$eq': [{'$size': {'$objectToArray': f'${path}'}}, len(value)]})
+            elif isinstance(value, list):
+                cas_filter[path] = value
+                unique_users.setdefault(other, set()).update(value)
+            elif isinstance(value, bytes):
+                cas_filter[path] = value
+                if other not in sketches:
+                    existing = _get_path(document, other)
+                    cas_filter[other] = existing if existing is not None else {'$exists': False}
+                    sketches[other] = hll.decode(existing) if existing else hll.new_registers()
+                hll.merge(sketches[other], hll.decode(value))
+        if size_checks:
+            cas_filter['$expr'] = {'$and': size_checks}
+
+        # 递增topKVersion，使缓存已结束日期合并结果的查询发现折叠
+        increments['topKVersion'] = 1
+        update = {'$unset': unset, '$inc': increments}
+        if unique_users:
+            update['$addToSet'] = {field: {'$each': list(values)} for field, values in unique_users.items()}
+        if sketches:
+            update['$set'] = {field: Binary(hll.encode(registers)) for field, registers in sketches.items()}
+        result = await collection.update_one(cas_filter, update)
+        return result.matched_count > 0
+
+    def get_metrics(self) -> Dict[str, Any]:
+        metrics = dict(self.metrics)
+        metrics['documents'] = self._documents.get_metrics()['size']
+        return metrics
+
+
+def _get_path(document: Optional[Dict[str, Any]], path: str):
+    for part in path.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(part)
+    return document
+
+
+def top_entry_errors(errors: Dict[str, Dict[str, Any]], entries: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    只保留返回条目的误差上界
+    :param errors: 合并后的 topKErrors {维度: {键: 误差}}
+    :param entries: {维度: 返回的条目}
+    """
+    result = {}
+    for dimension, dimension_errors in errors.items():
+        returned = entries.get(dimension) or {}
+        kept = {k: error for k, error in dimension_errors.items() if k in returned and error}
+        if kept:
+            result[dimension] = kept
+    return result
@@ -5,17 +5,34 @@ import threading
 from fastapi import HTTPException, Request, APIRouter
 
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 import hashlib
 import logging
 
-from mongodb import stats_collection, sites_collection
-from batch import BatchProcessor
+from pymongo import UpdateOne
+
+from mongodb import stats_collection, sites_collection, user_stats_collection, hourly_stats_collection
+from batch import (BatchProcessor, get_stats_target, split_unique_updates, apply_hll_updates, split_user_dimension_updates,
+                   build_user_dimension_operations, USER_DIMENSIONS, topk_limiter)
+from hll import HLL_ENABLED, UniqueUserCounter, count_unique
+from rollup import (STATS_HOURLY_BUCKETS, STATS_PERIOD_ROLLUPS, current_bucket, to_hour_range, merge_stats_data,
+                    stats_rollup, PeriodCompactor, plan_period_rollups)
+from stats_pipeline import STATS_QUERY_ENGINE, QUERY_ENGINES, run_stats_pipeline
+from day_cache import day_cache
+from storage import STATS_STORAGE, check_storage_features, stats_storage
+from stats_merge import FlatStatsMerger
+from topk import top_entry_errors
+from retention import STATS_RETENTION, StatsRetention, has_archived_months
+from delete_job import StatsDeleteJobs
+from dimension_dict import STATS_DIMENSION_DICTIONARY, dimension_dictionary, collect_keys
 from security import require_login
-from util import lru_cache_with_ttl, access_system
+from util import lru_cache_with_ttl, access_system, BoundedTTLCache
 
 logger = logging.getLogger(__name__)
 
+# 统计结果缓存过期后仍可返回旧结果的时间（秒），期间在后台刷新；0表示不启用
+STATS_CACHE_STALE_TTL = float(os.getenv("STATS_CACHE_STALE_TTL", "0"))
+
 # 创建API路由
 api_router = APIRouter(prefix="/api")
 
@@ -24,6 +41,27 @@ _batch_processor_instance = None
 _batch_processor_lock = threading.Lock()
 
 enable_batch_processor = os.getenv("ENABLE_BATCH_PROCESSOR", "True").lower() == "true"
+# 批量上报接口单次允许的最大记录数
+TRACK_BATCH_MAX_ITEMS = int(os.getenv("TRACK_BATCH_MAX_ITEMS", "500"))
+
+# 网站/API密钥校验缓存配置（每个worker进程各自持有一份）
+SITE_CACHE_MAXSIZE = int(os.getenv("SITE_CACHE_MAXSIZE", "1000"))
+SITE_CACHE_TTL = float(os.getenv("SITE_CACHE_TTL", "60"))  # 有效网站的缓存时间（秒）
+SITE_CACHE_NEGATIVE_TTL = float(os.getenv("SITE_CACHE_NEGATIVE_TTL", "5"))  # 无效密钥的缓存时间（秒）
+
+# 缓存键为(system, api_key)，值为网站信息或None（负结果）
+_site_cache = BoundedTTLCache(maxsize=SITE_CACHE_MAXSIZE, ttl=SITE_CACHE_TTL)
+
+# SQLite存储只保存基本的每日文档
+check_storage_features({
+    'UNIQUE_USERS_MODE=hll': HLL_ENABLED,
+    'STATS_HOURLY_BUCKETS': STATS_HOURLY_BUCKETS,
+    'STATS_PERIOD_ROLLUPS': STATS_PERIOD_ROLLUPS,
+    'STATS_RETENTION': STATS_RETENTION,
+    'STATS_DAY_CACHE_SIZE': day_cache.enabled,
+    'STATS_QUERY_ENGINE=pipeline': STATS_QUERY_ENGINE == 'pipeline',
+    'STATS_DIMENSION_DICTIONARY': STATS_DIMENSION_DICTIONARY,
+})
 
 
 def get_batch_processor() -> BatchProcessor:
@@ -59,32 +97,38 @@ def sanitize_key(key: str) -> str:
     return safe
 
 
-def restore_all_keys_recursive(data):
+def restore_all_keys_recursive(data, decoded: Optional[Dict[str, str]] = None):
     """
     递归遍历并还原数据结构中的所有键
     支持字典、列表、元组和基本类型
+    :param decoded: 字典编码的键到原值的映射（这些键不需要再还原转义字符）
     """
     if isinstance(data, dict):
         # 处理字典：还原每个键，并递归处理值
         restored_dict = {}
         for key, value in data.items():
             # 还原键名
-            restored_key = restore_key(key)
+            restored_key = decoded[key] if decoded and key in decoded else restore_key(key)
             # 递归处理值
-            restored_dict[restored_key] = restore_all_keys_recursive(value)
+            restored_value = restore_all_keys_recursive(value, decoded)
+            current = restored_dict.get(restored_key)
+            if isinstance(current, (int, float)) and isinstance(restored_value, (int, float)):
+                # 启用字典编码当天同一个值可能同时有旧键和id键，计数相加
+                restored_value += current
+            restored_dict[restored_key] = restored_value
         return restored_dict
 
     elif isinstance(data, list):
         # 处理列表：递归处理每个元素
-        return [restore_all_keys_recursive(item) for item in data]
+        return [restore_all_keys_recursive(item, decoded) for item in data]
 
     elif isinstance(data, tuple):
         # 处理元组：递归处理每个元素，返回元组
-        return tuple(restore_all_keys_recursive(item) for item in data)
+        return tuple(restore_all_keys_recursive(item, decoded) for item in data)
 
     elif isinstance(data, set):
         # 处理集合：递归处理每个元素，返回列表（因为集合可能包含不可哈希的字典）
-        return [restore_all_keys_recursive(item) for item in data]
+        return [restore_all_keys_recursive(item, decoded) for item in data]
 
     else:
         # 基本类型：直接返回
@@ -119,8 +163,8 @@ def get_client_ip(request: Request) -> str:
     return request.client.host
 
 
-async def check_site_api_key(request: Request, data: dict):
-    url = data.get('url', 'unknown')
+async def _get_registered_site(request: Request, data: dict) -> dict:
+    """校验system和API密钥，返回注册的网站信息"""
     system = sanitize_key(data.get('system', 'default'))
     api_key = request.headers.get("X-API-Key") or data.get('apiKey')
     
@@ -131,17 +175,25 @@ async def check_site_api_key(request: Request, data: dict):
     if not api_key:
         raise HTTPException(status_code=403, detail="API key is required in X-API-Key header")
     
-    # 查询sites_collection，检查system是否注册且apikey匹配
-    site = await sites_collection.find_one({
-        "site_name": system,
-        "api_key": api_key
-    })
+    # 先查缓存，未命中时再查询sites_collection，检查system是否注册且apikey匹配
+    cache_key = (system, api_key)
+    cached, site = _site_cache.get(cache_key)
+    if not cached:
+        site = await sites_collection.find_one(
+            {"site_name": system, "api_key": api_key},
+            {"_id": 0, "site_name": 1, "site_url": 1}
+        )
+        # 负结果也缓存一小段时间，避免无效密钥的请求洪泛直达数据库
+        _site_cache.set(cache_key, site, ttl=SITE_CACHE_TTL if site else SITE_CACHE_NEGATIVE_TTL)
     
     # 如果找不到匹配的记录，抛出404错误
     if not site:
         raise HTTPException(status_code=404, detail="System not registered or invalid API key")
-    
-    # 检查url是否与注册的site_url匹配
+    return site
+
+
+def _check_site_url(request: Request, url: str, site: dict):
+    """检查上报的url是否与注册的site_url匹配（不访问数据库）"""
     # 1. 从request中获取origin
     # 2. 检查URL是否以origin为前缀
     # 3. 比对origin与注册URL是否匹配
@@ -184,6 +236,28 @@ async def check_site_api_key(request: Request, data: dict):
     return True
 
 
+def invalidate_site_cache(site_name: Optional[str] = None) -> int:
+    """
+    使网站校验缓存失效（创建/删除网站时调用），site_name为空时清空全部
+    注意：只作用于当前worker进程，其他进程依赖TTL过期
+    """
+    if site_name is None:
+        return _site_cache.invalidate()
+    system = sanitize_key(site_name)
+    return _site_cache.invalidate(lambda key: key[0] == system)
+
+
+def get_site_cache_metrics() -> Dict[str, Any]:
+    """获取网站校验缓存的命中指标"""
+    return _site_cache.get_metrics()
+
+
+async def check_site_api_key(request: Request, data: dict):
+    url = data.get('url', 'unknown')
+    site = await _get_registered_site(request, data)
+    return _check_site_url(request, url, site)
+
+
 async def _track_common(request: Request, data: dict, track_type: str, detail_handler):
     """
     通用跟踪处理函数，处理重复的初始化和数据库更新逻辑
@@ -202,9 +276,15 @@ async def _track_common(request: Request, data: dict, track_type: str, detail_ha
         # 获取客户端IP并用于统计分析
         client_ip = get_client_ip(request)
         # 获取IP前两段用于地域统计（保护隐私）
-        ip_prefix = sanitize_key('.'.join(client_ip.split('.')[:2])) if '.' in client_ip else 'unknown'
-        # 获取当前日期（用于按天分片）
-        current_date = datetime.utcnow().strftime('%Y-%m-%d')
+        ip_prefix = '.'.join(client_ip.split('.')[:2]) if '.' in client_ip else 'unknown'
+        if STATS_DIMENSION_DICTIONARY:
+            # 维度值替换为字典id（尚未缓存id的值仍按原值转义后写入，id由后台分配）
+            [data], ip_key = dimension_dictionary.encode_items(system, [(track_type, data)], ip_prefix)
+            ip_prefix = ip_key or sanitize_key(ip_prefix)
+        else:
+            ip_prefix = sanitize_key(ip_prefix)
+        # 获取当前时间分片（按天，启用按小时分桶时为小时）
+        current_date = current_bucket()
         
         # 调用具体处理函数获取update_fields
         update_fields = detail_handler(data, track_type, system, user_fingerprint, client_ip, ip_prefix, current_date)
@@ -222,16 +302,7 @@ async def _track_common(request: Request, data: dict, track_type: str, detail_ha
 
             # 尝试直接写入（降级方案）
             try:
-                filter_criteria = {
-                    'system': system,
-                    'date': current_date,
-                    'type': track_type
-                }
-                await stats_collection.update_one(
-                    filter_criteria,
-                    update_fields,
-                    upsert=True
-                )
+                await _write_updates_immediately([(batch_key, update_fields)])
             except Exception as write_error:
                 logger.error(f"Immediate write also failed: {write_error}")
                 raise HTTPException(
@@ -247,55 +318,93 @@ async def _track_common(request: Request, data: dict, track_type: str, detail_ha
         raise HTTPException(status_code=500, detail=f"跟踪{track_type}失败: {str(e)}")
 
 
+def _pageview_handler(data, track_type, system, user_fingerprint, client_ip, ip_prefix, current_date):
+    """构建页面访问统计的MongoDB更新操作"""
+    url = sanitize_key(data.get('url', 'unknown'))
+    browser = sanitize_key(data.get('browser', 'unknown'))
+    os_name = sanitize_key(data.get('os', 'unknown'))
+    device = sanitize_key(data.get('device', 'unknown'))
+    referrer = sanitize_key(data.get('referrer', ''))
+    
+    return {
+        '$inc': {
+            'data.total': 1,
+            f'data.byUrl.{url}': 1,
+            f'data.byBrowser.{browser}': 1,
+            f'data.byOS.{os_name}': 1,
+            f'data.byDevice.{device}': 1,
+            # IP相关统计（使用IP前缀保护隐私）
+            f'data.byIPPrefix.{ip_prefix}': 1,
+            f'data.byUrlAndIPPrefix.{url}.{ip_prefix}': 1,
+            # 用户指纹统计
+            f'data.byUser.{user_fingerprint}': 1,
+            f'data.byUrlAndUser.{url}.{user_fingerprint}': 1,
+            # 组合维度统计
+            f'data.byUrlAndBrowser.{url}.{browser}': 1,
+            f'data.byUrlAndDevice.{url}.{device}': 1,
+            f'data.byBrowserAndOS.{browser}.{os_name}': 1,
+            # 来源页面统计
+            f'data.byReferrer.{referrer}': 1,
+            f'data.byUrlAndReferrer.{url}.{referrer}': 1
+        },
+        '$set': {
+            'system': system,
+            'date': current_date,
+            'type': track_type,
+            'lastUpdated': datetime.utcnow()
+        },
+        # 记录唯一用户数（使用$addToSet确保每个用户只计数一次）
+        '$addToSet': {
+            'data.uniqueUsers': user_fingerprint,
+            f'data.byUrlUniqueUsers.{url}': user_fingerprint,
+            f'data.byIPPrefixUniqueUsers.{ip_prefix}': user_fingerprint,
+            f'data.byBrowserAndOsUniqueUsers.{browser}.{os_name}': user_fingerprint
+        }
+    }
+
+
 @api_router.post("/track/pageview")
 async def track_pageview(request: Request, data: dict):
     """
     跟踪页面访问
     """
-    def pageview_handler(data, track_type, system, user_fingerprint, client_ip, ip_prefix, current_date):
-        url = sanitize_key(data.get('url', 'unknown'))
-        browser = sanitize_key(data.get('browser', 'unknown'))
-        os_name = sanitize_key(data.get('os', 'unknown'))
-        device = sanitize_key(data.get('device', 'unknown'))
-        referrer = sanitize_key(data.get('referrer', ''))
-        
-        return {
-            '$inc': {
-                'data.total': 1,
-                f'data.byUrl.{url}': 1,
-                f'data.byBrowser.{browser}': 1,
-                f'data.byOS.{os_name}': 1,
-                f'data.byDevice.{device}': 1,
-                # IP相关统计（使用IP前缀保护隐私）
-                f'data.byIPPrefix.{ip_prefix}': 1,
-                f'data.byUrlAndIPPrefix.{url}.{ip_prefix}': 1,
-                # 用户指纹统计
-                f'data.byUser.{user_fingerprint}': 1,
-                f'data.byUrlAndUser.{url}.{user_fingerprint}': 1,
-                # 组合维度统计
-                f'data.byUrlAndBrowser.{url}.{browser}': 1,
-                f'data.byUrlAndDevice.{url}.{device}': 1,
-                f'data.byBrowserAndOS.{browser}.{os_name}': 1,
-                # 来源页面统计
-                f'data.byReferrer.{referrer}': 1,
-                f'data.byUrlAndReferrer.{url}.{referrer}': 1
-            },
-            '$set': {
-                'system': system,
-                'date': current_date,
-                'type': track_type,
-                'lastUpdated': datetime.utcnow()
-            },
-            # 记录唯一用户数（使用$addToSet确保每个用户只计数一次）
-            '$addToSet': {
-                'data.uniqueUsers': user_fingerprint,
-                f'data.byUrlUniqueUsers.{url}': user_fingerprint,
-                f'data.byIPPrefixUniqueUsers.{ip_prefix}': user_fingerprint,
-                f'data.byBrowserAndOsUniqueUsers.{browser}.{os_name}': user_fingerprint
-            }
-        }
+    return await _track_common(request, data, "pageViews", _pageview_handler)
+
+
+def _download_handler(data, track_type, system, user_fingerprint, client_ip, ip_prefix, current_date):
+    """构建文件下载统计的MongoDB更新操作"""
+    download_url = sanitize_key(data.get('downloadUrl', 'unknown'))
+    file_name = sanitize_key(data.get('fileName', 'unknown'))
+    source_page = sanitize_key(data.get('sourcePage', 'unknown'))
     
-    return await _track_common(request, data, "pageViews", pageview_handler)
+    return {
+        '$inc': {
+            'data.total': 1,
+            f'data.byFile.{file_name}': 1,
+            f'data.byUrl.{download_url}': 1,
+            f'data.bySourcePage.{source_page}': 1,
+            # IP相关统计（使用IP前缀保护隐私）
+            f'data.byIPPrefix.{ip_prefix}': 1,
+            f'data.byFileAndIPPrefix.{file_name}.{ip_prefix}': 1,
+            # 用户指纹统计
+            f'data.byUser.{user_fingerprint}': 1,
+            f'data.byFileAndUser.{file_name}.{user_fingerprint}': 1,
+            # 组合维度统计
+            f'data.byFileAndSource.{file_name}.{source_page}': 1
+        },
+        '$set': {
+            'system': system,
+            'date': current_date,
+            'type': track_type,
+            'lastUpdated': datetime.utcnow()
+        },
+        # 记录唯一用户数
+        '$addToSet': {
+            'data.uniqueUsers': user_fingerprint,
+            f'data.byFileUniqueUsers.{file_name}': user_fingerprint,
+            f'data.byIPPrefixUniqueUsers.{ip_prefix}': user_fingerprint
+        }
+    }
 
 
 @api_router.post("/track/download")
@@ -303,41 +412,59 @@ async def track_download(request: Request, data: dict):
     """
     跟踪文件下载
     """
-    def download_handler(data, track_type, system, user_fingerprint, client_ip, ip_prefix, current_date):
-        download_url = sanitize_key(data.get('downloadUrl', 'unknown'))
-        file_name = sanitize_key(data.get('fileName', 'unknown'))
-        source_page = sanitize_key(data.get('sourcePage', 'unknown'))
-        
-        return {
-            '$inc': {
-                'data.total': 1,
-                f'data.byFile.{file_name}': 1,
-                f'data.byUrl.{download_url}': 1,
-                f'data.bySourcePage.{source_page}': 1,
-                # IP相关统计（使用IP前缀保护隐私）
-                f'data.byIPPrefix.{ip_prefix}': 1,
-                f'data.byFileAndIPPrefix.{file_name}.{ip_prefix}': 1,
-                # 用户指纹统计
-                f'data.byUser.{user_fingerprint}': 1,
-                f'data.byFileAndUser.{file_name}.{user_fingerprint}': 1,
-                # 组合维度统计
-                f'data.byFileAndSource.{file_name}.{source_page}': 1
-            },
-            '$set': {
-                'system': system,
-                'date': current_date,
-                'type': track_type,
-                'lastUpdated': datetime.utcnow()
-            },
-            # 记录唯一用户数
-            '$addToSet': {
-                'data.uniqueUsers': user_fingerprint,
-                f'data.byFileUniqueUsers.{file_name}': user_fingerprint,
-                f'data.byIPPrefixUniqueUsers.{ip_prefix}': user_fingerprint
-            }
+    return await _track_common(request, data, "downloads", _download_handler)
+
+
+def _event_handler(data, track_type, system, user_fingerprint, client_ip, ip_prefix, current_date):
+    """构建自定义事件统计的MongoDB更新操作"""
+    # 标准化事件字段，确保数据一致性
+    event_type = sanitize_key(data.get('eventType', 'click'))
+    event_category = sanitize_key(data.get('eventCategory', 'engagement'))
+    event_action = sanitize_key(data.get('eventAction', 'click'))
+    event_label = sanitize_key(data.get('eventLabel', 'unknown'))
+    selector = sanitize_key(data.get('selector', 'unknown'))
+    url = sanitize_key(data.get('url', 'unknown'))
+    
+    # 构建更新操作，减少重复代码
+    update_fields = {
+        '$inc': {
+            'data.total': 1,
+            f'data.byType.{event_type}': 1,
+            f'data.byCategory.{event_category}': 1,
+            f'data.byAction.{event_action}': 1,
+            f'data.byLabel.{event_label}': 1,
+            f'data.bySelector.{selector}': 1,
+            f'data.byUrl.{url}': 1,
+            # IP相关统计（使用IP前缀保护隐私）
+            f'data.byIPPrefix.{ip_prefix}': 1,
+            f'data.byCategoryAndIPPrefix.{event_category}.{ip_prefix}': 1,
+            f'data.byActionAndIPPrefix.{event_action}.{ip_prefix}': 1,
+            # 用户指纹统计
+            f'data.byUser.{user_fingerprint}': 1,
+            f'data.byCategoryAndUser.{event_category}.{user_fingerprint}': 1,
+            f'data.byCategoryAndActionAndUser.{event_category}.{event_action}.{user_fingerprint}': 1,
+            # 组合维度统计
+            f'data.byCategoryAndAction.{event_category}.{event_action}': 1,
+            f'data.byCategoryAndLabel.{event_category}.{event_label}': 1,
+            f'data.byUrlAndAction.{url}.{event_action}': 1
+        },
+        '$set': {
+            'system': system,
+            'date': current_date,
+            'type': track_type, 
+            'lastUpdated': datetime.utcnow()
+        },
+        # 记录唯一用户数（使用$addToSet确保每个用户只计数一次）
+        '$addToSet': {
+            'data.uniqueUsers': user_fingerprint,
+            f'data.byCategoryUniqueUsers.{event_category}': user_fingerprint,
+            f'data.byActionUniqueUsers.{event_action}': user_fingerprint,
+            f'data.byCategoryAndActionUniqueUsers.{event_category}.{event_action}': user_fingerprint,
+            f'data.byIPPrefixUniqueUsers.{ip_prefix}': user_fingerprint
         }
+    }
     
-    return await _track_common(request, data, "downloads", download_handler)
+    return update_fields
 
 
 @api_router.post("/track/event")
@@ -345,56 +472,60 @@ async def track_event(request: Request, data: dict):
     """
     跟踪自定义事件
     """
-    def event_handler(data, track_type, system, user_fingerprint, client_ip, ip_prefix, current_date):
-        # 标准化事件字段，确保数据一致性
-        event_type = sanitize_key(data.get('eventType', 'click'))
-        event_category = sanitize_key(data.get('eventCategory', 'engagement'))
-        event_action = sanitize_key(data.get('eventAction', 'click'))
-        event_label = sanitize_key(data.get('eventLabel', 'unknown'))
-        selector = sanitize_key(data.get('selector', 'unknown'))
-        url = sanitize_key(data.get('url', 'unknown'))
-        
-        # 构建更新操作，减少重复代码
-        update_fields = {
-            '$inc': {
-                'data.total': 1,
-                f'data.byType.{event_type}': 1,
-                f'data.byCategory.{event_category}': 1,
-                f'data.byAction.{event_action}': 1,
-                f'data.byLabel.{event_label}': 1,
-                f'data.bySelector.{selector}': 1,
-                f'data.byUrl.{url}': 1,
-                # IP相关统计（使用IP前缀保护隐私）
-                f'data.byIPPrefix.{ip_prefix}': 1,
-                f'data.byCategoryAndIPPrefix.{event_category}.{ip_prefix}': 1,
-                f'data.byActionAndIPPrefix.{event_action}.{ip_prefix}': 1,
-                # 用户指纹统计
-                f'data.byUser.{user_fingerprint}': 1,
-                f'data.byCategoryAndUser.{event_category}.{user_fingerprint}': 1,
-                f'data.byCategoryAndActionAndUser.{event_category}.{event_action}.{user_fingerprint}': 1,
-                # 组合维度统计
-                f'data.byCategoryAndAction.{event_category}.{event_action}': 1,
-                f'data.byCategoryAndLabel.{event_category}.{event_label}': 1,
-                f'data.byUrlAndAction.{url}.{event_action}': 1
-            },
-            '$set': {
-                'system': system,
-                'date': current_date,
-                'type': track_type, 
-                'lastUpdated': datetime.utcnow()
-            },
-            # 记录唯一用户数（使用$addToSet确保每个用户只计数一次）
-            '$addToSet': {
-                'data.uniqueUsers': user_fingerprint,
-                f'data.byCategoryUniqueUsers.{event_category}': user_fingerprint,
-                f'data.byActionUniqueUsers.{event_action}': user_fingerprint,
-                f'data.byIPPrefixUniqueUsers.{ip_prefix}': user_fingerprint
-            }
-        }
-        
-        return update_fields
+    return await _track_common(request, data, "events", _event_handler)
+
+
+def _duration_handler(data, track_type, system, user_fingerprint, client_ip, ip_prefix, current_date):
+    """构建停留时长统计的MongoDB更新操作"""
+    duration = int(data.get('duration', 0))
+    url = sanitize_key(data.get('url', 'unknown'))
+    browser = sanitize_key(data.get('browser', 'unknown'))
+    os_name = sanitize_key(data.get('os', 'unknown'))
+    device = sanitize_key(data.get('device', 'unknown'))
     
-    return await _track_common(request, data, "events", event_handler)
+    return {
+        '$inc': {
+            'data.total': duration,
+            'data.count': 1,
+            f'data.byUrl.{url}': duration,
+            f'data.byUrl.count.{url}': 1,
+            f'data.byBrowser.{browser}': duration,
+            f'data.byBrowser.count.{browser}': 1,
+            f'data.byOS.{os_name}': duration,
+            f'data.byOS.count.{os_name}': 1,
+            f'data.byDevice.{device}': duration,
+            f'data.byDevice.count.{device}': 1,
+            # IP相关统计（使用IP前缀保护隐私）
+            f'data.byIPPrefix.{ip_prefix}': duration,
+            f'data.byIPPrefix.count.{ip_prefix}': 1,
+            f'data.byUrlAndIPPrefix.{url}.{ip_prefix}': duration,
+            f'data.byUrlAndIPPrefix.count.{url}.{ip_prefix}': 1,
+            # 用户指纹统计
+            f'data.byUser.{user_fingerprint}': duration,
+            f'data.byUser.count.{user_fingerprint}': 1,
+            f'data.byUrlAndUser.{url}.{user_fingerprint}': duration,
+            f'data.byUrlAndUser.count.{url}.{user_fingerprint}': 1,
+            # 组合维度统计
+            f'data.byUrlAndBrowser.{url}.{browser}': duration,
+            f'data.byUrlAndBrowser.count.{url}.{browser}': 1,
+            f'data.byUrlAndDevice.{url}.{device}': duration,
+            f'data.byUrlAndDevice.count.{url}.{device}': 1,
+            f'data.byBrowserAndOS.{browser}.{os_name}': duration,
+            f'data.byBrowserAndOS.count.{browser}.{os_name}': 1
+        },
+        '$set': {
+            'system': system,
+            'date': current_date,
+            'type': track_type,
+            'lastUpdated': datetime.utcnow()
+        },
+        # 记录唯一用户数（使用$addToSet确保每个用户只计数一次）
+        '$addToSet': {
+            'data.uniqueUsers': user_fingerprint,
+            f'data.byUrlUniqueUsers.{url}': user_fingerprint,
+            f'data.byIPPrefixUniqueUsers.{ip_prefix}': user_fingerprint
+        }
+    }
 
 
 @api_router.post("/track/duration")
@@ -402,91 +533,142 @@ async def track_duration(request: Request, data: dict):
     """
     跟踪页面停留时长
     """
-    def duration_handler(data, track_type, system, user_fingerprint, client_ip, ip_prefix, current_date):
-        duration = int(data.get('duration', 0))
-        url = sanitize_key(data.get('url', 'unknown'))
-        browser = sanitize_key(data.get('browser', 'unknown'))
-        os_name = sanitize_key(data.get('os', 'unknown'))
-        device = sanitize_key(data.get('device', 'unknown'))
-        
-        return {
-            '$inc': {
-                'data.total': duration,
-                'data.count': 1,
-                f'data.byUrl.{url}': duration,
-                f'data.byUrl.count.{url}': 1,
-                f'data.byBrowser.{browser}': duration,
-                f'data.byBrowser.count.{browser}': 1,
-                f'data.byOS.{os_name}': duration,
-                f'data.byOS.count.{os_name}': 1,
-                f'data.byDevice.{device}': duration,
-                f'data.byDevice.count.{device}': 1,
-                # IP相关统计（使用IP前缀保护隐私）
-                f'data.byIPPrefix.{ip_prefix}': duration,
-                f'data.byIPPrefix.count.{ip_prefix}': 1,
-                f'data.byUrlAndIPPrefix.{url}.{ip_prefix}': duration,
-                f'data.byUrlAndIPPrefix.count.{url}.{ip_prefix}': 1,
-                # 用户指纹统计
-                f'data.byUser.{user_fingerprint}': duration,
-                f'data.byUser.count.{user_fingerprint}': 1,
-                f'data.byUrlAndUser.{url}.{user_fingerprint}': duration,
-                f'data.byUrlAndUser.count.{url}.{user_fingerprint}': 1,
-                # 组合维度统计
-                f'data.byUrlAndBrowser.{url}.{browser}': duration,
-                f'data.byUrlAndBrowser.count.{url}.{browser}': 1,
-                f'data.byUrlAndDevice.{url}.{device}': duration,
-                f'data.byUrlAndDevice.count.{url}.{device}': 1,
-                f'data.byBrowserAndOS.{browser}.{os_name}': duration,
-                f'data.byBrowserAndOS.count.{browser}.{os_name}': 1
-            },
-            '$set': {
-                'system': system,
-                'date': current_date,
-                'type': track_type,
-                'lastUpdated': datetime.utcnow()
-            },
-            # 记录唯一用户数（使用$addToSet确保每个用户只计数一次）
-            '$addToSet': {
-                'data.uniqueUsers': user_fingerprint,
-                f'data.byUrlUniqueUsers.{url}': user_fingerprint,
-                f'data.byIPPrefixUniqueUsers.{ip_prefix}': user_fingerprint
-            }
-        }
-    
-    return await _track_common(request, data, "duration", duration_handler)
-
-
-def merge_nested_dicts(dict1, dict2):
+    return await _track_common(request, data, "duration", _duration_handler)
+
+
+# 批量上报中记录类型与(统计类型, 处理函数)的映射
+TRACK_TYPE_HANDLERS = {
+    'pageview': ('pageViews', _pageview_handler),
+    'download': ('downloads', _download_handler),
+    'event': ('events', _event_handler),
+    'duration': ('duration', _duration_handler),
+}
+
+
+async def _write_updates_immediately(entries: List[Tuple[Tuple[str, str, str], Dict[str, Any]]]):
+    """批处理器不可用或队列满时，直接批量写入数据库（降级方案）"""
+    if STATS_STORAGE != 'mongodb':
+        failed = await stats_storage.apply_updates(entries)
+        if failed:
+            raise RuntimeError(f"{len(failed)} of {len(entries)} updates failed")
+        return
+    # 与批处理器相同：按小时分桶的键写入小时集合，按目标集合分组批量写入
+    groups: Dict[str, Tuple[Any, List[UpdateOne]]] = {}
+    user_operations = []
+    sketch_updates = []
+    for key, update_fields in entries:
+        collection, filter_criteria = get_stats_target(key)
+        # 开启top-K的站点把未进入摘要的键改写为(other)
+        update_fields = await topk_limiter.apply(key, update_fields, (collection, filter_criteria))
+        # HLL模式下唯一用户写入草图，而不是$addToSet
+        write_fields, sketch_values = split_unique_updates(update_fields)
+        # 按用户指纹的维度写入独立的分桶文档
+        write_fields, user_updates = split_user_dimension_updates(write_fields)
+        _, operations = groups.setdefault(collection.name, (collection, []))
+        operations.append(UpdateOne(filter_criteria, write_fields, upsert=True))
+        user_operations.extend(build_user_dimension_operations(key, user_updates))
+        if sketch_values:
+            sketch_updates.append((key, sketch_values))
+    for collection, operations in groups.values():
+        await collection.bulk_write(operations, ordered=False)
+    if user_operations:
+        await user_stats_collection.bulk_write(user_operations, ordered=False)
+    for key, sketch_values in sketch_updates:
+        await apply_hll_updates(key, sketch_values)
+    for key, _ in entries:
+        await topk_limiter.fold_pending(key, get_stats_target(key))
+
+
+@api_router.post("/track/batch")
+async def track_batch(request: Request, data: dict):
     """
-    合并两个嵌套字典，将相同路径的值相加
-    :param dict1: 第一个字典
-    :param dict2: 第二个字典
-    :return: 合并后的字典
+    批量跟踪：一次请求上报同一网站的多条不同类型记录
+    请求体格式: {"system": ..., "apiKey": ..., "userFingerprint": ..., "items": [{"type": "pageview", ...}, ...]}
+    API密钥只校验一次，所有记录合并为批处理键后一次性加入队列
     """
-    # 使用更高效的方式合并，避免不必要的复制
-    result = {}
-    
-    # 先复制dict1的内容
-    for key, value in dict1.items():
-        result[key] = value
-
-    # 合并dict2的内容
-    for key, value in dict2.items():
-        if key in result:
-            if isinstance(result[key], dict) and isinstance(value, dict):
-                # 递归合并嵌套字典
-                result[key] = merge_nested_dicts(result[key], value)
-            elif isinstance(result[key], int) and isinstance(value, int):
-                # 相加数值
-                result[key] = result[key] + value
-            else:
-                # 其他情况，直接使用新值
-                result[key] = value
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="items must be a non-empty list")
+    if len(items) > TRACK_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Too many items, at most {TRACK_BATCH_MAX_ITEMS} per request")
+
+    site = await _get_registered_site(request, data)
+    try:
+        # 公共字段只计算一次
+        system = sanitize_key(data.get('system', 'default'))
+        client_ip = get_client_ip(request)
+        ip_prefix = '.'.join(client_ip.split('.')[:2]) if '.' in client_ip else 'unknown'
+        current_date = current_bucket()
+        default_fingerprint = data.get('userFingerprint', '')
+        if STATS_DIMENSION_DICTIONARY:
+            # 所有记录的维度值一次编码（类型不支持或格式错误的记录保持原样，稍后拒绝）
+            encodable = [index for index, item in enumerate(items)
+                         if isinstance(item, dict) and item.get('type') in TRACK_TYPE_HANDLERS]
+            encoded, ip_key = dimension_dictionary.encode_items(
+                system, [(TRACK_TYPE_HANDLERS[items[index]['type']][0], items[index]) for index in encodable], ip_prefix)
+            encoded_items = dict(zip(encodable, encoded))
+            ip_prefix = ip_key or sanitize_key(ip_prefix)
         else:
-            # 键不存在，直接添加
-            result[key] = value
+            encoded_items = {}
+            ip_prefix = sanitize_key(ip_prefix)
 
-    return result
+        results = []
+        batch_cache = {}
+        processor = get_batch_processor()
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                results.append({"index": index, "accepted": False, "error": "Item must be an object"})
+                continue
+            handler_info = TRACK_TYPE_HANDLERS.get(item.get('type'))
+            if not handler_info:
+                results.append({"index": index, "accepted": False, "error": f"Unsupported type: {item.get('type')}"})
+                continue
+            track_type, detail_handler = handler_info
+            try:
+                _check_site_url(request, item.get('url', 'unknown'), site)
+                user_fingerprint = sanitize_fingerprint(item.get('userFingerprint', default_fingerprint))
+                update_fields = detail_handler(encoded_items.get(index, item), track_type, system, user_fingerprint,
+                                               client_ip, ip_prefix, current_date)
+            except HTTPException as e:
+                results.append({"index": index, "accepted": False, "error": e.detail})
+                continue
+            except (TypeError, ValueError) as e:
+                results.append({"index": index, "accepted": False, "error": f"Invalid item: {e}"})
+                continue
+
+            # 同一批处理键的记录先在本地合并
+            batch_key = (system, current_date, track_type)
+            if batch_key in batch_cache:
+                batch_cache[batch_key] = BatchProcessor._merge_update_fields(batch_cache[batch_key], update_fields)
+            else:
+                batch_cache[batch_key] = update_fields
+            results.append({"index": index, "accepted": True})
+
+        entries = list(batch_cache.items())
+        rejected = await processor.add_many(entries) if processor else entries
+        if rejected:
+            logger.warning(f"Batch tracking falling back to immediate write for {len(rejected)} keys")
+            try:
+                await _write_updates_immediately(rejected)
+            except Exception as write_error:
+                logger.error(f"Immediate write also failed: {write_error}")
+                raise HTTPException(
+                    status_code=503,
+                    detail="System busy, please try again later"
+                )
+
+        accepted = sum(1 for result in results if result["accepted"])
+        return {
+            "success": True,
+            "accepted": accepted,
+            "rejected": len(results) - accepted,
+            "results": results
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"批量跟踪失败: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"批量跟踪失败: {str(e)}")
 
 
 def get_top_entries(dictionary, limit=10, except_keys=None):
@@ -542,10 +724,241 @@ def get_top_entries(dictionary, limit=10, except_keys=None):
     return result
 
 
-@lru_cache_with_ttl(maxsize=50, ttl=5)  # 缓存50个结果，过期时间5秒
+def _merge_hour_documents(date: str, daily: Optional[dict], hour_docs: List[dict]) -> dict:
+    """把尚未汇总的小时文档合并进每日文档（跳过每日文档rolledUpHours中已合并的）"""
+    rolled_up = set(daily.get('rolledUpHours', [])) if daily else set()
+    data = daily.get('data', {}) if daily else {}
+    for hour_doc in hour_docs:
+        if str(hour_doc['_id']) not in rolled_up:
+            merge_stats_data(data, hour_doc.get('data', {}))
+    return {'date': date, 'data': data}
+
+
+def _build_trend_entry(stats_type: str, date: str, stats_data: dict, limit: int) -> dict:
+    """
+    构建单个日期分片的趋势数据
+    :param stats_type: 统计类型
+    :param date: 日期
+    :param stats_data: 当天的统计数据
+    :param limit: 子类别的条目数限制
+    :return: 趋势数据
+    """
+    # HLL模式下的唯一用户草图（旧数据没有）
+    hll_data = stats_data.get('hll', {})
+
+    # 收集当天的趋势数据（只创建必要的字段）
+    day_data = {'date': date}
+    if stats_type == 'duration':
+        # 停留时长统计的趋势数据包含总时长和会话数
+        day_data['total'] = stats_data.get('total', 0)
+        day_data['count'] = stats_data.get('count', 0)
+    else:
+        # 其他统计类型的趋势数据包含总数和独立用户数
+        day_data['total'] = stats_data.get('total', 0)
+        day_data['uniqueUsers'] = count_unique(stats_data.get('uniqueUsers'), hll_data.get('uniqueUsers'))
+    
+    # 添加按子类别收集的趋势数据
+    if stats_type == 'pageViews' and 'byUrl' in stats_data:
+        # 页面访问按URL收集趋势数据，包含访问次数和用户数
+        url_trend_data = {}
+        top_urls = get_top_entries(stats_data['byUrl'], limit)
+        for url, count in top_urls.items():
+            # 获取该URL的用户数信息
+            unique_users = count_unique(stats_data.get('byUrlUniqueUsers', {}).get(url),
+                                        hll_data.get('byUrlUniqueUsers', {}).get(url))
+            url_trend_data[url] = {
+                'count': count,
+                'uniqueUsers': unique_users
+            }
+        day_data['byUrl'] = url_trend_data
+    elif stats_type == 'duration' and 'byUrl' in stats_data:
+        # 停留时长按URL收集趋势数据，包含总时长和会话数
+        url_trend_data = {}
+        top_urls = get_top_entries(stats_data['byUrl'], limit, except_keys=['count'])
+        for url, count in top_urls.items():
+            if url == 'count':
+                continue
+            sessions = 1
+            if 'count' in stats_data['byUrl'] and url in stats_data['byUrl']['count']:
+                sessions = stats_data['byUrl']['count'][url]
+            url_trend_data[url] = {
+                'total': count,
+                'count': sessions
+            }
+        day_data['byUrl'] = url_trend_data
+    elif stats_type == 'downloads' and 'byFile' in stats_data:
+        # 下载按文件收集趋势数据，包含下载次数和用户数
+        file_data = {}
+        # 收集每个文件的下载次数
+        for file, count in stats_data['byFile'].items():
+            file_data[file] = {
+                'count': count,
+                'uniqueUsers': count_unique(stats_data.get('byFileUniqueUsers', {}).get(file),
+                                            hll_data.get('byFileUniqueUsers', {}).get(file))
+            }
+        # 按下载次数排序，取前limit个
+        sorted_files = sorted(file_data.items(), key=lambda x: x[1]['count'], reverse=True)[:limit]
+        day_data['byFile'] = {file: data for file, data in sorted_files}
+    elif stats_type == 'events' and 'byCategoryAndAction' in stats_data:
+        # 事件按类别+动作收集趋势数据，包含事件次数和用户数
+        event_data = {}
+        # 获取事件类别和动作数据
+        for category, actions in stats_data['byCategoryAndAction'].items():
+            for action, count in actions.items():
+                event_key = f"{category}.{action}"
+                # 计算该事件的唯一用户数
+                unique_users = count_unique(
+                    stats_data.get('byCategoryAndActionUniqueUsers', {}).get(category, {}).get(action),
+                    hll_data.get('byCategoryAndActionUniqueUsers', {}).get(category, {}).get(action)
+                )
+                if not unique_users and stats_data.get('byCategoryAndActionAndUser', {}).get(category, {}).get(action):
+                    # 兼容旧数据（没有byCategoryAndActionUniqueUsers字段）
+                    unique_users = len(stats_data['byCategoryAndActionAndUser'][category][action])
+                event_data[event_key] = {
+                    'count': count,
+                    'uniqueUsers': unique_users
+                }
+        # 按事件次数排序，取前limit个
+        sorted_events = sorted(event_data.items(), key=lambda x: x[1]['count'], reverse=True)[:limit]
+        day_data['byCategoryAndAction'] = {event: data for event, data in sorted_events}
+    
+    return day_data
+
+
+# 周/月汇总任务（趋势数据与查询使用相同的构建函数）
+period_compactor = PeriodCompactor(_build_trend_entry)
+stats_retention = StatsRetention(period_compactor)
+
+
+def _limit_trend_entry(entry: dict, limit: int) -> dict:
+    """汇总文档中保存的趋势数据按请求的limit截断子类别"""
+    for key in ('byUrl', 'byFile', 'byCategoryAndAction'):
+        if key in entry:
+            entry[key] = dict(list(entry[key].items())[:limit])
+    return entry
+
+
+async def _period_rollup_cursor(query: dict, projection: dict, archived_only: bool = False):
+    """长日期范围按天查询时，已汇总的周/月读取汇总文档，其余日期读取每日文档"""
+    date_query = query.get('date', {})
+    rollups, gaps = await plan_period_rollups(query['system'], query['type'],
+                                              date_query.get('$gte'), date_query.get('$lte'), archived_only)
+    if not rollups:
+        async for stats in stats_collection.find(query, projection).sort('date', 1):
+            yield stats
+        return
+
+    gap_conditions = []
+    for gap_start, gap_end in gaps:
+        condition = {}
+        if gap_start:
+            condition['$gte'] = gap_start
+        if gap_end:
+            condition['$lte'] = gap_end
+        gap_conditions.append({'date': condition})
+    daily_query = {key: value for key, value in query.items() if key != 'date'}
+    if gap_conditions:
+        daily_query['$or'] = gap_conditions
+    else:
+        daily_query['date'] = {'$in': []}
+
+    async for stats in stats_collection.find(daily_query, projection).sort('date', 1):
+        while rollups and rollups[0]['date'] < stats['date']:
+            yield rollups.pop(0)
+        yield stats
+    for rollup in rollups:
+        yield rollup
+
+
+async def _iter_stats_documents(query: dict, projection: dict, granularity: str, use_rollups: bool = False,
+                                archived_only: bool = False):
+    """
+    按日期顺序返回统计文档
+    granularity为hour时返回小时文档（同一小时的多个文档合并）；
+    按天查询且启用了按小时分桶时，当天等尚未汇总的小时合并进对应日期的文档；
+    use_rollups为True时已结束的周/月返回汇总文档（带trend字段，date为周期开始日期）；
+    archived_only为True时只有保留策略归档的月份返回汇总文档
+    """
+    # 小时文档需要_id判断是否已合并
+    hour_projection = {key: value for key, value in projection.items() if key != '_id'}
+    hour_query = dict(query)
+    if 'date' in query:
+        hour_query['date'] = to_hour_range(query['date'])
+
+    if granularity == 'hour':
+        current = None
+        async for hour_doc in hourly_stats_collection.find(hour_query, hour_projection).sort('date', 1):
+            if current and current['date'] == hour_doc['date']:
+                merge_stats_data(current['data'], hour_doc.get('data', {}))
+                continue
+            if current:
+                yield current
+            current = {'date': hour_doc['date'], 'data': hour_doc.get('data', {})}
+        if current:
+            yield current
+        return
+
+    if use_rollups or archived_only:
+        stats_cursor = _period_rollup_cursor(query, projection, archived_only=not use_rollups)
+    else:
+        stats_cursor = stats_storage.find_days(query, projection)
+    if not STATS_HOURLY_BUCKETS:
+        async for stats in stats_cursor:
+            yield stats
+        return
+
+    # 尚未汇总的小时文档只有最近几个小时，按日期分组后合并
+    pending = {}
+    hour_query['merged'] = {'$exists': False}
+    async for hour_doc in hourly_stats_collection.find(hour_query, hour_projection):
+        pending.setdefault(hour_doc['date'][:len('YYYY-MM-DD')], []).append(hour_doc)
+    async for stats in stats_cursor:
+        for date in sorted(date for date in pending if date < stats['date']):
+            yield _merge_hour_documents(date, None, pending.pop(date))
+        hour_docs = pending.pop(stats['date'], None)
+        yield _merge_hour_documents(stats['date'], stats, hour_docs) if hour_docs else stats
+    for date in sorted(pending):
+        yield _merge_hour_documents(date, None, pending[date])
+
+
+async def _load_topk_errors(query: dict) -> Dict[str, Any]:
+    """聚合管道引擎不读取完整文档，单独读取top-K误差上界"""
+    merger = FlatStatsMerger()
+    async for stats in _iter_stats_documents(query, {'_id': 0, 'date': 1, 'data.topKErrors': 1}, 'day'):
+        merger.add('topKErrors', stats.get('data', {}).get('topKErrors'))
+    return merger.to_nested('topKErrors')
+
+
+def _topk_entries(aggregated_stats: dict, topk_errors: dict, stats_type: str, limit: int) -> Dict[str, dict]:
+    """有误差记录的维度中将要返回的前N个条目（在最终处理之前计算）"""
+    except_keys = ['count'] if stats_type == 'duration' else None
+    return {dimension: get_top_entries(aggregated_stats.get(dimension) or {}, limit, except_keys)
+            for dimension in topk_errors}
+
+
+def _attach_topk_errors(result: dict, topk_errors: dict, entries: Dict[str, dict]) -> dict:
+    """top-K模式下在结果中附加返回条目的误差上界（真实计数在 [计数, 计数+误差] 之间）"""
+    if topk_errors:
+        result['topKErrors'] = top_entry_errors(topk_errors, entries)
+    return result
+
+
+async def _restore_result(system: str, result: dict) -> dict:
+    """
+    还原最终结果中的键：字典编码的键解析为原值，其他键还原转义字符
+    只遍历已取前N的最终结果（关闭字典编码后读取之前编码的数据同样需要解析）
+    """
+    keys = collect_keys(result)
+    decoded = await dimension_dictionary.decode(system, keys, restore_key) if keys else None
+    return restore_all_keys_recursive(result, decoded)
+
+
+# 权限检查在缓存之前执行：缓存键不包含用户，缓存的结果和等待中的调用由有权限的用户共享
 @access_system("${system}")
+@lru_cache_with_ttl(maxsize=50, ttl=5, stale_ttl=STATS_CACHE_STALE_TTL)  # 缓存50个结果，过期时间5秒
 async def _stats_common(request: Request, system: str, start_date: Optional[str], end_date: Optional[str], limit: int,
-                        stats_type: str, result_initializer, unique_users_handler, final_result_handler):
+                        stats_type: str, result_initializer, unique_users_handler, final_result_handler,
+                        include_users: bool = False, granularity: str = 'day', engine: Optional[str] = None):
     """
     通用统计处理函数，处理重复的查询和聚合逻辑
     :param system: 系统名称
@@ -556,8 +969,20 @@ async def _stats_common(request: Request, system: str, start_date: Optional[str]
     :param result_initializer: 初始化聚合结果的函数
     :param unique_users_handler: 处理唯一用户数据的函数
     :param final_result_handler: 处理最终结果的函数
+    :param include_users: 是否加载按用户指纹的维度（byUser等，按用户下钻时才需要）
+    :param granularity: 趋势数据的时间粒度（day或hour，hour需要启用按小时分桶）
+    :param engine: 查询引擎（python或pipeline，默认STATS_QUERY_ENGINE）；按小时查询和按用户下钻总是使用python引擎
     :return: 统计结果
     """
+    if granularity not in ('day', 'hour'):
+        raise HTTPException(status_code=400, detail="granularity must be 'hour' or 'day'")
+    if granularity == 'hour' and not STATS_HOURLY_BUCKETS:
+        raise HTTPException(status_code=400, detail="Hourly statistics are not enabled")
+    engine = (engine or STATS_QUERY_ENGINE).lower()
+    if engine not in QUERY_ENGINES:
+        raise HTTPException(status_code=400, detail="engine must be 'python' or 'pipeline'")
+    if engine == 'pipeline' and STATS_STORAGE != 'mongodb':
+        raise HTTPException(status_code=400, detail="The pipeline engine requires MongoDB storage")
     try:
         # 构建查询条件
         query = {'system': system}
@@ -575,147 +1000,157 @@ async def _stats_common(request: Request, system: str, start_date: Optional[str]
         query['type'] = stats_type
         
         # 只投影需要的字段，减少数据传输
-        stats_cursor = stats_collection.find(
-            query,
-            {'_id': 0, 'date': 1, 'data': 1}
-        ).sort('date', 1)
+        if include_users:
+            projection = {'_id': 0, 'date': 1, 'data': 1, 'rolledUpHours': 1}
+        else:
+            # 摘要查询排除按用户指纹的维度（旧数据仍保存在每日文档内）
+            projection = {'_id': 0}
+            projection.update({f'data.{dimension}': 0 for dimension in USER_DIMENSIONS})
+            if stats_type == 'events':
+                # 没有byCategoryAndActionUniqueUsers的旧文档只能从该维度计算每个事件的唯一用户
+                del projection['data.byCategoryAndActionAndUser']
+
+        # 保留策略归档的月份只有月汇总文档，需要使用python引擎读取
+        archived = STATS_RETENTION and granularity == 'day' and await has_archived_months(
+            system, stats_type, start_date, end_date)
+
+        if engine == 'pipeline' and granularity == 'day' and not include_users and not archived:
+            # 聚合管道引擎：在MongoDB中合并并取前N，只返回各维度的最终条目和每日趋势行
+            aggregated_stats, trend_data = await run_stats_pipeline(query, stats_type, limit, result_initializer,
+                                                                    unique_users_handler)
+            aggregated_stats['trendData'] = trend_data
+            topk_errors = await _load_topk_errors(query) if await topk_limiter.site_top_k(system) else {}
+            entries = _topk_entries(aggregated_stats, topk_errors, stats_type, limit)
+            result = _attach_topk_errors(final_result_handler(aggregated_stats, limit), topk_errors, entries)
+            return await _restore_result(system, result)
+
+        # 按用户下钻和按小时查询不使用周/月汇总（汇总文档不含用户维度和小时数据）
+        use_rollups = STATS_PERIOD_ROLLUPS and granularity == 'day' and not include_users
 
-        # 初始化聚合结果
-        aggregated_stats = result_initializer()
-        
-        # 初始化趋势数据列表
-        trend_data = []
-        
         # 预计算需要聚合的字段列表，避免重复判断
         merge_fields = [
-            key for key in aggregated_stats 
+            key for key in result_initializer() 
             if key not in ('total', 'count', 'uniqueUsers') 
             and not key.endswith('UniqueUsers')
+            and (include_users or key not in USER_DIMENSIONS)
         ]
 
-        # 聚合所有日期分片的数据，并收集趋势数据
-        async for stats in stats_cursor:
-            if 'data' not in stats:
-                continue
-                
-            stats_data = stats['data']
-            date = stats['date']
-            
-            # 收集当天的趋势数据（只创建必要的字段）
-            day_data = {'date': date}
-            if stats_type == 'duration':
-                # 停留时长统计的趋势数据包含总时长和会话数
-                day_data['total'] = stats_data.get('total', 0)
-                day_data['count'] = stats_data.get('count', 0)
-            else:
-                # 其他统计类型的趋势数据包含总数和独立用户数
-                day_data['total'] = stats_data.get('total', 0)
-                day_data['uniqueUsers'] = len(stats_data.get('uniqueUsers', []))
-            
-            # 添加按子类别收集的趋势数据
-            if stats_type == 'pageViews' and 'byUrl' in stats_data:
-                # 页面访问按URL收集趋势数据，包含访问次数和用户数
-                url_trend_data = {}
-                top_urls = get_top_entries(stats_data['byUrl'], limit)
-                for url, count in top_urls.items():
-                    # 获取该URL的用户数信息
-                    unique_users = len(stats_data.get('byUrlUniqueUsers', {}).get(url, []))
-                    url_trend_data[url] = {
-                        'count': count,
-                        'uniqueUsers': unique_users
-                    }
-                day_data['byUrl'] = url_trend_data
-            elif stats_type == 'duration' and 'byUrl' in stats_data:
-                # 停留时长按URL收集趋势数据，包含总时长和会话数
-                url_trend_data = {}
-                top_urls = get_top_entries(stats_data['byUrl'], limit, except_keys=['count'])
-                for url, count in top_urls.items():
-                    if url == 'count':
-                        continue
-                    sessions = 1
-                    if 'count' in stats_data['byUrl'] and url in stats_data['byUrl']['count']:
-                        sessions = stats_data['byUrl']['count'][url]
-                    url_trend_data[url] = {
-                        'total': count,
-                        'count': sessions
-                    }
-                day_data['byUrl'] = url_trend_data
-            elif stats_type == 'downloads' and 'byFile' in stats_data:
-                # 下载按文件收集趋势数据，包含下载次数和用户数
-                file_data = {}
-                # 收集每个文件的下载次数
-                for file, count in stats_data['byFile'].items():
-                    file_data[file] = {
-                        'count': count,
-                        'uniqueUsers': len(stats_data.get('byFileUniqueUsers', {}).get(file, []))
-                    }
-                # 按下载次数排序，取前limit个
-                sorted_files = sorted(file_data.items(), key=lambda x: x[1]['count'], reverse=True)[:limit]
-                day_data['byFile'] = {file: data for file, data in sorted_files}
-            elif stats_type == 'events' and 'byCategoryAndAction' in stats_data:
-                # 事件按类别+动作收集趋势数据，包含事件次数和用户数
-                event_data = {}
-                # 获取事件类别和动作数据
-                for category, actions in stats_data['byCategoryAndAction'].items():
-                    for action, count in actions.items():
-                        event_key = f"{category}.{action}"
-                        # 计算该事件的唯一用户数
-                        unique_users = 0
-                        if stats_data.get('byCategoryAndActionAndUser', {}).get(category, {}).get(action):
-                            unique_users = len(stats_data['byCategoryAndActionAndUser'][category][action])
-                        event_data[event_key] = {
-                            'count': count,
-                            'uniqueUsers': unique_users
-                        }
-                # 按事件次数排序，取前limit个
-                sorted_events = sorted(event_data.items(), key=lambda x: x[1]['count'], reverse=True)[:limit]
-                day_data['byCategoryAndAction'] = {event: data for event, data in sorted_events}
-            
-            trend_data.append(day_data)
+        async def merge_documents(stats_cursor, partial=None):
+            """合并文档到部分结果 (聚合结果, 路径计数, 趋势数据)"""
+            # 按维度累加的路径计数包括top-K模式下各维度键的误差上界topKErrors
+            partial = partial or (result_initializer(), FlatStatsMerger(), [])
+            await _merge_stats_documents(stats_cursor, *partial, merge_fields, stats_type, limit,
+                                         unique_users_handler)
+            return partial
+
+        if day_cache.enabled and granularity == 'day' and not include_users and not use_rollups and not archived:
+            # 已结束的日期使用缓存的合并结果，只重新读取并合并尚未结束的日期（通常只有当天）
+            partial, fresh_query = await day_cache.merged_closed_days(query, projection, (limit,), merge_documents)
+            if fresh_query:
+                partial = await merge_documents(_iter_stats_documents(fresh_query, projection, granularity), partial)
+        else:
+            partial = await merge_documents(_iter_stats_documents(query, projection, granularity, use_rollups, archived))
+        aggregated_stats, merger, trend_data = partial
+
+        # 按用户下钻时再读取分桶存储的用户维度（其他存储的用户维度在每日文档内）
+        if include_users and STATS_STORAGE == 'mongodb':
+            user_stats_cursor = user_stats_collection.find(query, {'_id': 0, 'dimension': 1, 'data': 1})
+            async for user_stats in user_stats_cursor:
+                dimension = user_stats.get('dimension')
+                if dimension in aggregated_stats:
+                    merger.add(dimension, user_stats.get('data'))
+
+        # 只为前N个一级键重建嵌套字典（结果处理函数对这些维度都只返回前N个条目）
+        except_keys = ['count'] if stats_type == 'duration' else ()
+        for key in merge_fields:
+            if key in merger:
+                aggregated_stats[key] = merger.to_nested(key, limit, except_keys)
+        topk_errors = merger.to_nested('topKErrors')
 
-            # 聚合基本统计（避免重复查找）
-            total = stats_data.get('total', 0)
-            aggregated_stats['total'] += total
-            
-            # 处理duration统计方法中的count字段
-            if 'count' in stats_data and 'count' in aggregated_stats:
-                aggregated_stats['count'] += stats_data.get('count', 0)
-
-            # 聚合嵌套字典数据（使用预计算的字段列表）
-            for key in merge_fields:
-                if key in stats_data:
-                    if not aggregated_stats[key]:
-                        # 如果聚合结果为空，直接使用当前数据
-                        aggregated_stats[key] = stats_data[key]
-                    else:
-                        # 合并嵌套字典
-                        aggregated_stats[key] = merge_nested_dicts(aggregated_stats[key], stats_data[key])
-                    
-            # 合并唯一用户集合（只在存在时处理）
-            stats_unique_users = stats_data.get('uniqueUsers')
-            if stats_unique_users:
-                aggregated_stats['uniqueUsers'].update(stats_unique_users)
-
-            # 处理特定的唯一用户数据
-            unique_users_handler(aggregated_stats, stats_data, stats_type)
-
-        # 将集合转换为列表，方便客户端处理
-        aggregated_stats['uniqueUsers'] = list(aggregated_stats['uniqueUsers'])
-        
         # 将趋势数据添加到聚合结果中
         aggregated_stats['trendData'] = trend_data
 
-        # ========== 统一还原所有键 ==========
-        aggregated_stats = restore_all_keys_recursive(aggregated_stats)
+        entries = _topk_entries(aggregated_stats, topk_errors, stats_type, limit)
+        result = _attach_topk_errors(final_result_handler(aggregated_stats, limit), topk_errors, entries)
 
-        # 返回处理后的结果
-        return final_result_handler(aggregated_stats, limit)
+        # ========== 统一还原最终结果的键 ==========
+        return await _restore_result(system, result)
 
     except Exception as e:
         logger.error(f"获取{stats_type}统计失败: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"获取{stats_type}统计失败: {str(e)}")
 
 
+async def _merge_stats_documents(stats_cursor, aggregated_stats: dict, merger: FlatStatsMerger, trend_data: list,
+                                 merge_fields: List[str], stats_type: str, limit: int, unique_users_handler):
+    """聚合所有日期分片的数据，并收集趋势数据"""
+    async for stats in stats_cursor:
+        if 'data' not in stats:
+            continue
+            
+        stats_data = stats['data']
+        date = stats['date']
+        # HLL模式下的唯一用户草图（旧数据没有）
+        hll_data = stats_data.get('hll', {})
+        
+        if 'trend' in stats:
+            # 周/月汇总文档保存了周期内每天的趋势数据
+            trend_data.extend(_limit_trend_entry(entry, limit) for entry in stats['trend'])
+        else:
+            trend_data.append(_build_trend_entry(stats_type, date, stats_data, limit))
+
+        # 聚合基本统计（避免重复查找）
+        total = stats_data.get('total', 0)
+        aggregated_stats['total'] += total
+        
+        # 处理duration统计方法中的count字段
+        if 'count' in stats_data and 'count' in aggregated_stats:
+            aggregated_stats['count'] += stats_data.get('count', 0)
+
+        # 聚合嵌套字典数据（使用预计算的字段列表，展开为路径计数后累加）
+        for key in merge_fields:
+            if key in stats_data:
+                merger.add(key, stats_data[key])
+                
+        # 合并唯一用户集合（只在存在时处理）
+        stats_unique_users = stats_data.get('uniqueUsers')
+        if stats_unique_users:
+            aggregated_stats['uniqueUsers'].update(stats_unique_users)
+        if hll_data.get('uniqueUsers'):
+            aggregated_stats['uniqueUsers'].merge_sketch(hll_data['uniqueUsers'])
+
+        # 处理特定的唯一用户数据
+        unique_users_handler(aggregated_stats, stats_data, stats_type)
+
+        merger.add('topKErrors', stats_data.get('topKErrors'))
+
+
+def _merge_unique_users_map(target: dict, users_map: Optional[dict], sketch_map: Optional[dict], depth: int = 1):
+    """
+    按维度合并唯一用户（指纹列表和HLL草图）到UniqueUserCounter
+    :param target: 聚合结果中的维度字典
+    :param users_map: 当天的指纹列表字典
+    :param sketch_map: 当天的HLL草图字典
+    :param depth: 维度层数，例如浏览器+操作系统为2
+    """
+    users_map = users_map or {}
+    sketch_map = sketch_map or {}
+    for key in set(users_map) | set(sketch_map):
+        users = users_map.get(key)
+        sketch = sketch_map.get(key)
+        if depth > 1:
+            _merge_unique_users_map(target.setdefault(key, {}), users, sketch, depth - 1)
+            continue
+        counter = target.get(key)
+        if counter is None:
+            counter = target[key] = UniqueUserCounter()
+        # 只处理集合或列表类型，避免类型错误
+        if isinstance(users, (set, list)):
+            counter.update(users)
+        if sketch:
+            counter.merge_sketch(sketch)
+
+
 def _init_pageview_result():
     """
     初始化页面访问统计结果
@@ -735,7 +1170,8 @@ def _init_pageview_result():
         'byBrowserAndOS': {},
         'byReferrer': {},
         'byUrlAndReferrer': {},
-        'uniqueUsers': set(),
+        'uniqueUsers': UniqueUserCounter(),
+        'byUrlUniqueUsers': {},
         'byIPPrefixUniqueUsers': {},
         'byBrowserAndOsUniqueUsers': {}
     }
@@ -745,32 +1181,27 @@ def _handle_pageview_unique_users(aggregated_stats, stats_data, stats_type):
     """
     处理页面访问的唯一用户数据
     """
+    hll_data = stats_data.get('hll', {})
+    # 聚合按URL分组的唯一用户
+    _merge_unique_users_map(aggregated_stats['byUrlUniqueUsers'],
+                            stats_data.get('byUrlUniqueUsers'),
+                            hll_data.get('byUrlUniqueUsers'))
+
     # 聚合按浏览器和操作系统分组的唯一用户
-    for browser, os_data in stats_data.get('byBrowserAndOsUniqueUsers', {}).items():
-        if browser not in aggregated_stats['byBrowserAndOsUniqueUsers']:
-            aggregated_stats['byBrowserAndOsUniqueUsers'][browser] = {}
-        
-        for os, users in os_data.items():
-            if os not in aggregated_stats['byBrowserAndOsUniqueUsers'][browser]:
-                aggregated_stats['byBrowserAndOsUniqueUsers'][browser][os] = set()
-            aggregated_stats['byBrowserAndOsUniqueUsers'][browser][os].update(users)
+    _merge_unique_users_map(aggregated_stats['byBrowserAndOsUniqueUsers'],
+                            stats_data.get('byBrowserAndOsUniqueUsers'),
+                            hll_data.get('byBrowserAndOsUniqueUsers'), depth=2)
     
     # 聚合按IP前缀分组的唯一用户
-    for ip, users in stats_data.get('byIPPrefixUniqueUsers', {}).items():
-        if ip not in aggregated_stats['byIPPrefixUniqueUsers']:
-            aggregated_stats['byIPPrefixUniqueUsers'][ip] = set()
-        aggregated_stats['byIPPrefixUniqueUsers'][ip].update(users)
+    _merge_unique_users_map(aggregated_stats['byIPPrefixUniqueUsers'],
+                            stats_data.get('byIPPrefixUniqueUsers'),
+                            hll_data.get('byIPPrefixUniqueUsers'))
 
 
 def _finalize_pageview_result(aggregated_stats, limit):
     """
     处理页面访问统计的最终结果
     """
-    # 处理浏览器和操作系统唯一用户数据（将集合转换为列表）
-    for browser in aggregated_stats['byBrowserAndOsUniqueUsers']:
-        for os in aggregated_stats['byBrowserAndOsUniqueUsers'][browser]:
-            aggregated_stats['byBrowserAndOsUniqueUsers'][browser][os] = list(aggregated_stats['byBrowserAndOsUniqueUsers'][browser][os])
-
     # 处理浏览器和操作系统组合的唯一用户数，应用limit限制
     raw_browser_os_unique_users = aggregated_stats.get('byBrowserAndOsUniqueUsers', {})
     # 先计算每个浏览器的总唯一用户数，用于排序
@@ -789,18 +1220,19 @@ def _finalize_pageview_result(aggregated_stats, limit):
         sorted_os = sorted(os_data.items(), key=lambda x: len(x[1]), reverse=True)[:limit]
         limited_browser_os_unique_users[browser] = {os: len(users) for os, users in sorted_os}
 
-    # 处理IP前缀唯一用户数据（将集合转换为列表）
-    for ip in aggregated_stats['byIPPrefixUniqueUsers']:
-        aggregated_stats['byIPPrefixUniqueUsers'][ip] = list(aggregated_stats['byIPPrefixUniqueUsers'][ip])
-    
     # 计算每个IP前缀的唯一用户数，应用limit限制
     ip_prefix_unique_users = {ip: len(users) for ip, users in aggregated_stats['byIPPrefixUniqueUsers'].items()}
     ip_prefix_unique_users = get_top_entries(ip_prefix_unique_users, limit)
     
     # 应用limit限制到所有嵌套字典
     for key in aggregated_stats:
-        if key not in ['total', 'uniqueUsers', 'byBrowserAndOsUniqueUsers', 'byIPPrefixUniqueUsers', 'trendData'] and isinstance(aggregated_stats[key], dict):
+        if key not in ['total', 'uniqueUsers', 'byUrlUniqueUsers', 'byBrowserAndOsUniqueUsers', 'byIPPrefixUniqueUsers', 'trendData'] and isinstance(aggregated_stats[key], dict):
             aggregated_stats[key] = get_top_entries(aggregated_stats[key], limit)
+
+    # 只计算返回的URL的唯一用户数
+    raw_url_unique_users = aggregated_stats['byUrlUniqueUsers']
+    url_unique_users = {url: len(raw_url_unique_users[url]) for url in aggregated_stats.get('byUrl', {})
+                        if url in raw_url_unique_users}
     
     # 返回处理后的结果
     return {
@@ -819,6 +1251,7 @@ def _finalize_pageview_result(aggregated_stats, limit):
         "byUser": aggregated_stats.get('byUser', {}),
         "byUrlAndUser": aggregated_stats.get('byUrlAndUser', {}),
         "uniqueUsers": len(aggregated_stats.get('uniqueUsers', [])),
+        "byUrlUniqueUsers": url_unique_users,
         "browserAndOSUniqueUsers": limited_browser_os_unique_users,
         "byIPPrefixUniqueUsers": ip_prefix_unique_users,
         "trendData": aggregated_stats.get('trendData', [])
@@ -828,7 +1261,8 @@ def _finalize_pageview_result(aggregated_stats, limit):
 @api_router.get("/stats/pageview")
 async def get_technology_stats(request: Request, system: str = "default",
                                start_date: Optional[str] = None, end_date: Optional[str] = None,
-                               limit: int = 10):
+                               limit: int = 10, include_users: bool = False,
+                               granularity: str = "day", engine: Optional[str] = None):
     """
     获取页面访问统计
     """
@@ -838,7 +1272,10 @@ async def get_technology_stats(request: Request, system: str = "default",
         "pageViews",
         _init_pageview_result,
         _handle_pageview_unique_users,
-        _finalize_pageview_result
+        _finalize_pageview_result,
+        include_users,
+        granularity,
+        engine
     )
 
 
@@ -856,7 +1293,7 @@ def _init_downloads_result():
         'byFileAndIPPrefix': {},
         'byUser': {},
         'byFileAndUser': {},
-        'uniqueUsers': set(),
+        'uniqueUsers': UniqueUserCounter(),
         'byFileUniqueUsers': {},
         'byIPPrefixUniqueUsers': {}
     }
@@ -866,29 +1303,22 @@ def _handle_downloads_unique_users(aggregated_stats, stats_data, stats_type):
     """
     处理下载统计的唯一用户数据
     """
+    hll_data = stats_data.get('hll', {})
     # 聚合按文件分组的唯一用户
-    for file, users in stats_data.get('byFileUniqueUsers', {}).items():
-        if file not in aggregated_stats['byFileUniqueUsers']:
-            aggregated_stats['byFileUniqueUsers'][file] = set()
-        aggregated_stats['byFileUniqueUsers'][file].update(users)
+    _merge_unique_users_map(aggregated_stats['byFileUniqueUsers'],
+                            stats_data.get('byFileUniqueUsers'),
+                            hll_data.get('byFileUniqueUsers'))
 
     # 聚合按IP前缀分组的唯一用户
-    for ip, users in stats_data.get('byIPPrefixUniqueUsers', {}).items():
-        if ip not in aggregated_stats['byIPPrefixUniqueUsers']:
-            aggregated_stats['byIPPrefixUniqueUsers'][ip] = set()
-        aggregated_stats['byIPPrefixUniqueUsers'][ip].update(users)
+    _merge_unique_users_map(aggregated_stats['byIPPrefixUniqueUsers'],
+                            stats_data.get('byIPPrefixUniqueUsers'),
+                            hll_data.get('byIPPrefixUniqueUsers'))
 
 
 def _finalize_downloads_result(aggregated_stats, limit):
     """
     处理下载统计的最终结果
     """
-    # 将集合转换为列表，方便客户端处理
-    for file in aggregated_stats['byFileUniqueUsers']:
-        aggregated_stats['byFileUniqueUsers'][file] = list(aggregated_stats['byFileUniqueUsers'][file])
-    for ip in aggregated_stats['byIPPrefixUniqueUsers']:
-        aggregated_stats['byIPPrefixUniqueUsers'][ip] = list(aggregated_stats['byIPPrefixUniqueUsers'][ip])
-
     # 为文件唯一用户和IP前缀唯一用户应用limit
     # 处理文件唯一用户
     file_unique_users = {file: len(users) for file, users in aggregated_stats['byFileUniqueUsers'].items()}
@@ -918,7 +1348,8 @@ def _finalize_downloads_result(aggregated_stats, limit):
 @api_router.get("/stats/downloads")
 async def get_download_stats(request: Request, system: str = "default",
                              start_date: Optional[str] = None, end_date: Optional[str] = None,
-                             limit: int = 10):
+                             limit: int = 10, include_users: bool = False,
+                             granularity: str = "day", engine: Optional[str] = None):
     """
     获取下载统计
     """
@@ -928,7 +1359,10 @@ async def get_download_stats(request: Request, system: str = "default",
         "downloads",
         _init_downloads_result,
         _handle_downloads_unique_users,
-        _finalize_downloads_result
+        _finalize_downloads_result,
+        include_users,
+        granularity,
+        engine
     )
 
 
@@ -953,9 +1387,10 @@ def _init_events_result():
         'byCategoryAndAction': {},
         'byCategoryAndLabel': {},
         'byUrlAndAction': {},
-        'uniqueUsers': set(),
+        'uniqueUsers': UniqueUserCounter(),
         'byCategoryUniqueUsers': {},
         'byActionUniqueUsers': {},
+        'byCategoryAndActionUniqueUsers': {},
         'byIPPrefixUniqueUsers': {}
     }
 
@@ -964,42 +1399,46 @@ def _handle_events_unique_users(aggregated_stats, stats_data, stats_type):
     """
     处理事件统计的唯一用户数据
     """
+    hll_data = stats_data.get('hll', {})
     # 聚合按类别分组的唯一用户
-    for category, users in stats_data.get('byCategoryUniqueUsers', {}).items():
-        if category not in aggregated_stats['byCategoryUniqueUsers']:
-            aggregated_stats['byCategoryUniqueUsers'][category] = set()
-        # 只处理集合或列表类型，避免类型错误
-        if isinstance(users, (set, list)):
-            aggregated_stats['byCategoryUniqueUsers'][category].update(users)
+    _merge_unique_users_map(aggregated_stats['byCategoryUniqueUsers'],
+                            stats_data.get('byCategoryUniqueUsers'),
+                            hll_data.get('byCategoryUniqueUsers'))
 
     # 聚合按操作分组的唯一用户
-    for action, users in stats_data.get('byActionUniqueUsers', {}).items():
-        if action not in aggregated_stats['byActionUniqueUsers']:
-            aggregated_stats['byActionUniqueUsers'][action] = set()
-        # 只处理集合或列表类型，避免类型错误
-        if isinstance(users, (set, list)):
-            aggregated_stats['byActionUniqueUsers'][action].update(users)
+    _merge_unique_users_map(aggregated_stats['byActionUniqueUsers'],
+                            stats_data.get('byActionUniqueUsers'),
+                            hll_data.get('byActionUniqueUsers'))
+
+    # 聚合按类别+操作分组的唯一用户（旧数据没有该字段，使用byCategoryAndActionAndUser中的指纹）
+    category_action_users = stats_data.get('byCategoryAndActionUniqueUsers')
+    if category_action_users is None and stats_data.get('byCategoryAndActionAndUser'):
+        category_action_users = {
+            category: {action: list(users) for action, users in actions.items() if isinstance(users, dict)}
+            for category, actions in stats_data['byCategoryAndActionAndUser'].items() if isinstance(actions, dict)
+        }
+    _merge_unique_users_map(aggregated_stats['byCategoryAndActionUniqueUsers'],
+                            category_action_users,
+                            hll_data.get('byCategoryAndActionUniqueUsers'), depth=2)
 
     # 聚合按IP前缀分组的唯一用户
-    for ip, users in stats_data.get('byIPPrefixUniqueUsers', {}).items():
-        if ip not in aggregated_stats['byIPPrefixUniqueUsers']:
-            aggregated_stats['byIPPrefixUniqueUsers'][ip] = set()
-        # 只处理集合或列表类型，避免类型错误
-        if isinstance(users, (set, list)):
-            aggregated_stats['byIPPrefixUniqueUsers'][ip].update(users)
+    _merge_unique_users_map(aggregated_stats['byIPPrefixUniqueUsers'],
+                            stats_data.get('byIPPrefixUniqueUsers'),
+                            hll_data.get('byIPPrefixUniqueUsers'))
 
 
 def _finalize_events_result(aggregated_stats, limit):
     """
     处理事件统计的最终结果
     """
-    # 将集合转换为列表，方便客户端处理
-    for category in aggregated_stats['byCategoryUniqueUsers']:
-        aggregated_stats['byCategoryUniqueUsers'][category] = list(aggregated_stats['byCategoryUniqueUsers'][category])
-    for action in aggregated_stats['byActionUniqueUsers']:
-        aggregated_stats['byActionUniqueUsers'][action] = list(aggregated_stats['byActionUniqueUsers'][action])
-    for ip in aggregated_stats['byIPPrefixUniqueUsers']:
-        aggregated_stats['byIPPrefixUniqueUsers'][ip] = list(aggregated_stats['byIPPrefixUniqueUsers'][ip])
+    # 只计算返回的类别+操作组合的唯一用户数
+    top_category_actions = get_top_entries(aggregated_stats.get('byCategoryAndAction', {}), limit)
+    raw_category_action_users = aggregated_stats.get('byCategoryAndActionUniqueUsers', {})
+    category_action_unique_users = {}
+    for category, actions in top_category_actions.items():
+        action_users = raw_category_action_users.get(category, {})
+        category_action_unique_users[category] = {action: len(action_users[action]) for action in actions
+                                                  if action in action_users}
 
     # 只返回客户端需要的前N条数据，减少数据传输量
     return {
@@ -1010,7 +1449,7 @@ def _finalize_events_result(aggregated_stats, limit):
         "byLabel": get_top_entries(aggregated_stats.get('byLabel', {}), limit),
         "bySelector": get_top_entries(aggregated_stats.get('bySelector', {}), limit),
         "byUrl": get_top_entries(aggregated_stats.get('byUrl', {}), limit),
-        "byCategoryAndAction": get_top_entries(aggregated_stats.get('byCategoryAndAction', {}), limit),
+        "byCategoryAndAction": top_category_actions,
         "byCategoryAndLabel": get_top_entries(aggregated_stats.get('byCategoryAndLabel', {}), limit),
         "byUrlAndAction": get_top_entries(aggregated_stats.get('byUrlAndAction', {}), limit),
         # IP相关统计
@@ -1026,6 +1465,7 @@ def _finalize_events_result(aggregated_stats, limit):
         "byIPPrefixUniqueUsers": get_top_entries({ip: len(users) for ip, users in
                                                 aggregated_stats.get('byIPPrefixUniqueUsers', {}).items()},
                                                 limit),
+        "byCategoryAndActionUniqueUsers": category_action_unique_users,
          "byCategoryAndActionAndUser": get_top_entries(aggregated_stats.get('byCategoryAndActionAndUser', {}), limit),
         "byUser": get_top_entries(aggregated_stats.get('byUser', {}), limit),
         "trendData": aggregated_stats.get("trendData", [])
@@ -1035,7 +1475,8 @@ def _finalize_events_result(aggregated_stats, limit):
 @api_router.get("/stats/events")
 async def get_event_stats(request: Request, system: str = "default",
                           start_date: Optional[str] = None, end_date: Optional[str] = None,
-                          limit: int = 10):
+                          limit: int = 10, include_users: bool = False,
+                          granularity: str = "day", engine: Optional[str] = None):
     """
     获取事件统计
     """
@@ -1045,7 +1486,10 @@ async def get_event_stats(request: Request, system: str = "default",
         "events",
         _init_events_result,
         _handle_events_unique_users,
-        _finalize_events_result
+        _finalize_events_result,
+        include_users,
+        granularity,
+        engine
     )
 
 
@@ -1067,7 +1511,7 @@ def _init_duration_result():
         'byUrlAndBrowser': {},
         'byUrlAndDevice': {},
         'byBrowserAndOS': {},
-        'uniqueUsers': set()
+        'uniqueUsers': UniqueUserCounter()
     }
 
 
@@ -1106,7 +1550,8 @@ def _finalize_duration_result(aggregated_stats, limit):
 @api_router.get("/stats/duration")
 async def get_duration_stats(request: Request, system: str = "default",
                              start_date: Optional[str] = None, end_date: Optional[str] = None,
-                             limit: int = 10):
+                             limit: int = 10, include_users: bool = False,
+                             granularity: str = "day", engine: Optional[str] = None):
     """
     获取停留时长统计
     """
@@ -1116,31 +1561,46 @@ async def get_duration_stats(request: Request, system: str = "default",
         "duration",
         _init_duration_result,
         _handle_duration_unique_users,
-        _finalize_duration_result
+        _finalize_duration_result,
+        include_users,
+        granularity,
+        engine
     )
 
 
+def _invalidate_system_caches(system: str):
+    """删除统计数据时清除本进程中该system的缓存"""
+    dimension_dictionary.invalidate_system(system)
+    day_cache.invalidate_system(system)
+    topk_limiter.invalidate_site(system)
+
+
+stats_delete_jobs = StatsDeleteJobs(_invalidate_system_caches)
+
+
 async def _delete_system_stats(system: str) -> Dict[str, Any]:
     """
     删除指定system的所有统计数据（普通方法，不带有路由装饰器）
+    数据在后台任务中分批删除，返回任务id，进度通过 GET /api/stats/{system}/delete-jobs/{job_id} 查询
     
     Args:
         system: 要删除统计数据的系统名称
     
     Returns:
-        包含删除结果的字典
+        包含删除任务信息的字典
     """
     try:
         # 清理system名称中的特殊字符
         sanitized_system = sanitize_key(system)
         
-        # 删除该系统的所有统计数据
-        result = await stats_collection.delete_many({'system': sanitized_system})
+        # 删除统计数据、分桶存储的用户维度、小时文档、周/月汇总和维度字典
+        job = await stats_delete_jobs.start(sanitized_system)
         
         return {
             "success": True,
-            "message": f"成功删除系统 '{sanitized_system}' 的统计数据",
-            "deleted_count": result.deleted_count
+            "message": f"已开始删除系统 '{sanitized_system}' 的统计数据",
+            "job_id": job['_id'],
+            "status": job['status']
         }
     except Exception as e:
         logger.error(f"删除系统统计数据失败: {str(e)}", exc_info=True)
@@ -1151,7 +1611,7 @@ async def _delete_system_stats(system: str) -> Dict[str, Any]:
 @access_system("${system}")
 async def delete_system_stats(request: Request, system: str):
     """
-    删除指定system的所有统计数据
+    删除指定system的所有统计数据（后台分批删除，立即返回任务id）
     
     Args:
         request: 请求对象，用于获取当前用户信息
@@ -1165,6 +1625,18 @@ async def delete_system_stats(request: Request, system: str):
         raise
 
 
+@api_router.get("/stats/{system}/delete-jobs/{job_id}")
+@access_system("${system}")
+async def get_delete_job(request: Request, system: str, job_id: str):
+    """
+    查询删除任务的进度：状态、已删除文档数（总数和各集合）、耗时和每秒删除的文档数
+    """
+    job = await stats_delete_jobs.status(job_id)
+    if not job or job['system'] != sanitize_key(system):
+        raise HTTPException(status_code=404, detail="删除任务不存在")
+    return job
+
+
 # 添加监控端点
 @api_router.get("/batch/metrics")
 @require_login()
@@ -1177,5 +1649,12 @@ async def get_metrics(request: Request):
     return {
         "enabled": enable_batch_processor,
         "process_id": os.getpid(),
-        "metrics": metrics
+        "metrics": metrics,
+        "site_cache": get_site_cache_metrics(),
+        "rollup": stats_rollup.get_metrics() if STATS_HOURLY_BUCKETS else None,
+        "period_rollup": period_compactor.get_metrics() if STATS_PERIOD_ROLLUPS else None,
+        "retention": stats_retention.get_metrics() if STATS_RETENTION else None,
+        "day_cache": day_cache.get_metrics() if day_cache.enabled else None,
+        "dimension_dictionary": dimension_dictionary.get_metrics() if STATS_DIMENSION_DICTIONARY else None,
+        "stats_cache": _stats_common.cache_info()
     }
@@ -1,127 +1,331 @@
+import asyncio
 import inspect
+import logging
+import math
+import threading
 import time
+from collections import OrderedDict
 from functools import wraps
-from typing import Callable, Dict, Tuple, Any
+from typing import Callable, Dict, Tuple, Any, List, Optional
 from fastapi import Request
 from security import require_permissions
 
+logger = logging.getLogger(__name__)
+
+
+def _make_cache_key(args, kwargs) -> Tuple[Any, ...]:
+    """构建缓存键，过滤掉不可哈希的参数（如Request对象）"""
+    hashable_args = tuple(arg for arg in args if not isinstance(arg, Request))
+    hashable_kwargs = tuple(sorted((k, v) for k, v in kwargs.items() if not isinstance(v, Request)))
+    return hashable_args + hashable_kwargs
+
+
 # 带过期时间的LRU缓存装饰器（支持异步函数）
-def lru_cache_with_ttl(maxsize: int = 128, ttl: int = 3600):
+def lru_cache_with_ttl(maxsize: int = 128, ttl: int = 3600, stale_ttl: float = 0):
     """
     带过期时间的LRU缓存装饰器，同时支持同步和异步函数
+    - OrderedDict维护访问顺序，命中和淘汰都是O(1)
+    - 同一个键的并发调用只执行一次（single-flight），其余调用等待同一个结果；
+      失败不共享（等待者各自重新执行），发起者被取消时执行继续，等待者仍能拿到结果
+    - stale_ttl>0时，过期不超过stale_ttl秒的结果直接返回，同时在后台刷新（stale-while-revalidate）
+    被装饰的函数提供cache_info()（命中/未命中/淘汰等计数）和cache_clear()
+    缓存键不包含调用者，权限检查等依赖调用者的逻辑必须放在本装饰器之外（先于缓存执行）
     :param maxsize: 缓存最大数量
     :param ttl: 缓存过期时间（秒）
+    :param stale_ttl: 过期后仍可返回旧结果的时间（秒），0表示不启用
     """
-    # 只使用一个缓存字典，存储(key: (timestamp, result))
-    cache: Dict[Tuple[Any, ...], Tuple[float, Any]] = {}
-    # 使用有序列表来维护访问顺序，用于LRU淘汰
-    access_order = []
+    # {key: (timestamp, result)}，按访问顺序排列，最久未使用的在最前面
+    cache: "OrderedDict[Tuple[Any, ...], Tuple[float, Any]]" = OrderedDict()
+    lock = threading.Lock()
+    stats = {'hits': 0, 'misses': 0, 'stale_hits': 0, 'shared': 0, 'evictions': 0, 'refreshes': 0,
+             'refresh_errors': 0}
+
+    def increment(name: str):
+        with lock:
+            stats[name] += 1
+
+    def lookup(key, count: bool = True) -> Tuple[bool, bool, Any]:
+        """返回(是否命中, 是否已过期需要刷新, 结果)，count为False时不计入命中统计"""
+        with lock:
+            entry = cache.get(key)
+            if entry is None:
+                return False, False, None
+            timestamp, result = entry
+            age = time.time() - timestamp
+            if age < ttl:
+                cache.move_to_end(key)
+                if count:
+                    stats['hits'] += 1
+                return True, False, result
+            if age < ttl + stale_ttl:
+                cache.move_to_end(key)
+                if count:
+                    stats['stale_hits'] += 1
+                return True, True, result
+            del cache[key]
+            return False, False, None
+
+    def store(key, result):
+        with lock:
+            cache[key] = (time.time(), result)
+            cache.move_to_end(key)
+            while len(cache) > maxsize:
+                cache.popitem(last=False)
+                stats['evictions'] += 1
+
+    def cache_info() -> Dict[str, Any]:
+        with lock:
+            total = stats['hits'] + stats['stale_hits'] + stats['misses']
+            return dict(stats, size=len(cache), maxsize=maxsize, ttl=ttl, stale_ttl=stale_ttl,
+                        hit_ratio=round((stats['hits'] + stats['stale_hits']) / total, 4) if total else 0.0)
+
+    def cache_clear():
+        with lock:
+            cache.clear()
 
     def decorator(func: Callable) -> Callable:
         # 检查函数是否为异步函数
         is_async = inspect.iscoroutinefunction(func)
 
         if is_async:
+            # {key: Task}，正在执行的调用（独立的任务，不随发起者取消）
+            in_flight: Dict[Tuple[Any, ...], asyncio.Task] = {}
+
+            def load(key, args, kwargs) -> asyncio.Task:
+                task = asyncio.ensure_future(func(*args, **kwargs))
+                in_flight[key] = task
+
+                def done(finished: asyncio.Task):
+                    if in_flight.get(key) is finished:
+                        del in_flight[key]
+                    # 读取异常，没有等待者时避免"exception was never retrieved"警告
+                    if not finished.cancelled() and finished.exception() is None:
+                        store(key, finished.result())
+
+                task.add_done_callback(done)
+                return task
+
+            def refresh(key, args, kwargs):
+                def done(task: asyncio.Task):
+                    if not task.cancelled() and task.exception() is None:
+                        increment('refreshes')
+                        return
+                    increment('refresh_errors')
+                    error = 'cancelled' if task.cancelled() else task.exception()
+                    logger.warning(f"Background cache refresh failed for {func.__name__}: {error}")
+
+                load(key, args, kwargs).add_done_callback(done)
+
             @wraps(func)
             async def cached_func(*args, **kwargs):
-                # 构建缓存键，过滤掉不可哈希的参数（如Request对象）
-                hashable_args = []
-                for arg in args:
-                    if isinstance(arg, Request):
-                        # 跳过Request对象，不将其作为缓存键的一部分
-                        continue
-                    hashable_args.append(arg)
-
-                hashable_kwargs = {}
-                for k, v in kwargs.items():
-                    if isinstance(v, Request):
-                        # 跳过Request对象
-                        continue
-                    hashable_kwargs[k] = v
-
-                key = tuple(hashable_args) + tuple(sorted(hashable_kwargs.items()))
-
-                # 检查缓存是否存在且未过期
-                if key in cache:
-                    timestamp, result = cache[key]
-                    if time.time() - timestamp < ttl:
-                        # 更新访问顺序（移到最后，表示最近使用）
-                        if key in access_order:
-                            access_order.remove(key)
-                        access_order.append(key)
-                        return result
-                    else:
-                        # 缓存已过期，移除
-                        del cache[key]
-                        if key in access_order:
-                            access_order.remove(key)
-
-                # 执行异步函数
-                result = await func(*args, **kwargs)
-
-                # 检查缓存大小，超过限制则移除最久未使用的项
-                if len(cache) >= maxsize:
-                    # 移除第一个元素（最久未使用）
-                    oldest_key = access_order.pop(0)
-                    del cache[oldest_key]
-
-                # 存储结果和时间戳
-                cache[key] = (time.time(), result)
-                access_order.append(key)
-
-                return result
+                key = _make_cache_key(args, kwargs)
+                hit, stale, result = lookup(key)
+                if hit:
+                    if stale and key not in in_flight:
+                        # 返回旧结果，同时在后台刷新
+                        refresh(key, args, kwargs)
+                    return result
+                task = in_flight.get(key)
+                if task is None:
+                    increment('misses')
+                    return await asyncio.shield(load(key, args, kwargs))
+                # 相同的调用正在执行，等待其结果
+                increment('shared')
+                try:
+                    return await asyncio.shield(task)
+                except asyncio.CancelledError:
+                    if not task.cancelled():
+                        raise  # 等待者自己被取消
+                except Exception:
+                    pass
+                # 失败不共享给等待者，自行执行一次
+                return await func(*args, **kwargs)
         else:
+            # {key: [Lock, 使用者数]}，同一个键的调用串行执行，后来者直接使用先执行者写入的结果；
+            # 失败时后来者自行执行。最后一个使用者释放时才删除锁，避免同一个键的调用并发执行
+            key_locks: Dict[Tuple[Any, ...], List[Any]] = {}
+            refreshing = set()
+
+            def load(key, args, kwargs, force=False):
+                with lock:
+                    entry = key_locks.setdefault(key, [threading.Lock(), 0])
+                    entry[1] += 1
+                try:
+                    with entry[0]:
+                        if not force:
+                            hit, stale, result = lookup(key, count=False)
+                            if hit and not stale:
+                                increment('shared')
+                                return result
+                            increment('misses')
+                        result = func(*args, **kwargs)
+                        store(key, result)
+                        return result
+                finally:
+                    with lock:
+                        entry[1] -= 1
+                        if not entry[1]:
+                            del key_locks[key]
+
+            def refresh(key, args, kwargs):
+                try:
+                    load(key, args, kwargs, force=True)
+                    increment('refreshes')
+                except Exception as e:
+                    increment('refresh_errors')
+                    logger.warning(f"Background cache refresh failed for {func.__name__}: {e}")
+                finally:
+                    refreshing.discard(key)
+
             @wraps(func)
             def cached_func(*args, **kwargs):
-                # 构建缓存键，过滤掉不可哈希的参数
-                hashable_args = []
-                for arg in args:
-                    if isinstance(arg, Request):
-                        # 跳过Request对象
-                        continue
-                    hashable_args.append(arg)
-
-                hashable_kwargs = {}
-                for k, v in kwargs.items():
-                    if isinstance(v, Request):
-                        # 跳过Request对象
-                        continue
-                    hashable_kwargs[k] = v
-
-                key = tuple(hashable_args) + tuple(sorted(hashable_kwargs.items()))
-
-                # 检查缓存是否存在且未过期
-                if key in cache:
-                    timestamp, result = cache[key]
-                    if time.time() - timestamp < ttl:
-                        # 更新访问顺序
-                        if key in access_order:
-                            access_order.remove(key)
-                        access_order.append(key)
-                        return result
-                    else:
-                        # 缓存已过期
-                        del cache[key]
-                        if key in access_order:
-                            access_order.remove(key)
+                key = _make_cache_key(args, kwargs)
+                hit, stale, result = lookup(key)
+                if hit:
+                    if stale and key not in refreshing:
+                        refreshing.add(key)
+                        threading.Thread(target=refresh, args=(key, args, kwargs), daemon=True).start()
+                    return result
+                return load(key, args, kwargs)
+
+        cached_func.cache_info = cache_info
+        cached_func.cache_clear = cache_clear
+        return cached_func
+
+    return decorator
 
-                # 执行同步函数
-                result = func(*args, **kwargs)
 
-                # LRU淘汰
-                if len(cache) >= maxsize:
-                    oldest_key = access_order.pop(0)
-                    del cache[oldest_key]
+class BoundedTTLCache:
+    """
+    线程安全的有界TTL缓存，支持为单个条目指定过期时间（例如负结果使用更短的TTL）
+    超过maxsize时按LRU淘汰，并记录命中/未命中计数
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self._cache: "OrderedDict[Any, Tuple[Any, float]]" = OrderedDict()  # {key: (value, expire_time)}
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-                # 存储结果
-                cache[key] = (time.time(), result)
-                access_order.append(key)
+    def get(self, key, default=None):
+        """返回(是否命中, 值)，值可以是缓存的负结果None"""
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                value, expire_time = entry
+                if time.time() < expire_time:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._cache[key]
+            self.misses += 1
+            return False, default
 
-                return result
+    def set(self, key, value, ttl: float = None) -> None:
+        with self._lock:
+            expire_time = time.time() + (self._ttl if ttl is None else ttl)
+            self._cache[key] = (value, expire_time)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._maxsize:
+                self._cache.popitem(last=False)
+                self.evictions += 1
 
-        return cached_func
+    def invalidate(self, predicate: Callable[[Any], bool] = None) -> int:
+        """删除满足predicate(key)的条目，predicate为空时清空缓存，返回删除数量"""
+        with self._lock:
+            if predicate is None:
+                count = len(self._cache)
+                self._cache.clear()
+                return count
+            keys = [key for key in self._cache if predicate(key)]
+            for key in keys:
+                del self._cache[key]
+            return len(keys)
 
-    return decorator
+    def get_metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._cache),
+                'maxsize': self._maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+class LogHistogram:
+    """
+    线程安全的固定分桶直方图，用于延迟、批量大小等正数值
+    对数分桶（与HDR Histogram类似），分位数的相对误差不超过 2**(1/sub_buckets)-1；
+    分桶在创建时固定，记录为O(1)；累计记录、不重置，可以按两次快照的差值计算区间内的分布
+    """
+
+    def __init__(self, lowest: float, highest: float, sub_buckets: int = 4):
+        """
+        Args:
+            lowest: 第一个桶的上界，不超过该值的记录都落入第一个桶
+            highest: 最后一个有限桶的上界，超过该值的记录落入溢出桶
+            sub_buckets: 每个2倍区间内的桶数
+        """
+        self._lowest = lowest
+        self._sub_buckets = sub_buckets
+        self._size = math.ceil(math.log2(highest / lowest) * sub_buckets) + 2  # 含第一个桶和溢出桶
+        self._counts = [0] * self._size
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def _index(self, value: float) -> int:
+        if value <= self._lowest:
+            return 0
+        return min(self._size - 1, math.ceil(math.log2(value / self._lowest) * self._sub_buckets))
+
+    def _upper_bound(self, index: int) -> float:
+        if index == self._size - 1:
+            return float('inf')
+        return self._lowest * 2 ** (index / self._sub_buckets)
+
+    def record(self, value: float) -> None:
+        index = self._index(value)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def _percentile(self, counts: List[int], count: int, maximum: float, q: float) -> float:
+        """取第q分位所在桶的上界（不超过记录的最大值）"""
+        rank = max(1, math.ceil(count * q))
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(self._upper_bound(index), maximum)
+        return maximum
+
+    def snapshot(self) -> Dict[str, Any]:
+        """返回累计的记录数、总和、分位数和非空桶（键为桶上界，溢出桶为+Inf）"""
+        with self._lock:
+            counts, count, total = list(self._counts), self.count, self.total
+            minimum, maximum = self.min, self.max
+        snapshot = {'count': count, 'sum': round(total, 6), 'min': minimum, 'max': maximum,
+                    'mean': round(total / count, 6) if count else None}
+        for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999)):
+            snapshot[name] = round(self._percentile(counts, count, maximum, q), 6) if count else None
+        snapshot['buckets'] = {
+            ('+Inf' if index == self._size - 1 else f'{self._upper_bound(index):.6g}'): bucket_count
+            for index, bucket_count in enumerate(counts) if bucket_count
+        }
+        return snapshot
 
 
 def access_system(system=None):
@@ -0,0 +1,272 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+from datetime import datetime
+from collections import defaultdict
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+_LOCK_FILE = ".lock"
+_SEGMENT_SUFFIX = ".log"
+_ACK_SUFFIX = ".ack"
+
+# 记录的位置：(段编号, 段内序号)
+RecordId = Tuple[int, int]
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+class WriteAheadLog:
+    """
+    批处理队列的本地追加写日志（每个worker进程一个目录）
+    - 加入队列的每条更新先追加到当前段文件，按fsync_interval分组提交fsync
+    - 写库成功（或已被拒绝、已重新入队）的记录把段内序号追加到段的确认文件（<段>.ack），
+      回放时跳过已确认的记录，避免已写库的$inc在崩溃或关闭超时后重复计数
+    - 段文件写满后封存，段内所有记录都确认后连同确认文件一起删除
+    - 进程崩溃后目录上的文件锁自动释放，其他worker启动时回放这些遗留目录
+    """
+
+    def __init__(self, base_dir: str, segment_max_bytes: int = 16 * 1024 * 1024, fsync_interval: float = 0.05):
+        """
+        Args:
+            base_dir: 日志根目录，每个进程在其下创建 wal-<pid> 子目录
+            segment_max_bytes: 单个段文件的最大字节数
+            fsync_interval: 分组提交间隔（秒），<=0表示每次追加都立即fsync
+        """
+        self.base_dir = base_dir
+        self.dir = os.path.join(base_dir, f"wal-{os.getpid()}")
+        self._segment_max_bytes = segment_max_bytes
+        self._fsync_interval = fsync_interval
+        self._lock_fd: Optional[int] = None
+        self._file = None
+        self._segment_id = 0
+        self._segment_size = 0
+        self._segment_records = 0  # 当前段已追加的记录数（下一条记录的段内序号）
+        self._outstanding: Dict[int, int] = {}  # {segment_id: 尚未写库的记录数}
+        self._pending_sync: Optional[asyncio.Future] = None
+        self.metrics = {
+            'appended_records': 0,
+            'fsyncs': 0,
+            'segments_deleted': 0,
+            'replayed_records': 0,
+        }
+
+    def open(self):
+        """创建本进程的日志目录并加锁，打开第一个段文件"""
+        if os.path.isdir(self.dir):
+            # 同pid的旧进程（容器重启后pid复用）遗留的目录，改名后作为遗留目录回放
+            os.rename(self.dir, f"{self.dir}.{int(time.time() * 1000)}")
+        os.makedirs(self.dir)
+        self._lock_fd = os.open(os.path.join(self.dir, _LOCK_FILE), os.O_CREAT | os.O_RDWR, 0o600)
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._open_segment(self._segment_id)
+
+    def close(self):
+        """关闭日志；所有记录都已写库时删除本进程目录"""
+        if self._file:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+        self._maybe_delete_segment(self._segment_id, sealed=True)
+        if not any(self._outstanding.values()):
+            shutil.rmtree(self.dir, ignore_errors=True)
+        if self._lock_fd is not None:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _segment_path(self, segment_id: int, directory: str = None, suffix: str = _SEGMENT_SUFFIX) -> str:
+        return os.path.join(directory or self.dir, f"{segment_id:08d}{suffix}")
+
+    def _open_segment(self, segment_id: int):
+        self._segment_id = segment_id
+        self._file = open(self._segment_path(segment_id), "ab")
+        self._segment_size = self._file.tell()
+        self._segment_records = 0
+        self._outstanding.setdefault(segment_id, 0)
+
+    def _rotate(self):
+        """封存当前段并打开新段"""
+        old_segment = self._segment_id
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._open_segment(old_segment + 1)
+        self._maybe_delete_segment(old_segment, sealed=True)
+
+    def _maybe_delete_segment(self, segment_id: int, sealed: bool = None):
+        if sealed is None:
+            sealed = segment_id != self._segment_id or self._file is None
+        if sealed and self._outstanding.get(segment_id) == 0:
+            del self._outstanding[segment_id]
+            try:
+                os.unlink(self._segment_path(segment_id))
+                self.metrics['segments_deleted'] += 1
+            except FileNotFoundError:
+                pass
+            try:
+                os.unlink(self._segment_path(segment_id, suffix=_ACK_SUFFIX))
+            except FileNotFoundError:
+                pass
+
+    def append(self, entries: List[Tuple[Tuple[str, str, str], Dict[str, Any]]]) -> List[RecordId]:
+        """
+        追加记录（只写入文件缓冲区，持久化需await wait_durable()）
+
+        Returns:
+            List[RecordId]: 每条记录的位置，写库后通过release()归还
+        """
+        if self._segment_size >= self._segment_max_bytes:
+            self._rotate()
+        data = b"".join(
+            json.dumps([list(key), update_fields], default=_json_default).encode() + b"\n"
+            for key, update_fields in entries
+        )
+        self._file.write(data)
+        self._segment_size += len(data)
+        first = self._segment_records
+        self._segment_records += len(entries)
+        self._outstanding[self._segment_id] += len(entries)
+        self.metrics['appended_records'] += len(entries)
+        return [(self._segment_id, first + i) for i in range(len(entries))]
+
+    def release(self, records: Iterable[Optional[RecordId]]):
+        """
+        记录已写库（或被拒绝、已重新入队）：段内序号写入确认文件，段内记录全部归还后删除已封存的段
+        确认文件直接写入（不经过用户态缓冲），进程崩溃后仍然有效
+        """
+        by_segment = defaultdict(list)
+        for record in records:
+            if record is not None and record[0] in self._outstanding:
+                by_segment[record[0]].append(record[1])
+        for segment_id, indexes in by_segment.items():
+            self._outstanding[segment_id] = max(0, self._outstanding[segment_id] - len(indexes))
+            if self._outstanding[segment_id] or segment_id == self._segment_id and self._file is not None:
+                self._write_acks(segment_id, indexes)
+            self._maybe_delete_segment(segment_id)
+
+    def _write_acks(self, segment_id: int, indexes: List[int]):
+        """连续的序号合并为一行：起始序号 数量"""
+        indexes.sort()
+        lines, start, count = [], indexes[0], 1
+        for index in indexes[1:]:
+            if index == start + count:
+                count += 1
+            else:
+                lines.append(f"{start} {count}\n")
+                start, count = index, 1
+        lines.append(f"{start} {count}\n")
+        fd = os.open(self._segment_path(segment_id, suffix=_ACK_SUFFIX), os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o600)
+        try:
+            os.write(fd, "".join(lines).encode())
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _read_acks(path: str) -> Set[int]:
+        acked = set()
+        try:
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        start, count = map(int, line.split())
+                    except ValueError:
+                        continue  # 崩溃时写了一半的行
+                    acked.update(range(start, start + count))
+        except FileNotFoundError:
+            pass
+        return acked
+
+    async def wait_durable(self):
+        """等待已追加的记录落盘，同一间隔内的调用共享一次fsync"""
+        loop = asyncio.get_running_loop()
+        if self._pending_sync is None:
+            self._pending_sync = loop.create_future()
+            if self._fsync_interval > 0:
+                loop.call_later(self._fsync_interval, lambda: asyncio.ensure_future(self._group_sync()))
+            else:
+                asyncio.ensure_future(self._group_sync())
+        await asyncio.shield(self._pending_sync)
+
+    async def _group_sync(self):
+        future, self._pending_sync = self._pending_sync, None
+        try:
+            self._file.flush()
+            # 复制文件描述符，避免fsync期间段文件被轮转关闭
+            fd = os.dup(self._file.fileno())
+            try:
+                await asyncio.to_thread(os.fsync, fd)
+            finally:
+                os.close(fd)
+            self.metrics['fsyncs'] += 1
+            future.set_result(None)
+        except Exception as e:
+            logger.error(f"WAL fsync failed: {e}", exc_info=True)
+            future.set_exception(e)
+
+    def claim_orphan_dirs(self) -> List[Tuple[str, int]]:
+        """
+        认领已退出进程遗留的日志目录（目录锁可以获取），返回[(目录, 锁描述符), ...]
+        锁会一直持有到remove_orphan_dir()，避免多个worker同时回放同一目录
+        """
+        orphans = []
+        if not os.path.isdir(self.base_dir):
+            return orphans
+        for name in sorted(os.listdir(self.base_dir)):
+            path = os.path.join(self.base_dir, name)
+            if path == self.dir or not name.startswith("wal-") or not os.path.isdir(path):
+                continue
+            try:
+                fd = os.open(os.path.join(path, _LOCK_FILE), os.O_CREAT | os.O_RDWR, 0o600)
+            except FileNotFoundError:
+                continue  # 已被其他worker回放并删除
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)  # 目录属于仍在运行的worker，或正在被回放
+                continue
+            orphans.append((path, fd))
+        return orphans
+
+    def remove_orphan_dir(self, directory: str, lock_fd: int, delete: bool = True):
+        """回放完成后删除遗留目录并释放锁；delete=False时只释放锁，留待下次启动回放"""
+        if delete:
+            shutil.rmtree(directory, ignore_errors=True)
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        os.close(lock_fd)
+
+    def read_dir(self, directory: str) -> Iterator[Tuple[Tuple[str, str, str], Dict[str, Any]]]:
+        """按顺序读取目录中所有段文件中未确认的记录，忽略崩溃时写了一半的行"""
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(_SEGMENT_SUFFIX):
+                continue
+            acked = self._read_acks(os.path.join(directory, name[:-len(_SEGMENT_SUFFIX)] + _ACK_SUFFIX))
+            with open(os.path.join(directory, name), "rb") as f:
+                for index, line in enumerate(f):
+                    if index in acked:
+                        continue
+                    try:
+                        key, update_fields = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Skipping corrupted WAL record in {name}")
+                        continue
+                    if 'lastUpdated' in update_fields.get('$set', {}):
+                        update_fields['$set']['lastUpdated'] = datetime.utcnow()
+                    self.metrics['replayed_records'] += 1
+                    yield tuple(key), update_fields
+
+    def get_metrics(self) -> Dict[str, Any]:
+        metrics = self.metrics.copy()
+        metrics['outstanding_records'] = sum(self._outstanding.values())
+        metrics['segments'] = len(self._outstanding)
+        return metrics